@@ -0,0 +1,589 @@
+"""Local stand-ins for the Spotify Web API, the YouTube Data API and YTMusic search.
+
+Playlists are synthetic and generated lazily from integer track numbers, so a
+50,000 track playlist costs nothing until it is read. Track `n` is called
+"Song n" by "Artist n % 500"; roughly `explicit_ratio` of the tracks are
+explicit, and every explicit track except one in ten has a clean version that
+search returns at `clean_rank`.
+"""
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ARTISTS = 500
+MARKETS = ['AD', 'AR', 'AT', 'AU', 'BE', 'BG', 'BO', 'BR', 'CA', 'CH', 'CL', 'CO', 'CR', 'CY', 'CZ',
+           'DE', 'DK', 'DO', 'EC', 'EE', 'ES', 'FI', 'FR', 'GB', 'GR', 'GT', 'HK', 'HN', 'HU', 'ID',
+           'IE', 'IS', 'IT', 'JP', 'LI', 'LT', 'LU', 'LV', 'MC', 'MT', 'MX', 'MY', 'NI', 'NL', 'NO',
+           'NZ', 'PA', 'PE', 'PH', 'PL', 'PT', 'PY', 'SE', 'SG', 'SK', 'SV', 'TR', 'TW', 'US', 'UY']
+SONG_QUERY = re.compile(r'^Song (\d+)\b')
+ISRC_QUERY = re.compile(r'^isrc:USFAKE(\d+)$')
+
+
+class Catalog:
+    """Deterministic track catalog shared by the fakes"""
+
+    def __init__(self, explicit_ratio: float = 0.4, clean_rank: int = 3):
+        self.explicit_ratio = explicit_ratio
+        self.clean_rank = clean_rank
+
+    def is_explicit(self, n: int) -> bool:
+        return (n * 7919) % 100 < self.explicit_ratio * 100
+
+    def has_clean_version(self, n: int) -> bool:
+        return n % 10 != 0
+
+    def artist(self, n: int) -> str:
+        return f"Artist {n % ARTISTS}"
+
+
+class FakeUpstream:
+    """Threaded local HTTP server with configurable latency and 429 injection.
+
+    Every `rate_limit_every`-th request is answered with a 429 carrying a
+    Retry-After of `retry_after` seconds. Calls are counted per route. With
+    `send_etags`, GET responses carry an ETag and a matching If-None-Match gets
+    an empty 304.
+    """
+
+    send_etags = False
+
+    def __init__(self, catalog: Catalog = None, latency: float = 0.0,
+                 rate_limit_every: int = 0, retry_after: float = 1):
+        self.catalog = catalog or Catalog()
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.bytes_sent = 0
+        self._requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reset_counters(self) -> None:
+        with self._lock:
+            self.calls.clear()
+            self.bytes_sent = 0
+
+    @property
+    def total_calls(self) -> int:
+        return sum(count for route, count in self.calls.items() if route not in ('429', '304'))
+
+    def routes(self):
+        """(method, compiled path pattern, handler) triples; handlers return (status, payload)"""
+        return []
+
+    def dispatch(self, method: str, path: str, query: dict, body: bytes, headers: dict):
+        with self._lock:
+            self._requests += 1
+            limited = self.rate_limit_every and self._requests % self.rate_limit_every == 0
+            if limited:
+                self.calls['429'] += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if limited:
+            return 429, {'Retry-After': str(self.retry_after)}, {'error': {'status': 429, 'message': 'rate limited'}}
+
+        for route_method, pattern, handler in self.routes():
+            match = pattern.fullmatch(path)
+            if route_method == method and match:
+                with self._lock:
+                    self.calls[handler.__name__] += 1
+                status, payload = handler(match, query, body, headers)
+                return status, {}, payload
+
+        return 404, {}, {'error': {'status': 404, 'message': f"No fake for {method} {path}"}}
+
+    def _handler_class(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _handle(self):
+                parsed = urlparse(self.path)
+                query = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                status, headers, payload = upstream.dispatch(
+                    self.command, parsed.path, query, body, dict(self.headers)
+                )
+
+                if isinstance(payload, tuple):
+                    content_type, data = payload
+                else:
+                    content_type, data = 'application/json', json.dumps(payload).encode()
+
+                if upstream.send_etags and self.command == 'GET' and status == 200:
+                    etag = f'"{hashlib.sha1(data).hexdigest()}"'
+                    headers = {**headers, 'ETag': etag}
+                    if self.headers.get('If-None-Match') == etag:
+                        with upstream._lock:
+                            upstream.calls['304'] += 1
+                        status, data = 304, b''
+
+                with upstream._lock:
+                    upstream.bytes_sent += len(data)
+
+                self.send_response(status)
+                if data:
+                    self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class FakeSpotify(FakeUpstream):
+    """Fake https://api.spotify.com/v1 covering the calls SpotifyService makes"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.playlists = {}
+        self.created = {}
+        self._next_start = 0
+
+    def add_playlist(self, size: int, name: str = None) -> str:
+        playlist_id = f"bench{len(self.playlists)}"
+        self.playlists[playlist_id] = {
+            'name': name or f"Benchmark {size}",
+            'tracks': list(range(self._next_start, self._next_start + size)),
+        }
+        self._next_start += size
+        return playlist_id
+
+    def append_tracks(self, playlist_id: str, count: int) -> None:
+        """Add `count` new tracks to the end of a playlist, changing its snapshot_id"""
+        self.playlists[playlist_id]['tracks'].extend(range(self._next_start, self._next_start + count))
+        self._next_start += count
+
+    def snapshot_id(self, playlist_id: str) -> str:
+        return f"{playlist_id}-{len(self.playlists[playlist_id]['tracks'])}"
+
+    def track(self, n: int, clean: bool = False) -> dict:
+        catalog = self.catalog
+        track_id = f"{'c' if clean else 't'}{n:021d}"
+        artist_id = f"a{n % ARTISTS:021d}"
+        artist = {
+            'id': artist_id,
+            'name': catalog.artist(n),
+            'type': 'artist',
+            'uri': f"spotify:artist:{artist_id}",
+            'href': f"https://api.spotify.com/v1/artists/{artist_id}",
+            'external_urls': {'spotify': f"https://open.spotify.com/artist/{artist_id}"},
+        }
+        album_id = f"{'d' if clean else 'b'}{n // 12:021d}"
+        return {
+            'id': track_id,
+            'name': f"Song {n}",
+            'uri': f"spotify:track:{track_id}",
+            'type': 'track',
+            'explicit': False if clean else catalog.is_explicit(n),
+            'artists': [artist],
+            'album': {
+                'id': album_id,
+                'name': f"Album {n // 12}",
+                'album_type': 'album',
+                'uri': f"spotify:album:{album_id}",
+                'release_date': '2024-01-01',
+                'artists': [artist],
+                'available_markets': MARKETS,
+                'images': [
+                    {'url': f"https://i.scdn.co/image/{album_id}{size}", 'height': size, 'width': size}
+                    for size in (640, 300, 64)
+                ],
+                'external_urls': {'spotify': f"https://open.spotify.com/album/{album_id}"},
+            },
+            'available_markets': MARKETS,
+            'disc_number': 1,
+            'track_number': n % 12 + 1,
+            'duration_ms': 180000 + n % 60000,
+            'popularity': n % 100,
+            'is_local': False,
+            'preview_url': None,
+            'external_ids': {'isrc': f"USFAK{'C' if clean else 'E'}{n:07d}"},
+            'href': f"https://api.spotify.com/v1/tracks/{track_id}",
+            'external_urls': {'spotify': f"https://open.spotify.com/track/{track_id}"},
+        }
+
+    def search_results(self, n: int) -> list:
+        """The full ranked result list for a track's query; requests slice it with offset/limit"""
+        results = [self.track(n)]
+        for k in range(1, 100):
+            results.append(self.track(10 ** 8 + (n * 31 + k * 977) % 10 ** 6))
+        if self.catalog.is_explicit(n) and self.catalog.has_clean_version(n):
+            results[self.catalog.clean_rank] = self.track(n, clean=True)
+        return results
+
+    def routes(self):
+        return [
+            ('GET', re.compile(r'/v1/me/?'), self.me),
+            ('GET', re.compile(r'/v1/me/playlists/?'), self.my_playlists),
+            ('GET', re.compile(r'/v1/playlists/([^/]+)/?'), self.playlist),
+            ('GET', re.compile(r'/v1/playlists/([^/]+)/followers/contains/?'), self.followers_contains),
+            ('GET', re.compile(r'/v1/playlists/([^/]+)/(?:tracks|items)/?'), self.playlist_items),
+            ('POST', re.compile(r'/v1/playlists/([^/]+)/(?:tracks|items)/?'), self.add_items),
+            ('DELETE', re.compile(r'/v1/playlists/([^/]+)/(?:tracks|items)/?'), self.remove_items),
+            ('POST', re.compile(r'/v1/users/([^/]+)/playlists/?'), self.create_playlist),
+            ('GET', re.compile(r'/v1/search/?'), self.search),
+        ]
+
+    def me(self, match, query, body, headers):
+        return 200, {
+            'id': 'benchuser',
+            'display_name': 'Benchmark User',
+            'external_urls': {'spotify': 'https://open.spotify.com/user/benchuser'},
+        }
+
+    def my_playlists(self, match, query, body, headers):
+        limit = int(query.get('limit', 50))
+        offset = int(query.get('offset', 0))
+        ids = list(self.playlists)
+        items = [
+            {
+                'id': playlist_id,
+                'name': self.playlists[playlist_id]['name'],
+                'snapshot_id': self.snapshot_id(playlist_id),
+                'external_urls': {'spotify': f"https://open.spotify.com/playlist/{playlist_id}"},
+                'tracks': {'total': len(self.playlists[playlist_id]['tracks'])},
+            }
+            for playlist_id in ids[offset:offset + limit]
+        ]
+        next_url = f"{self.url}/v1/me/playlists?offset={offset + limit}&limit={limit}" \
+            if offset + limit < len(ids) else None
+        return 200, {'items': items, 'total': len(ids), 'limit': limit, 'offset': offset, 'next': next_url}
+
+    def playlist(self, match, query, body, headers):
+        playlist_id = match.group(1)
+        if playlist_id not in self.playlists:
+            return 404, {'error': {'status': 404, 'message': 'Not found'}}
+        playlist = self.playlists[playlist_id]
+        return 200, {
+            'id': playlist_id,
+            'name': playlist['name'],
+            'snapshot_id': self.snapshot_id(playlist_id),
+            'external_urls': {'spotify': f"https://open.spotify.com/playlist/{playlist_id}"},
+            'tracks': {'total': len(playlist['tracks'])},
+        }
+
+    def followers_contains(self, match, query, body, headers):
+        playlist_id = match.group(1)
+        return 200, [playlist_id in self.created or playlist_id in self.playlists]
+
+    def playlist_items(self, match, query, body, headers):
+        playlist_id = match.group(1)
+        limit = int(query.get('limit', 100))
+        offset = int(query.get('offset', 0))
+        if playlist_id in self.created:
+            uris = self.created[playlist_id]
+            end = min(offset + limit, len(uris))
+            next_url = f"{self.url}/v1/playlists/{playlist_id}/tracks?offset={end}&limit={limit}" \
+                if end < len(uris) else None
+            items = [{'track': {'uri': uri}} for uri in uris[offset:end]]
+            return 200, {'items': items, 'total': len(uris), 'limit': limit, 'offset': offset, 'next': next_url}
+
+        playlist = self.playlists[playlist_id]
+        size = len(playlist['tracks'])
+        end = min(offset + limit, size)
+        items = [
+            {'added_at': '2024-01-01T00:00:00Z', 'track': self.track(n)}
+            for n in playlist['tracks'][offset:end]
+        ]
+        next_url = f"{self.url}/v1/playlists/{playlist_id}/tracks?offset={end}&limit={limit}" \
+            if end < size else None
+        return 200, {'items': items, 'total': size, 'limit': limit, 'offset': offset, 'next': next_url}
+
+    def create_playlist(self, match, query, body, headers):
+        data = json.loads(body or b'{}')
+        playlist_id = f"new{len(self.created)}"
+        self.created[playlist_id] = []
+        return 201, {
+            'id': playlist_id,
+            'name': data.get('name'),
+            'snapshot_id': f"{playlist_id}-0",
+            'external_urls': {'spotify': f"https://open.spotify.com/playlist/{playlist_id}"},
+        }
+
+    def add_items(self, match, query, body, headers):
+        playlist_id = match.group(1)
+        data = json.loads(body or b'{}')
+        # spotipy posts a bare list of uris; the Web API also accepts {"uris": [...]}
+        uris = data if isinstance(data, list) else data.get('uris', [])
+        self.created.setdefault(playlist_id, []).extend(uris)
+        return 201, {'snapshot_id': f"{playlist_id}-{len(self.created[playlist_id])}"}
+
+    def remove_items(self, match, query, body, headers):
+        playlist_id = match.group(1)
+        data = json.loads(body or b'{}')
+        items = data.get('tracks', data.get('items', []))
+        uris = self.created.get(playlist_id, [])
+        if all('positions' in item for item in items):
+            positions = {position for item in items for position in item['positions']}
+            self.created[playlist_id] = [uri for position, uri in enumerate(uris) if position not in positions]
+        else:
+            removed = {item['uri'] for item in items}
+            self.created[playlist_id] = [uri for uri in uris if uri not in removed]
+        return 200, {'snapshot_id': f"{playlist_id}-{len(self.created[playlist_id])}"}
+
+    def search(self, match, query, body, headers):
+        limit = int(query.get('limit', 20))
+        offset = int(query.get('offset', 0))
+        q = query.get('q', '')
+
+        isrc = ISRC_QUERY.match(q)
+        song = SONG_QUERY.match(q)
+        if isrc:
+            results = [self.track(int(isrc.group(1)))]
+        elif song:
+            results = self.search_results(int(song.group(1)))
+        else:
+            results = []
+
+        return 200, {'tracks': {
+            'items': results[offset:offset + limit],
+            'total': len(results),
+            'limit': limit,
+            'offset': offset,
+        }}
+
+
+class FakeYouTube(FakeUpstream):
+    """Fake YouTube Data API v3, including the multipart batch endpoint"""
+
+    send_etags = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.playlists = {}
+        self.created = {}
+        self._next_start = 0
+
+    def add_playlist(self, size: int, name: str = None) -> str:
+        playlist_id = f"PLbench{len(self.playlists)}"
+        self.playlists[playlist_id] = {
+            'name': name or f"Benchmark {size}",
+            'start': self._next_start,
+            'size': size,
+        }
+        self._next_start += size
+        return playlist_id
+
+    def routes(self):
+        return [
+            ('GET', re.compile(r'/youtube/v3/channels'), self.channels),
+            ('GET', re.compile(r'/youtube/v3/playlists'), self.list_playlists),
+            ('POST', re.compile(r'/youtube/v3/playlists'), self.insert_playlist),
+            ('GET', re.compile(r'/youtube/v3/playlistItems'), self.list_playlist_items),
+            ('POST', re.compile(r'/youtube/v3/playlistItems'), self.insert_playlist_item),
+            ('POST', re.compile(r'/batch(?:/youtube/v3)?'), self.batch),
+        ]
+
+    def channels(self, match, query, body, headers):
+        return 200, {'items': [{
+            'id': 'UCbenchmark',
+            'snippet': {'title': 'Benchmark Channel', 'customUrl': '@benchmark'},
+        }]}
+
+    def list_playlists(self, match, query, body, headers):
+        if 'id' in query:
+            playlist_id = query['id']
+            if playlist_id in self.playlists:
+                name, size = self.playlists[playlist_id]['name'], self.playlists[playlist_id]['size']
+            else:
+                created = self.created.get(playlist_id, {})
+                name, size = created.get('title'), len(created.get('items', []))
+            return 200, {'items': [{
+                'id': playlist_id,
+                'snippet': {'title': name},
+                'contentDetails': {'itemCount': size},
+            }]}
+
+        items = [
+            {'id': playlist_id, 'snippet': {'title': playlist['name']}}
+            for playlist_id, playlist in self.playlists.items()
+        ]
+        return 200, {'items': items}
+
+    def insert_playlist(self, match, query, body, headers):
+        snippet = json.loads(body or b'{}').get('snippet', {})
+        playlist_id = f"PLnew{len(self.created)}"
+        self.created[playlist_id] = {'title': snippet.get('title'), 'items': []}
+        return 200, {
+            'id': playlist_id,
+            'snippet': {'title': snippet.get('title'), 'description': snippet.get('description', '')},
+        }
+
+    def list_playlist_items(self, match, query, body, headers):
+        limit = int(query.get('maxResults', 5))
+        offset = int(query.get('pageToken') or 0)
+        if query['playlistId'] in self.created:
+            video_ids = self.created[query['playlistId']]['items']
+            end = min(offset + limit, len(video_ids))
+            response = {
+                'items': [{'contentDetails': {'videoId': video_id}} for video_id in video_ids[offset:end]],
+                'pageInfo': {'totalResults': len(video_ids), 'resultsPerPage': limit},
+            }
+            if end < len(video_ids):
+                response['nextPageToken'] = str(end)
+            return 200, response
+
+        playlist = self.playlists[query['playlistId']]
+        end = min(offset + limit, playlist['size'])
+        items = []
+        for i in range(offset, end):
+            n = playlist['start'] + i
+            items.append({
+                'snippet': {'title': f"Song {n}", 'videoOwnerChannelTitle': f"{self.catalog.artist(n)} - Topic"},
+                'contentDetails': {'videoId': f"v{n:010d}"},
+            })
+        response = {'items': items, 'pageInfo': {'totalResults': playlist['size'], 'resultsPerPage': limit}}
+        if end < playlist['size']:
+            response['nextPageToken'] = str(end)
+        return 200, response
+
+    def insert_playlist_item(self, match, query, body, headers):
+        snippet = json.loads(body or b'{}').get('snippet', {})
+        playlist = self.created.get(snippet.get('playlistId'))
+        if playlist is None:
+            return 404, {'error': {'code': 404, 'message': 'playlistNotFound'}}
+
+        items = playlist['items']
+        position = snippet.get('position', len(items))
+        if position > len(items):
+            return 400, {'error': {'code': 400, 'message': 'invalidPlaylistItemPosition'}}
+        items.insert(position, snippet['resourceId']['videoId'])
+        return 200, {'id': uuid.uuid4().hex, 'snippet': snippet}
+
+    def batch(self, match, query, body, headers):
+        content_type = headers.get('Content-Type') or headers.get('content-type')
+        message = BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        boundary = uuid.uuid4().hex
+        parts = []
+
+        for part in message.get_payload():
+            payload = part.get_payload()
+            head, _, sub_body = payload.replace('\r\n', '\n').partition('\n\n')
+            request_line = head.split('\n', 1)[0]
+            method, target, _ = request_line.split(' ', 2)
+            parsed = urlparse(target)
+            sub_query = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+
+            # Sub-requests share the batch's latency but are counted and rate limited on their own
+            with self._lock:
+                self._requests += 1
+                limited = self.rate_limit_every and self._requests % self.rate_limit_every == 0
+            if limited:
+                with self._lock:
+                    self.calls['429'] += 1
+                status, payload = 429, {'error': {'code': 429, 'message': 'rateLimitExceeded'}}
+            else:
+                status, payload = 404, {'error': {'code': 404}}
+                for route_method, pattern, handler in self.routes():
+                    if route_method == method and pattern.fullmatch(parsed.path):
+                        with self._lock:
+                            self.calls[handler.__name__] += 1
+                        status, payload = handler(None, sub_query, sub_body.encode(), {})
+                        break
+
+            content_id = part['Content-ID'].strip('<>')
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n\r\n"
+                f"{json.dumps(payload)}\r\n"
+            )
+
+        data = ''.join(parts) + f"--{boundary}--\r\n"
+        return 200, (f"multipart/mixed; boundary={boundary}", data.encode())
+
+
+class FakeYTMusic:
+    """In-process stand-in for ytmusicapi.YTMusic.
+
+    YTMusic scrapes the music.youtube.com web client rather than a documented
+    API, so it is faked at the object level instead of over HTTP.
+    """
+
+    def __init__(self, catalog: Catalog = None, latency: float = 0.0):
+        self.catalog = catalog or Catalog()
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def reset_counters(self) -> None:
+        with self._lock:
+            self.calls.clear()
+
+    def song(self, n: int, clean: bool = False) -> dict:
+        video_id = f"{'c' if clean else 'v'}{n:010d}"
+        return {
+            'resultType': 'song',
+            'videoId': video_id,
+            'title': f"Song {n}",
+            'artists': [{'name': self.catalog.artist(n), 'id': f"UC{n % ARTISTS:08d}"}],
+            'album': {'name': f"Album {n // 12}", 'id': f"MPRE{n // 12:08d}"},
+            'duration': '3:00',
+            'duration_seconds': 180,
+            'isExplicit': False if clean else self.catalog.is_explicit(n),
+            'thumbnails': [{'url': f"https://lh3.googleusercontent.com/{video_id}", 'width': 60, 'height': 60}],
+        }
+
+    def search(self, query: str, filter: str = None, limit: int = 20, **kwargs) -> list:
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls['search'] += 1
+
+        song = SONG_QUERY.match(query)
+        if not song:
+            return []
+
+        n = int(song.group(1))
+        results = [self.song(n)]
+        if self.catalog.is_explicit(n) and self.catalog.has_clean_version(n):
+            results.append(self.song(n, clean=True))
+        for k in range(1, max(limit, 20) - len(results) + 1):
+            results.append(self.song(10 ** 8 + (n * 31 + k * 977) % 10 ** 6))
+        return results
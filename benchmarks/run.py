@@ -0,0 +1,300 @@
+"""Offline benchmarks for the playlist services and the ninja API.
+
+Runs SpotifyService, YouTubeMusicService and the API endpoints against the
+local fakes in benchmarks.fakes and reports wall time, throughput, peak
+memory and upstream call counts. No network access is needed:
+
+    python -m benchmarks.run --sizes 100 1000 10000 --latency 0.02
+    python -m benchmarks.run --sizes 2000 --rate-limit-every 50 --warm --json results.json
+
+spotify.reconvert_playlist converts a playlist, appends NEW_TRACKS tracks to the
+source and reports only the second, incremental conversion.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import ExitStack
+from functools import lru_cache
+from unittest import mock
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'benchmarks.settings'
+
+SCENARIOS = [
+    'spotify.get_playlist_tracks',
+    'spotify.convert_playlist',
+    'spotify.reconvert_playlist',
+    'youtube.get_playlist_tracks',
+    'youtube.convert_playlist',
+    'api.spotify_tracks',
+    'api.spotify_convert',
+    'api.youtube_tracks',
+    'api.youtube_convert',
+]
+
+NEW_TRACKS = 5
+
+
+def setup_django():
+    import django
+    from django.conf import settings
+    from django.core.management import call_command
+
+    if os.path.exists(settings.DATABASES['default']['NAME']):
+        os.remove(settings.DATABASES['default']['NAME'])
+    django.setup()
+    call_command('migrate', verbosity=0)
+
+    # The fakes charge no quota, and admission isn't what is measured
+    from youtube_app.quota import quota_scheduler
+    quota_scheduler.daily_quota = quota_scheduler.user_quota = 10 ** 9
+
+    # Searches read the session's token from the table rather than the client
+    from datetime import timedelta
+    from django.utils import timezone
+    from spotify_app.models import Token
+    Token.objects.create(user='benchmark-session', access_token='benchmark-token', refresh_token='benchmark-token',
+                         token_type='Bearer', expires_in=timezone.now() + timedelta(days=1))
+
+
+class Upstreams:
+    """The three fakes plus ready clients pointed at them"""
+
+    def __init__(self, latency: float, rate_limit_every: int, retry_after: float, ytmusic_latency: float):
+        from benchmarks.fakes import Catalog, FakeSpotify, FakeYouTube, FakeYTMusic
+
+        catalog = Catalog()
+        self.spotify = FakeSpotify(catalog, latency, rate_limit_every, retry_after).start()
+        self.youtube = FakeYouTube(catalog, latency, rate_limit_every, retry_after).start()
+        self.ytmusic = FakeYTMusic(catalog, ytmusic_latency)
+
+    def stop(self) -> None:
+        self.spotify.stop()
+        self.youtube.stop()
+
+    def reset_counters(self) -> None:
+        self.spotify.reset_counters()
+        self.youtube.reset_counters()
+        self.ytmusic.reset_counters()
+
+    def spotify_client(self):
+        from spotipy import Spotify
+        from newMusicCleaner.metrics import instrument_session
+
+        client = Spotify(auth='benchmark-token', requests_timeout=30)
+        client.prefix = f"{self.spotify.url}/v1/"
+        instrument_session(client._session, 'spotify')
+        return client
+
+    def youtube_client(self):
+        import httplib2
+        from googleapiclient.discovery import build_from_document
+        from googleapiclient.discovery_cache import get_static_doc
+        from youtube_app.http_cache import DjangoHttpCache
+        from youtube_app.quota import MeteredHttpRequest
+
+        document = json.loads(get_static_doc('youtube', 'v3'))
+        document['rootUrl'] = f"{self.youtube.url}/"
+
+        http_cache = DjangoHttpCache(namespace='benchmark-session')
+        local = threading.local()
+
+        def build_request(http, *args, **kwargs):
+            # One connection per thread, as in youtube_app.extras
+            if getattr(local, 'http', None) is None:
+                local.http = httplib2.Http(cache=http_cache)
+            request = MeteredHttpRequest(local.http, *args, **kwargs)
+            request.quota_user = 'benchmark-session'
+            return request
+
+        return build_from_document(document, http=httplib2.Http(), requestBuilder=build_request)
+
+
+def reset_caches() -> None:
+    from django.core.cache import cache
+    from spotify_app.match_cache import match_cache
+    from spotify_app.models import PlaylistConversion, TrackMatch
+    from youtube_app.metadata_cache import metadata_cache
+    from youtube_app.models import QuotaUsage, VideoMetadata
+
+    match_cache.clear()
+    TrackMatch.objects.all().delete()
+    PlaylistConversion.objects.all().delete()
+    metadata_cache.clear()
+    VideoMetadata.objects.all().delete()
+    QuotaUsage.objects.all().delete()
+    cache.clear()
+
+
+@lru_cache(maxsize=None)
+def api_client():
+    # ninja only allows one TestClient per NinjaAPI
+    from ninja.testing import TestClient
+    from spotify_app.api import api
+
+    return TestClient(api)
+
+
+def prepare_scenario(name: str, upstreams: Upstreams, size: int, spotify_playlist: str) -> str:
+    """Unmeasured setup; returns the Spotify playlist the scenario runs against"""
+    from spotify_app.spotify_service import SpotifyService
+
+    if name == 'spotify.reconvert_playlist':
+        spotify_playlist = upstreams.spotify.add_playlist(size)
+        SpotifyService('benchmark-session').convert_playlist(spotify_playlist)
+        upstreams.spotify.append_tracks(spotify_playlist, NEW_TRACKS)
+    return spotify_playlist
+
+
+def _body(response):
+    """The JSON body of an API response, or an error carrying its status and body"""
+    if response.status_code >= 400:
+        raise RuntimeError(f"HTTP {response.status_code}: {response.content.decode(errors='replace')[:500]}")
+    return response.json()
+
+
+def run_scenario(name: str, upstreams: Upstreams, spotify_playlist: str, youtube_playlist: str):
+    from spotify_app.spotify_service import SpotifyService
+    from youtube_app.yt_services import YouTubeMusicService
+
+    session = mock.MagicMock(session_key='benchmark-session')
+    client = api_client()
+
+    if name == 'spotify.get_playlist_tracks':
+        return len(SpotifyService('benchmark-session').get_playlist_tracks(spotify_playlist))
+    if name in ('spotify.convert_playlist', 'spotify.reconvert_playlist'):
+        result = SpotifyService('benchmark-session').convert_playlist(spotify_playlist)
+        return result['num_original_clean'] + result['num_clean_found'] + result['num_still_missing']
+    if name == 'youtube.get_playlist_tracks':
+        return len(YouTubeMusicService('benchmark-session').get_playlist_tracks(youtube_playlist))
+    if name == 'youtube.convert_playlist':
+        result = YouTubeMusicService('benchmark-session').convert_playlist(youtube_playlist)
+        return result['num_original_clean'] + result['num_converted'] + result['num_still_missing']
+    if name == 'api.spotify_tracks':
+        return len(_body(client.get(f"/playlists/{spotify_playlist}/tracks", session=session)))
+    if name == 'api.spotify_convert':
+        result = _body(client.post(f"/playlist/{spotify_playlist}/convert", session=session))
+        return result['num_original_clean'] + result['num_clean_found'] + result['num_still_missing']
+    if name == 'api.youtube_tracks':
+        return len(_body(client.get(f"/youtube/playlists/{youtube_playlist}/tracks", session=session)))
+    if name == 'api.youtube_convert':
+        result = _body(client.post(f"/youtube/playlist/{youtube_playlist}/convert", session=session))
+        return result['num_original_clean'] + result['num_converted'] + result['num_still_missing']
+    raise ValueError(f"Unknown scenario: {name}")
+
+
+def coalesced_searches() -> int:
+    from spotify_app.search_engine import search_engine
+    from youtube_app.yt_services import ytmusic_searches
+
+    return search_engine.coalesced + ytmusic_searches.coalesced
+
+
+def measure(name: str, size: int, upstreams: Upstreams, spotify_playlist: str, youtube_playlist: str,
+            phase: str) -> dict:
+    spotify_playlist = prepare_scenario(name, upstreams, size, spotify_playlist)
+    upstreams.reset_counters()
+    coalesced = coalesced_searches()
+    tracemalloc.start()
+    started = time.perf_counter()
+    error = None
+
+    try:
+        tracks = run_scenario(name, upstreams, spotify_playlist, youtube_playlist)
+    except Exception as e:
+        tracks = 0
+        error = f"{type(e).__name__}: {e}"
+
+    wall = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'scenario': name,
+        'phase': phase,
+        'size': size,
+        'tracks': tracks,
+        'wall_s': round(wall, 3),
+        'tracks_per_s': round(tracks / wall, 1) if wall else None,
+        'peak_mb': round(peak / 2 ** 20, 2),
+        'spotify_calls': dict(upstreams.spotify.calls),
+        'youtube_calls': dict(upstreams.youtube.calls),
+        'ytmusic_calls': dict(upstreams.ytmusic.calls),
+        'upstream_calls': upstreams.spotify.total_calls + upstreams.youtube.total_calls
+        + upstreams.ytmusic.total_calls,
+        'rate_limited': upstreams.spotify.calls['429'] + upstreams.youtube.calls['429'],
+        'upstream_bytes': upstreams.spotify.bytes_sent + upstreams.youtube.bytes_sent,
+        'coalesced': coalesced_searches() - coalesced,
+        'error': error,
+    }
+
+
+def print_table(rows) -> None:
+    header = f"{'scenario':<30}{'phase':<7}{'size':>7}{'wall s':>9}{'tracks/s':>10}{'peak MB':>9}" \
+             f"{'calls':>8}{'429s':>6}{'MB in':>8}"
+    print(header)
+    print('-' * len(header))
+    for row in rows:
+        print(f"{row['scenario']:<30}{row['phase']:<7}{row['size']:>7}{row['wall_s']:>9}"
+              f"{row['tracks_per_s'] or 0:>10}{row['peak_mb']:>9}{row['upstream_calls']:>8}"
+              f"{row['rate_limited']:>6}{row['upstream_bytes'] / 2 ** 20:>8.2f}"
+              + (f"  ERROR: {row['error']}" if row['error'] else ''))
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000],
+                        help="playlist sizes to generate (100 to 50000)")
+    parser.add_argument('--scenarios', nargs='+', default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument('--latency', type=float, default=0.02, help="seconds added to every fake HTTP response")
+    parser.add_argument('--ytmusic-latency', type=float, default=0.05, help="seconds added to every YTMusic search")
+    parser.add_argument('--rate-limit-every', type=int, default=0, help="answer every Nth request with a 429")
+    parser.add_argument('--retry-after', type=float, default=1, help="Retry-After seconds sent with injected 429s")
+    parser.add_argument('--search-rate', type=float, default=500.0,
+                        help="token bucket rate for the Spotify search engine, requests per second")
+    parser.add_argument('--warm', action='store_true', help="run every scenario a second time with warm caches")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    setup_django()
+
+    from spotify_app.search_engine import search_engine
+
+    upstreams = Upstreams(args.latency, args.rate_limit_every, args.retry_after, args.ytmusic_latency)
+    search_engine.search_url = f"{upstreams.spotify.url}/v1/search"
+    search_engine.bucket.rate = args.search_rate
+    search_engine.bucket.capacity = max(1, int(args.search_rate))
+
+    rows = []
+    with ExitStack() as stack:
+        stack.enter_context(mock.patch('spotify_app.spotify_service.get_spotify_client',
+                                       side_effect=lambda session_id: upstreams.spotify_client()))
+        stack.enter_context(mock.patch('youtube_app.yt_services.get_youtube_client',
+                                       side_effect=lambda session_id: upstreams.youtube_client()))
+        stack.enter_context(mock.patch('youtube_app.yt_services.YTMusic', return_value=upstreams.ytmusic))
+
+        for size in args.sizes:
+            spotify_playlist = upstreams.spotify.add_playlist(size)
+            youtube_playlist = upstreams.youtube.add_playlist(size)
+
+            for name in args.scenarios:
+                reset_caches()
+                rows.append(measure(name, size, upstreams, spotify_playlist, youtube_playlist, 'cold'))
+                if args.warm:
+                    rows.append(measure(name, size, upstreams, spotify_playlist, youtube_playlist, 'warm'))
+
+    upstreams.stop()
+    print_table(rows)
+
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(rows, fp, indent=2)
+
+    return 1 if any(row['error'] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,18 @@
+"""Settings for running the benchmarks offline against a throwaway database"""
+import os
+import tempfile
+
+from newMusicCleaner.settings import *  # noqa: F401,F403
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(tempfile.gettempdir(), 'playlistcurator-bench.sqlite3'),
+    }
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
@@ -2,6 +2,8 @@
 ASGI config for newMusicCleaner project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Serve it with ``uvicorn newMusicCleaner.asgi:application`` to run the async
+endpoints under /api/async/ without a thread per request.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
@@ -14,3 +16,15 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'newMusicCleaner.settings')
 
 application = get_asgi_application()
+
+# Picks up conversion jobs queued before a restart and runs new ones
+from spotify_app.jobs import job_queue  # noqa: E402
+
+job_queue.start()
+
+# Refreshes the tokens of live sessions ahead of expiry, whether or not a request comes by
+from newMusicCleaner.token_lease import token_refresher  # noqa: E402
+import spotify_app.extras  # noqa: E402,F401  registers the Spotify tokens
+import youtube_app.extras  # noqa: E402,F401  registers the YouTube tokens
+
+token_refresher.start()
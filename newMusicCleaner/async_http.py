@@ -0,0 +1,59 @@
+"""httpx clients for the async services, one per event loop and service.
+
+Under ASGI the whole process shares one loop and so one connection pool per
+service. Async views served through WSGI run each request on its own loop,
+and a client's connections can't outlive the loop they were opened on, so
+those get a client per request.
+"""
+import asyncio
+import weakref
+from contextlib import nullcontext
+from typing import Dict, Optional
+
+import httpx
+
+from newMusicCleaner.concurrency import AIMDLimiter, Call
+from newMusicCleaner.metrics import InstrumentedTransport, UPSTREAM_RETRIES, endpoint_label
+from newMusicCleaner.settings import ASYNC_HTTP_MAX_CONNECTIONS, ASYNC_HTTP_MAX_RETRIES, ASYNC_HTTP_TIMEOUT
+
+_clients: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, httpx.AsyncClient]]' = \
+    weakref.WeakKeyDictionary()
+
+
+def async_client(service: str) -> httpx.AsyncClient:
+    """Shared AsyncClient for `service` on the running loop, recording every call in the upstream metrics"""
+    clients = _clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(service)
+    if client is None:
+        client = clients[service] = httpx.AsyncClient(
+            timeout=httpx.Timeout(ASYNC_HTTP_TIMEOUT),
+            transport=InstrumentedTransport(
+                service,
+                limits=httpx.Limits(max_connections=ASYNC_HTTP_MAX_CONNECTIONS)
+            )
+        )
+    return client
+
+
+async def send_with_retries(service: str, method: str, url: str, max_retries: int = ASYNC_HTTP_MAX_RETRIES,
+                            limiter: Optional[AIMDLimiter] = None, **kwargs) -> httpx.Response:
+    """Send a request, waiting out 429s for their Retry-After and retrying 5xx with backoff.
+
+    Each attempt holds a slot of `limiter`, if given, only while it is in
+    flight, so a call waiting out a Retry-After leaves its slot to others.
+    The last response is returned whatever its status; callers raise for it.
+    """
+    client = async_client(service)
+    for attempt in range(max_retries + 1):
+        async with (limiter.aslot() if limiter else nullcontext(Call())) as call:
+            response = await client.request(method, url, **kwargs)
+            call.rate_limited = response.status_code == 429
+            call.failed = response.status_code >= 500
+        if attempt == max_retries or (response.status_code != 429 and response.status_code < 500):
+            return response
+
+        delay = 2 ** attempt
+        if response.status_code == 429:
+            delay = float(response.headers.get('Retry-After', delay))
+        UPSTREAM_RETRIES.inc(service=service, endpoint=endpoint_label(url))
+        await asyncio.sleep(delay)
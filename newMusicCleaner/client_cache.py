@@ -0,0 +1,50 @@
+import threading
+from datetime import timedelta
+from typing import Any, Callable, Optional, Tuple
+
+from cachetools import LRUCache
+from django.utils import timezone
+
+from .metrics import record_cache_lookups
+from .singleflight import SingleFlight
+
+
+class ClientCache:
+    """Process-wide cache of ready API clients keyed by session id.
+
+    Entries are dropped once their token expires. Loading goes through a
+    single-flight per session, so when a token needs refreshing only one caller
+    refreshes it while concurrent callers wait for the new client.
+    """
+
+    def __init__(self, maxsize: int = 1024, expiry_margin: int = 0, name: str = 'clients'):
+        self.name = name
+        self._clients = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self.expiry_margin = timedelta(seconds=expiry_margin)
+
+    def get(self, session_id: str, load: Callable[[], Optional[Tuple[Any, Any]]]) -> Any:
+        """Return the cached client, or build one with `load` which returns (client, expires_at)"""
+        with self._lock:
+            entry = self._clients.get(session_id)
+        if entry and entry[1] - self.expiry_margin > timezone.now():
+            record_cache_lookups(self.name, 1, 0)
+            return entry[0]
+
+        record_cache_lookups(self.name, 0, 1)
+        return self._flight.do(session_id, lambda: self._load(session_id, load))
+
+    def _load(self, session_id: str, load: Callable[[], Optional[Tuple[Any, Any]]]) -> Any:
+        loaded = load()
+        if loaded is None:
+            self.invalidate(session_id)
+            return None
+
+        with self._lock:
+            self._clients[session_id] = loaded
+        return loaded[0]
+
+    def invalidate(self, session_id: str) -> None:
+        with self._lock:
+            self._clients.pop(session_id, None)
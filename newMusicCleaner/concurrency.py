@@ -0,0 +1,148 @@
+"""Adaptive (AIMD) limits on the calls in flight to one upstream.
+
+Every SpotifyService, YouTubeMusicService and the Spotify search engine of a
+process share one limit per upstream. Each call answered within the latency
+target adds 1/limit, so the limit grows by one per round of calls while the
+upstream keeps up. A 429 or a slow answer multiplies it by `backoff`, once
+per round: only calls started after the last cut can cut it again, so a burst
+of 429s from one window of calls counts once.
+
+Callers wait for a slot with `slot()` from threads or `aslot()` on an event
+loop; both draw on the same limit.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Iterator
+
+from newMusicCleaner.metrics import Counter, Gauge
+
+CONCURRENCY_LIMIT = Gauge(
+    'upstream_concurrency_limit', 'Calls currently allowed in flight to an upstream', ['service']
+)
+CONCURRENCY_IN_FLIGHT = Gauge(
+    'upstream_concurrency_in_flight', 'Calls holding a concurrency slot', ['service']
+)
+CONCURRENCY_WAITING = Gauge(
+    'upstream_concurrency_waiting', 'Calls queued for a concurrency slot', ['service']
+)
+CONCURRENCY_CHANGES = Counter(
+    'upstream_concurrency_limit_changes_total', 'Concurrency limit changes by direction', ['service', 'direction']
+)
+
+
+class Call:
+    """One call holding a slot: set `rate_limited` on a 429, `failed` on another error response"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.rate_limited = False
+        self.failed = False
+
+
+class AIMDLimiter:
+    """Adaptive limit on the calls in flight to `service`, between `minimum` and `maximum`"""
+
+    def __init__(self, service: str, initial: int, minimum: int, maximum: int,
+                 latency_target: float, backoff: float = 0.5):
+        self.service = service
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self._limit = float(initial)
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self._async_waiters = deque()
+        CONCURRENCY_LIMIT.set(initial, service=service)
+
+    @property
+    def limit(self) -> int:
+        """Calls allowed in flight right now"""
+        return int(self._limit)
+
+    def _try_acquire(self) -> bool:
+        if self._in_flight < int(self._limit):
+            self._in_flight += 1
+            CONCURRENCY_IN_FLIGHT.set(self._in_flight, service=self.service)
+            return True
+        return False
+
+    def _release(self, call: Call) -> None:
+        latency = time.monotonic() - call.started
+        with self._cond:
+            self._in_flight -= 1
+            CONCURRENCY_IN_FLIGHT.set(self._in_flight, service=self.service)
+            if call.rate_limited or latency > self.latency_target:
+                if call.started >= self._last_decrease:
+                    self._set_limit(max(self.minimum, self._limit * self.backoff), 'decrease')
+                    self._last_decrease = time.monotonic()
+            elif not call.failed and self._limit < self.maximum:
+                self._set_limit(min(self.maximum, self._limit + 1 / self._limit), 'increase')
+
+            self._cond.notify_all()
+            while self._async_waiters:
+                loop, waiter = self._async_waiters.popleft()
+                loop.call_soon_threadsafe(_wake, waiter)
+
+    def _set_limit(self, limit: float, direction: str) -> None:
+        if int(limit) != int(self._limit):
+            CONCURRENCY_CHANGES.inc(service=self.service, direction=direction)
+            CONCURRENCY_LIMIT.set(int(limit), service=self.service)
+        self._limit = limit
+
+    @contextmanager
+    def slot(self) -> Iterator[Call]:
+        """Hold one of the slots for a blocking call"""
+        with self._cond:
+            if not self._try_acquire():
+                CONCURRENCY_WAITING.inc(service=self.service)
+                try:
+                    self._cond.wait_for(self._try_acquire)
+                finally:
+                    CONCURRENCY_WAITING.dec(service=self.service)
+        call = Call()
+        try:
+            yield call
+        except BaseException:
+            call.failed = True
+            raise
+        finally:
+            self._release(call)
+
+    @asynccontextmanager
+    async def aslot(self) -> AsyncIterator[Call]:
+        """`slot` for a call awaited on an event loop"""
+        loop = asyncio.get_running_loop()
+        waiting = False
+        try:
+            while True:
+                with self._cond:
+                    if self._try_acquire():
+                        break
+                    waiter = loop.create_future()
+                    self._async_waiters.append((loop, waiter))
+                    if not waiting:
+                        waiting = True
+                        CONCURRENCY_WAITING.inc(service=self.service)
+                await waiter
+        finally:
+            if waiting:
+                CONCURRENCY_WAITING.dec(service=self.service)
+
+        call = Call()
+        try:
+            yield call
+        except BaseException:
+            call.failed = True
+            raise
+        finally:
+            self._release(call)
+
+
+def _wake(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
@@ -0,0 +1,220 @@
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Callable, Dict, FrozenSet, List, Optional, Sequence, Tuple
+
+from rapidfuzz import fuzz, process
+
+# Tags naming another cut of the same recording; live, remix, acoustic and
+# instrumental versions are different recordings and keep their tag
+EDITION_TAGS = (
+    r'clean|explicit|dirty|censored|edited|radio edit|clean edit|'
+    r'(?:album|single|radio|clean|explicit|original|remastered) version|'
+    r'remaster(?:ed)?|\d{4} remaster(?:ed)?|remaster(?:ed)? \d{4}|'
+    r'mono|stereo|deluxe(?: edition)?|expanded edition|bonus track'
+)
+OTHER_RECORDING = r'(?!.*\b(?:live|remix|mix|acoustic|instrumental|demo)\b)'
+
+FEATURING = re.compile(
+    r'\s*[(\[]\s*(?:feat|ft|featuring|with)\b\.?[^)\]]*[)\]]'
+    r'|\s+(?:feat|ft|featuring)\b\.?\s.*$',
+    re.IGNORECASE
+)
+BRACKETED_EDITION = re.compile(
+    rf'\s*[(\[]{OTHER_RECORDING}[^)\]]*\b(?:{EDITION_TAGS})\b[^)\]]*[)\]]',
+    re.IGNORECASE
+)
+DASHED_EDITION = re.compile(
+    rf'\s+-\s+{OTHER_RECORDING}[^-]*\b(?:{EDITION_TAGS})\b[^-]*$',
+    re.IGNORECASE
+)
+NOT_ALPHANUMERIC = re.compile(r'[\W_]+')
+
+
+def normalize_title(title: str) -> str:
+    return title.lower().strip()
+
+
+@lru_cache(maxsize=65536)
+def canonical_title(title: str) -> str:
+    """Title reduced to what every cut of the same recording shares.
+
+    Featuring credits, edition tags such as "Clean", "Radio Edit" or
+    "2011 Remaster", accents, case and punctuation are dropped, so
+    "Song (feat. X) - Clean" and "Song - Remastered" both become "song".
+    """
+    title = FEATURING.sub('', title)
+    title = BRACKETED_EDITION.sub('', title)
+    title = DASHED_EDITION.sub('', title)
+    title = unicodedata.normalize('NFKD', title)
+    title = ''.join(char for char in title if not unicodedata.combining(char))
+    return NOT_ALPHANUMERIC.sub(' ', title.casefold()).strip() or normalize_title(title)
+
+
+def normalize_query(query: str) -> str:
+    """Key for coalescing searches that differ only in case or spacing"""
+    return ' '.join(query.lower().split())
+
+
+def artist_names(track: Dict) -> Tuple[str, ...]:
+    """Artist names of a Spotify track (dicts) or a YouTube track (plain names)"""
+    return tuple(
+        artist['name'] if isinstance(artist, dict) else artist
+        for artist in track.get('artists', [])
+    )
+
+
+def artist_key(track: Dict) -> FrozenSet[str]:
+    """Artist ids of a Spotify track, or lowercased names where an artist has no id"""
+    return frozenset(
+        (artist.get('id') or artist['name'].lower()) if isinstance(artist, dict) else artist.lower()
+        for artist in track.get('artists', [])
+    )
+
+
+class TitleIndex:
+    """Search results keyed by canonical title, each title normalized once.
+
+    `get` returns the candidates sharing a title's canonical form, optionally
+    only those by exactly `artists` (an `artist_key`), in result order.
+    """
+
+    def __init__(self, candidates: Sequence[Dict], title_field: str = 'name'):
+        self._by_title: Dict[str, List[Tuple[FrozenSet[str], Dict]]] = {}
+        for candidate in candidates:
+            self._by_title.setdefault(canonical_title(candidate[title_field]), []).append(
+                (artist_key(candidate), candidate)
+            )
+
+    def get(self, title: str, artists: Optional[FrozenSet[str]] = None) -> List[Dict]:
+        return [
+            candidate for key, candidate in self._by_title.get(canonical_title(title), [])
+            if artists is None or key == artists
+        ]
+
+
+def score_titles(title: str, candidates: Sequence[str],
+                 processor: Optional[Callable[[str], str]] = None) -> List[int]:
+    """Score one title against a whole batch of candidate titles in a single RapidFuzz call.
+
+    Scores are rounded to whole numbers and returned in candidate order, the same
+    values fuzzywuzzy's per-pair ratio produced.
+    """
+    scores = [0] * len(candidates)
+    if not candidates:
+        return scores
+
+    for _, score, index in process.extract(title, candidates, scorer=fuzz.ratio,
+                                           processor=processor, limit=None):
+        scores[index] = int(round(score))
+    return scores
+
+
+def match_spotify_track(track: Dict, search_results: List[Dict]) -> Dict:
+    """Pick the clean counterpart of an explicit Spotify track from its search results.
+
+    Only non-explicit results by the same artists are considered. A result with
+    the same canonical title is a match, preferring the exact title; any other
+    similar title becomes a potential match.
+    """
+    clean_results = [result for result in search_results if not result['explicit']]
+    matches = TitleIndex(clean_results).get(track['name'], artist_key(track))
+    if matches:
+        best = next((match for match in matches if match['name'] == track['name']), matches[0])
+        return {
+            'track': track,
+            'found_match': True,
+            'converted_uri': best['uri'],
+            'potential_matches': [],
+        }
+
+    artists = artist_names(track)
+    candidates = [result for result in clean_results if artist_names(result) == artists]
+    scores = score_titles(track['name'], [candidate['name'] for candidate in candidates])
+
+    potential_matches = [
+        {
+            'name': candidate['name'],
+            'artists': candidate['artists'][0]['name'],
+            'link': candidate['external_urls']['spotify'],
+            'uri': candidate['uri'],
+            'original_track_uri': track['uri'],
+            'original_track_link': track['link']
+        }
+        for candidate, score in zip(candidates, scores) if score > 1
+    ]
+
+    return {
+        'track': track,
+        'found_match': False,
+        'converted_uri': None,
+        'potential_matches': potential_matches,
+    }
+
+
+def match_youtube_track(track: Dict, search_results: List[Dict], threshold: int = 85) -> Optional[Dict]:
+    """Return the non-explicit YTMusic song with the same canonical title, preferring one
+    by the track's artist, else the best scoring above `threshold`, or None"""
+    candidates = [
+        result for result in search_results
+        if result['resultType'] == 'song' and not result.get('isExplicit', False)
+    ]
+
+    best_match = None
+    matches = TitleIndex(candidates, title_field='title').get(track['title'])
+    if matches:
+        # Uploads carry the channel name, e.g. "Artist - Topic", as their artist
+        channels = ' '.join(track.get('artists', [])).lower()
+        best_match = next(
+            (match for match in matches if any(name.lower() in channels for name in artist_names(match))),
+            matches[0]
+        )
+    else:
+        scores = score_titles(track['title'], [candidate['title'] for candidate in candidates],
+                              processor=normalize_title)
+        best_ratio = 0
+        for candidate, score in zip(candidates, scores):
+            if score > threshold and score > best_ratio:
+                best_ratio = score
+                best_match = candidate
+
+    if best_match is None:
+        return None
+
+    return {
+        'id': best_match['videoId'],
+        'title': best_match['title'],
+        'artists': [artist['name'] for artist in best_match.get('artists', [])],
+        'explicit': best_match.get('isExplicit', False),
+        'url': f"https://www.youtube.com/watch?v={best_match['videoId']}"
+    }
+
+
+def youtube_potential_matches(track: Dict, search_results: List[Dict], threshold: int = 85,
+                              minimum: int = 50, limit: int = 5) -> List[Dict]:
+    """Non-explicit YTMusic songs by the track's artist whose title scores from `minimum` up to
+    the match `threshold`, best first, to offer when match_youtube_track found nothing"""
+    channels = ' '.join(track.get('artists', [])).lower()
+    candidates = [
+        result for result in search_results
+        if result['resultType'] == 'song' and not result.get('isExplicit', False)
+        and any(name.lower() in channels for name in artist_names(result))
+    ]
+    scores = score_titles(track['title'], [candidate['title'] for candidate in candidates],
+                          processor=normalize_title)
+    ranked = sorted(
+        ((score, index) for index, score in enumerate(scores) if minimum <= score <= threshold),
+        key=lambda scored: -scored[0]
+    )
+
+    return [
+        {
+            'name': candidates[index]['title'],
+            'artists': ', '.join(artist['name'] for artist in candidates[index].get('artists', [])),
+            'link': f"https://www.youtube.com/watch?v={candidates[index]['videoId']}",
+            'id': candidates[index]['videoId'],
+            'original_track_id': track['id'],
+            'original_track_link': track['url']
+        }
+        for _, index in ranked[:limit]
+    ]
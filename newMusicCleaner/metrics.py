@@ -0,0 +1,252 @@
+"""In-process metrics exposed in the Prometheus text format on /metrics.
+
+Every outbound call goes through `track_upstream`: requests sessions (spotipy,
+YTMusic and the token refreshes) via InstrumentedAdapter, the Spotify search
+engine's httpx client via InstrumentedTransport and the YouTube Data API
+client via MeteredHttpRequest. Values live in this process only, so each
+worker process is scraped on its own.
+"""
+import bisect
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import urlparse
+
+import httpx
+import requests
+from django.http import HttpResponse
+from requests.adapters import HTTPAdapter
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+CANDIDATE_BUCKETS = (1, 5, 10, 20, 50, 100)
+
+_registry: List['Metric'] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return f"{{{pairs}}}"
+
+
+class Metric:
+    """Base metric; an unlabelled one can read its value from `function` at scrape time"""
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 function: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: Dict) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterator[Tuple[str, Sequence[str], Sequence[str], float]]:
+        """(suffix, label names, label values, value) for every series"""
+        if self.function is not None:
+            yield '', (), (), self.function()
+            return
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield '', self.labelnames, key, value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, names, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(names, values)} {value:g}")
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield '_bucket', self.labelnames + ('le',), key + (f"{bound:g}",), cumulative
+            yield '_bucket', self.labelnames + ('le',), key + ('+Inf',), count
+            yield '_sum', self.labelnames, key, total
+            yield '_count', self.labelnames, key, count
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+
+def metrics_view(request) -> HttpResponse:
+    return HttpResponse(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+UPSTREAM_LATENCY = Histogram(
+    'upstream_request_duration_seconds', 'Latency of outbound API calls', ['service', 'endpoint']
+)
+UPSTREAM_REQUESTS = Counter(
+    'upstream_requests_total', 'Outbound API calls by response status', ['service', 'endpoint', 'status']
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    'upstream_requests_in_flight', 'Outbound API calls waiting for a response', ['service']
+)
+UPSTREAM_RETRIES = Counter(
+    'upstream_retries_total', 'Outbound API calls sent again after a failure or 429', ['service', 'endpoint']
+)
+CACHE_LOOKUPS = Counter(
+    'cache_lookups_total', 'Cache lookups by result', ['cache', 'result']
+)
+UPSTREAM_RESPONSE_BYTES = Histogram(
+    'upstream_response_bytes', 'Body size of outbound API responses', ['service', 'endpoint'],
+    buckets=BYTE_BUCKETS
+)
+SEARCH_CANDIDATES = Histogram(
+    'search_candidates', 'Search results fetched for one track before its match was decided', ['service'],
+    buckets=CANDIDATE_BUCKETS
+)
+
+# Path segments following these are ids, which would make one series per playlist or user
+ID_COLLECTIONS = {'playlists', 'users', 'tracks', 'albums', 'artists', 'shows', 'episodes'}
+HEX_OR_NUMBER = re.compile(r'^[0-9a-f-]{8,}$|^\d+$')
+
+
+def endpoint_label(url: str) -> str:
+    """URL path with ids replaced, e.g. /v1/playlists/{id}/tracks"""
+    parts = urlparse(url).path.split('/')
+    for i in range(1, len(parts)):
+        if parts[i] and (parts[i - 1] in ID_COLLECTIONS or HEX_OR_NUMBER.match(parts[i])):
+            parts[i] = '{id}'
+    return '/'.join(parts) or '/'
+
+
+class UpstreamCall:
+    status = 'error'
+
+
+@contextmanager
+def track_upstream(service: str, endpoint: str) -> Iterator[UpstreamCall]:
+    """Time one outbound call; set `status` on the yielded object, exceptions count as 'error'"""
+    call = UpstreamCall()
+    UPSTREAM_IN_FLIGHT.inc(service=service)
+    started = time.perf_counter()
+    try:
+        yield call
+    finally:
+        UPSTREAM_IN_FLIGHT.dec(service=service)
+        UPSTREAM_LATENCY.observe(time.perf_counter() - started, service=service, endpoint=endpoint)
+        UPSTREAM_REQUESTS.inc(service=service, endpoint=endpoint, status=call.status)
+
+
+def record_cache_lookups(cache: str, hits: int, misses: int) -> None:
+    if hits:
+        CACHE_LOOKUPS.inc(hits, cache=cache, result='hit')
+    if misses:
+        CACHE_LOOKUPS.inc(misses, cache=cache, result='miss')
+
+
+class InstrumentedAdapter(HTTPAdapter):
+    """HTTPAdapter recording every request of a requests session.
+
+    Retries done by urllib3 (`max_retries`) show up in upstream_retries_total;
+    the latency covers the request including those retries. Unless the
+    response is streamed its body is read here, to record its size.
+    """
+
+    def __init__(self, service: str, **kwargs):
+        self.service = service
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        endpoint = endpoint_label(request.url)
+        with track_upstream(self.service, endpoint) as call:
+            response = super().send(request, **kwargs)
+            call.status = str(response.status_code)
+            if not kwargs.get('stream'):
+                UPSTREAM_RESPONSE_BYTES.observe(len(response.content), service=self.service, endpoint=endpoint)
+
+        retries = getattr(response.raw, 'retries', None)
+        if retries is not None and retries.history:
+            UPSTREAM_RETRIES.inc(len(retries.history), service=self.service, endpoint=endpoint)
+        return response
+
+
+def instrument_session(session: requests.Session, service: str) -> requests.Session:
+    """Swap the session's adapters for instrumented ones, keeping their retry settings"""
+    for prefix in ('https://', 'http://'):
+        max_retries = session.get_adapter(prefix).max_retries
+        session.mount(prefix, InstrumentedAdapter(service, max_retries=max_retries))
+    return session
+
+
+def instrumented_session(service: str) -> requests.Session:
+    return instrument_session(requests.Session(), service)
+
+
+class InstrumentedTransport(httpx.AsyncHTTPTransport):
+    """httpx transport recording every request of an AsyncClient"""
+
+    def __init__(self, service: str, **kwargs):
+        self.service = service
+        super().__init__(**kwargs)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        with track_upstream(self.service, endpoint_label(str(request.url))) as call:
+            response = await super().handle_async_request(request)
+            call.status = str(response.status_code)
+        return response
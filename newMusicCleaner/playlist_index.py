@@ -0,0 +1,128 @@
+"""Per-user playlist indexes kept in the Django cache and served a page at a time.
+
+The whole playlist list of a user is loaded once, stored in CACHES and paged
+through with opaque cursors, so scrolling never goes back to Spotify or
+YouTube. A cursor names the last playlist of the page before, so paging
+resumes after it even if a refresh shifted the list meanwhile. An index older than PLAYLIST_INDEX_REFRESH_AFTER is still served
+while a background refresh replaces it.
+"""
+import base64
+import binascii
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import orjson
+from django.core.cache import cache
+from django.db import close_old_connections
+
+from newMusicCleaner.settings import PLAYLIST_INDEX_REFRESH_AFTER, PLAYLIST_INDEX_TTL, PLAYLIST_PAGE_SIZE
+from newMusicCleaner.singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+refresh_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='playlist-index')
+
+# Loads of the same index, first or background, share one upstream walk
+_loads = SingleFlight()
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+class InvalidCursor(ValueError):
+    """Raised for a cursor that wasn't produced by `encode_cursor`, or whose playlist is gone"""
+
+
+def encode_cursor(after: str, offset: int) -> str:
+    """Cursor of the page following playlist `after`, found at `offset` - 1 when it was issued"""
+    return base64.urlsafe_b64encode(orjson.dumps({'after': after, 'offset': offset})).rstrip(b'=').decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    try:
+        data = orjson.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        after, offset = data['after'], data['offset']
+    except (binascii.Error, orjson.JSONDecodeError, TypeError, KeyError, ValueError):
+        raise InvalidCursor(f"Invalid cursor: {cursor}")
+    if not isinstance(after, str) or not isinstance(offset, int) or offset < 1:
+        raise InvalidCursor(f"Invalid cursor: {cursor}")
+    return after, offset
+
+
+class PlaylistIndex:
+    """All playlists of one session on one platform, as returned by `loader`"""
+
+    def __init__(self, platform: str, session_id: str, loader: Callable[[], List[Dict]],
+                 ttl: int = PLAYLIST_INDEX_TTL, refresh_after: int = PLAYLIST_INDEX_REFRESH_AFTER):
+        self.key = f"playlist-index:{platform}:{session_id}"
+        self.loader = loader
+        self.ttl = ttl
+        self.refresh_after = refresh_after
+
+    def _load(self) -> Dict:
+        entry = {'playlists': self.loader(), 'fetched_at': time.time()}
+        try:
+            cache.set(self.key, entry, self.ttl)
+        except Exception as e:
+            logger.warning(f"Failed to store playlist index {self.key}: {e}")
+        return entry
+
+    def _cached(self) -> Optional[Dict]:
+        try:
+            return cache.get(self.key)
+        except Exception as e:
+            logger.warning(f"Failed to read playlist index {self.key}: {e}")
+            return None
+
+    def _refresh(self) -> None:
+        try:
+            close_old_connections()
+            _loads.do(self.key, self._load)
+        except Exception as e:
+            logger.error(f"Failed to refresh playlist index {self.key}: {e}")
+        finally:
+            close_old_connections()
+            with _refreshing_lock:
+                _refreshing.discard(self.key)
+
+    def refresh_in_background(self) -> None:
+        with _refreshing_lock:
+            if self.key in _refreshing:
+                return
+            _refreshing.add(self.key)
+        refresh_executor.submit(self._refresh)
+
+    def get(self) -> List[Dict]:
+        entry = self._cached()
+        if entry is None:
+            entry = _loads.do(self.key, self._load)
+        elif time.time() - entry['fetched_at'] > self.refresh_after:
+            self.refresh_in_background()
+        return entry['playlists']
+
+    def page(self, cursor: Optional[str] = None, limit: int = PLAYLIST_PAGE_SIZE) -> Tuple[List[Dict], Optional[str]]:
+        """Up to `limit` playlists from `cursor` on, and the cursor of the page after, if any.
+
+        Raises InvalidCursor when the cursor's playlist has left the index,
+        e.g. it was deleted, as there is no telling where to resume.
+        """
+        playlists = self.get()
+        offset = 0
+        if cursor:
+            after, offset = decode_cursor(cursor)
+            if offset > len(playlists) or playlists[offset - 1]['id'] != after:
+                # The list changed since the cursor was issued, find its playlist again
+                offset = next((i + 1 for i, playlist in enumerate(playlists) if playlist['id'] == after), None)
+                if offset is None:
+                    raise InvalidCursor("The playlist list changed, start again from the first page")
+        end = offset + limit
+        page = playlists[offset:end]
+        return page, encode_cursor(page[-1]['id'], end) if end < len(playlists) else None
+
+    def invalidate(self) -> None:
+        try:
+            cache.delete(self.key)
+        except Exception as e:
+            logger.warning(f"Failed to drop playlist index {self.key}: {e}")
@@ -0,0 +1,257 @@
+"""Opt-in profiling of single conversion requests.
+
+A request to one of PROFILED_PATHS carrying PROFILING_TOKEN in the
+X-Profile-Token header or the `profile` query parameter is run under a
+sampling profiler, and the `stage` blocks it passes through are timed. The
+result is stored as a RequestProfile, downloadable from the admin, and its id
+is returned in the X-Profile-Id header.
+
+Only the threads working for the profiled request are sampled: the request
+thread, and pool threads while they run a `bind`-wrapped call or a `stage`
+of that request. On the async side the request thread is the event loop,
+shared with the other requests in flight, so its samples may include theirs.
+
+Without the token nothing is sampled: `stage` returns a shared no-op and the
+middleware only compares the path.
+"""
+import contextvars
+import hmac
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, Optional
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from newMusicCleaner.settings import PROFILING_TOKEN, PROFILING_INTERVAL
+
+PROFILED_PATHS = [
+    re.compile(r'^/api/(?:async/)?playlist/[^/]+/convert/?$'),
+    re.compile(r'^/api/(?:async/)?youtube/playlist/[^/]+/convert/?$'),
+    re.compile(r'^/spotify/playlist/[^/]+/convert/?$'),
+]
+
+_current_profile: contextvars.ContextVar[Optional['Profile']] = contextvars.ContextVar('profile', default=None)
+
+
+class Sampler(threading.Thread):
+    """Samples the stacks of the threads working for `profile` each `interval` seconds.
+
+    Stacks are kept in folded form ("thread;outer (file:line);...;inner") with
+    a count, ready for flamegraph tools.
+    """
+
+    def __init__(self, profile: 'Profile', interval: float = PROFILING_INTERVAL, max_depth: int = 100):
+        super().__init__(name='profiler', daemon=True)
+        self.profile = profile
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self.samples = 0
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            threads = self.profile.threads()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident not in threads:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.join()
+
+    def folded(self) -> str:
+        return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+
+class Profile:
+    """Stage timings of one profiled request.
+
+    Stages entered many times, e.g. matching once per track on several
+    threads, are summed: `count`, `total` and `max` seconds, plus the wall
+    span from the first start to the last end.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: Dict[str, Dict] = {}
+        self._threads = Counter()
+        self._lock = threading.Lock()
+
+    def enter_thread(self) -> None:
+        """Mark the calling thread as working for this request until the matching `exit_thread`"""
+        with self._lock:
+            self._threads[threading.get_ident()] += 1
+
+    def exit_thread(self) -> None:
+        ident = threading.get_ident()
+        with self._lock:
+            self._threads[ident] -= 1
+            if self._threads[ident] <= 0:
+                del self._threads[ident]
+
+    def threads(self) -> set:
+        with self._lock:
+            return set(self._threads)
+
+    def record(self, name: str, start: float, end: float) -> None:
+        duration = end - start
+        with self._lock:
+            entry = self.stages.get(name)
+            if entry is None:
+                entry = self.stages[name] = {
+                    'count': 0, 'total': 0.0, 'max': 0.0,
+                    'first_start': start - self.started, 'last_end': 0.0
+                }
+            entry['count'] += 1
+            entry['total'] += duration
+            entry['max'] = max(entry['max'], duration)
+            entry['last_end'] = max(entry['last_end'], end - self.started)
+
+
+class _Stage:
+    def __init__(self, profile: Profile, name: str):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.profile.enter_thread()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.record(self.name, self.start, time.perf_counter())
+        self.profile.exit_thread()
+        return False
+
+
+class _NoStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+def stage(name: str):
+    """Time a block as `name` when the current request is being profiled"""
+    profile = _current_profile.get()
+    if profile is None:
+        return _NO_STAGE
+    return _Stage(profile, name)
+
+
+def bind(fn: Callable) -> Callable:
+    """Carry the current profile into `fn` when it runs on a pool thread"""
+    if _current_profile.get() is None:
+        return fn
+    return _bound(contextvars.copy_context(), fn)
+
+
+def _bound(context: contextvars.Context, fn: Callable) -> Callable:
+    def run(*args, **kwargs):
+        # A Context can only be entered by one thread at a time, so each call gets its own copy
+        return context.copy().run(_sampled, fn, *args, **kwargs)
+    return run
+
+
+def _sampled(fn: Callable, *args, **kwargs):
+    profile = _current_profile.get()
+    profile.enter_thread()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        profile.exit_thread()
+
+
+def wants_profile(request) -> bool:
+    if not PROFILING_TOKEN or not any(pattern.match(request.path) for pattern in PROFILED_PATHS):
+        return False
+    token = request.headers.get('X-Profile-Token') or request.GET.get('profile') or ''
+    return hmac.compare_digest(token.encode(), PROFILING_TOKEN.encode())
+
+
+def _stored_profile(request, response, profile: Profile, sampler: Sampler):
+    from spotify_app.models import RequestProfile
+
+    return RequestProfile(
+        method=request.method,
+        # Not the full path, the query string may hold the token
+        path=request.path[:500],
+        status_code=response.status_code,
+        duration=time.perf_counter() - profile.started,
+        stages=profile.stages,
+        samples=sampler.folded(),
+        sample_count=sampler.samples,
+        interval=sampler.interval
+    )
+
+
+class ProfilingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not wants_profile(request):
+            return self.get_response(request)
+
+        profile = Profile()
+        sampler = Sampler(profile)
+        token = _current_profile.set(profile)
+        profile.enter_thread()
+        sampler.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            sampler.stop()
+            profile.exit_thread()
+            _current_profile.reset(token)
+
+        stored = _stored_profile(request, response, profile, sampler)
+        stored.save()
+        response['X-Profile-Id'] = str(stored.profile_id)
+        return response
+
+    async def __acall__(self, request):
+        if not wants_profile(request):
+            return await self.get_response(request)
+
+        profile = Profile()
+        sampler = Sampler(profile)
+        token = _current_profile.set(profile)
+        profile.enter_thread()
+        sampler.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            sampler.stop()
+            profile.exit_thread()
+            _current_profile.reset(token)
+
+        stored = _stored_profile(request, response, profile, sampler)
+        await stored.asave()
+        response['X-Profile-Id'] = str(stored.profile_id)
+        return response
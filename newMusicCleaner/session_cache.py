@@ -0,0 +1,75 @@
+"""Per-session memoization of upstream metadata in the Django cache.
+
+The services are built anew for every request, so their own attributes
+(e.g. `_user`) only last one request. Values kept here are shared by every
+request, worker and process of a session until their TTL runs out or they
+are invalidated, e.g. when the session logs in again or creates a playlist.
+"""
+import logging
+from typing import Any, Awaitable, Callable, Optional
+
+from django.core.cache import cache
+
+from newMusicCleaner.metrics import record_cache_lookups
+from newMusicCleaner.settings import SESSION_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+
+class SessionCache:
+    """Values of one session on one platform, e.g. the user profile. None is never cached."""
+
+    def __init__(self, platform: str, session_id: str, ttl: int = SESSION_CACHE_TTL):
+        self.platform = platform
+        self.session_id = session_id
+        self.ttl = ttl
+
+    def _key(self, name: str) -> str:
+        return f"session:{self.platform}:{self.session_id}:{name}"
+
+    def _read(self, name: str) -> Optional[Any]:
+        try:
+            value = cache.get(self._key(name))
+        except Exception as e:
+            logger.warning(f"Failed to read {self._key(name)}: {e}")
+            value = None
+        record_cache_lookups(f"session_{self.platform}", int(value is not None), int(value is None))
+        return value
+
+    def _store(self, name: str, value: Any, ttl: Optional[int]) -> None:
+        try:
+            cache.set(self._key(name), value, ttl or self.ttl)
+        except Exception as e:
+            logger.warning(f"Failed to store {self._key(name)}: {e}")
+
+    def get(self, name: str, load: Callable[[], Any], ttl: int = None) -> Any:
+        """The cached value of `name`, or `load()` stored for next time"""
+        value = self._read(name)
+        if value is None:
+            value = load()
+            if value is not None:
+                self._store(name, value, ttl)
+        return value
+
+    async def aget(self, name: str, load: Callable[[], Awaitable[Any]], ttl: int = None) -> Any:
+        """`get` for the async services, `load` being a coroutine function"""
+        try:
+            value = await cache.aget(self._key(name))
+        except Exception as e:
+            logger.warning(f"Failed to read {self._key(name)}: {e}")
+            value = None
+        record_cache_lookups(f"session_{self.platform}", int(value is not None), int(value is None))
+        if value is None:
+            value = await load()
+            if value is not None:
+                try:
+                    await cache.aset(self._key(name), value, ttl or self.ttl)
+                except Exception as e:
+                    logger.warning(f"Failed to store {self._key(name)}: {e}")
+        return value
+
+    def invalidate(self, *names: str) -> None:
+        try:
+            cache.delete_many([self._key(name) for name in names])
+        except Exception as e:
+            logger.warning(f"Failed to drop {names} of session {self.session_id}: {e}")
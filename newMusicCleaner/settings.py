@@ -56,7 +56,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'corsheaders.middleware.CorsMiddleware'
+    'corsheaders.middleware.CorsMiddleware',
+    'newMusicCleaner.profiling.ProfilingMiddleware'
 ]
 
 ROOT_URLCONF = 'newMusicCleaner.urls'
@@ -151,3 +152,89 @@ CACHES = {
         'LOCATION': '127.0.0.1:11211',
     }
 }
+
+# Explicit -> clean match cache shared by every Spotify conversion
+SPOTIFY_MATCH_CACHE_SIZE = 20000
+SPOTIFY_MATCH_CACHE_TTL = 60 * 60 * 24 * 30
+SPOTIFY_MATCH_CACHE_MISS_TTL = 60 * 60 * 24 * 3
+
+# Async Spotify search engine: requests per second, burst size and in-flight limit
+SPOTIFY_SEARCH_RATE = 20.0
+SPOTIFY_SEARCH_BURST = 40
+SPOTIFY_SEARCH_CONCURRENCY = 100
+SPOTIFY_SEARCH_MAX_RETRIES = 4
+# Adaptive limit on Spotify calls in flight, see newMusicCleaner/concurrency.py;
+# it starts at SPOTIFY_CONCURRENCY_INITIAL and never exceeds SPOTIFY_SEARCH_CONCURRENCY
+SPOTIFY_CONCURRENCY_INITIAL = 10
+SPOTIFY_LATENCY_TARGET = 2.0
+CONCURRENCY_BACKOFF = 0.5
+# Results fetched per Spotify search step; a step runs only if the ones before found no match
+SPOTIFY_SEARCH_DEPTHS = (10, 50)
+# Shared pool reading the pages after the first of Spotify playlists, for every request
+SPOTIFY_PAGE_WORKERS = 16
+
+# httpx clients of the async services under /api/async/, per service and event loop
+ASYNC_HTTP_TIMEOUT = 10.0
+ASYNC_HTTP_MAX_CONNECTIONS = 100
+ASYNC_HTTP_MAX_RETRIES = 3
+
+# Per-user playlist lists kept in CACHES, see newMusicCleaner/playlist_index.py
+PLAYLIST_PAGE_SIZE = 50
+PLAYLIST_INDEX_TTL = 60 * 60 * 24
+PLAYLIST_INDEX_REFRESH_AFTER = 60 * 5
+
+# Per-session user profiles and playlist metadata kept in CACHES, see newMusicCleaner/session_cache.py
+SESSION_CACHE_TTL = 60 * 60
+SESSION_PLAYLIST_CACHE_TTL = 60 * 5
+
+# OAuth token refreshes, see newMusicCleaner/token_lease.py: how long before expiry
+# a token is refreshed, how long a refreshing node holds the lease, how often
+# a node waiting for an expired token looks for the new one and how often the
+# tokens of live sessions are swept for ones due (keep it below TOKEN_REFRESH_AHEAD)
+TOKEN_REFRESH_AHEAD = 60 * 5
+TOKEN_REFRESH_LEASE = 30
+TOKEN_REFRESH_POLL = 0.2
+TOKEN_REFRESH_SWEEP_INTERVAL = 60
+
+# Background playlist conversion jobs
+CONVERSION_JOB_WORKERS = 4
+CONVERSION_JOB_MAX_PENDING = 100
+# How often the dispatcher looks for due jobs, and how long a running job may go
+# without a heartbeat before it counts as left behind by a stopped process
+CONVERSION_JOB_POLL_INTERVAL = 2.0
+CONVERSION_JOB_STALE_AFTER = 60
+
+# Shared pool for YTMusic metadata lookups while reading YouTube playlists
+YOUTUBE_METADATA_WORKERS = 20
+YOUTUBE_METADATA_MAX_IN_FLIGHT = 100
+
+# videoId -> YTMusic metadata cache; misses are the videos that fall back to basic metadata
+YOUTUBE_METADATA_CACHE_SIZE = 50000
+YOUTUBE_METADATA_CACHE_TTL = 60 * 60 * 24 * 30
+YOUTUBE_METADATA_CACHE_MISS_TTL = 60 * 60 * 24 * 7
+
+# Batched playlistItems().insert calls during YouTube conversions
+YOUTUBE_INSERT_BATCH_SIZE = 50
+YOUTUBE_INSERT_MAX_RETRIES = 3
+
+# Shared pool for clean-version searches during YouTube conversions
+YOUTUBE_SEARCH_WORKERS = 20
+# YTMusic results scored before the rest of the page, and the page size asked for
+YTMUSIC_SEARCH_DEPTHS = (5, 10)
+# Adaptive limit on YTMusic searches in flight from both pools above
+YTMUSIC_CONCURRENCY_INITIAL = 10
+YTMUSIC_CONCURRENCY_MAX = YOUTUBE_SEARCH_WORKERS + YOUTUBE_METADATA_WORKERS
+YTMUSIC_LATENCY_TARGET = 3.0
+
+# ETag-validated YouTube Data API responses kept per session in CACHES
+YOUTUBE_HTTP_CACHE_TTL = 60 * 60 * 24 * 7
+
+# YouTube Data API quota budget, in units per quota day (resets at midnight Pacific time)
+YOUTUBE_DAILY_QUOTA = 10000
+YOUTUBE_QUOTA_RESERVE = 1000
+YOUTUBE_USER_DAILY_QUOTA = 5000
+YOUTUBE_SECONDS_PER_TRACK = 0.2
+
+# Opt-in request profiling, see newMusicCleaner/profiling.py; empty disables it
+PROFILING_TOKEN = env('PROFILING_TOKEN', default='')
+PROFILING_INTERVAL = 0.005
@@ -0,0 +1,466 @@
+import asyncio
+import threading
+import time
+from contextlib import ExitStack
+from datetime import timedelta
+from unittest import mock
+
+import httpx
+
+from django.core.cache import cache
+from django.test import SimpleTestCase
+from django.utils import timezone
+
+from newMusicCleaner.async_http import send_with_retries
+from newMusicCleaner.client_cache import ClientCache
+from newMusicCleaner.concurrency import AIMDLimiter
+from newMusicCleaner.matching import (
+    TitleIndex,
+    canonical_title,
+    match_spotify_track,
+    match_youtube_track,
+    normalize_title,
+    score_titles
+)
+from newMusicCleaner.playlist_index import InvalidCursor, PlaylistIndex, encode_cursor
+from newMusicCleaner.singleflight import SingleFlight
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting")
+        time.sleep(0.01)
+
+
+class SingleFlightTests(SimpleTestCase):
+    def run_concurrently(self, flight, fn, callers=4):
+        results, errors = [], []
+
+        def call():
+            try:
+                results.append(flight.do('key', fn))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(callers)]
+        for thread in threads:
+            thread.start()
+        return threads, results, errors
+
+    def test_concurrent_callers_share_one_execution(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def fn():
+            calls.append(1)
+            release.wait()
+            return 'result'
+
+        threads, results, errors = self.run_concurrently(flight, fn)
+        wait_until(lambda: flight.coalesced == 3)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['result'] * 4)
+        self.assertEqual(errors, [])
+
+    def test_followers_get_the_leaders_exception(self):
+        flight = SingleFlight()
+        release = threading.Event()
+
+        def fn():
+            release.wait()
+            raise ValueError('upstream failed')
+
+        threads, results, errors = self.run_concurrently(flight, fn)
+        wait_until(lambda: flight.coalesced == 3)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [])
+        self.assertEqual([str(e) for e in errors], ['upstream failed'] * 4)
+
+    def test_calls_after_completion_run_again(self):
+        flight = SingleFlight()
+        calls = []
+
+        for _ in range(2):
+            flight.do('key', lambda: calls.append(1))
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(flight.coalesced, 0)
+
+
+class PlaylistIndexTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.playlists = [{'id': f"playlist-{n}"} for n in range(5)]
+        self.index = PlaylistIndex('spotify', 'session', lambda: list(self.playlists))
+
+    def ids(self, page):
+        return [playlist['id'] for playlist in page]
+
+    def test_pages_through_every_playlist(self):
+        page, cursor = self.index.page(limit=2)
+        self.assertEqual(self.ids(page), ['playlist-0', 'playlist-1'])
+
+        page, cursor = self.index.page(cursor, limit=2)
+        self.assertEqual(self.ids(page), ['playlist-2', 'playlist-3'])
+
+        page, cursor = self.index.page(cursor, limit=2)
+        self.assertEqual(self.ids(page), ['playlist-4'])
+        self.assertIsNone(cursor)
+
+    def test_last_full_page_has_no_cursor(self):
+        page, cursor = self.index.page(limit=5)
+
+        self.assertEqual(len(page), 5)
+        self.assertIsNone(cursor)
+
+    def test_resumes_after_the_cursors_playlist_when_the_list_shifts(self):
+        _, cursor = self.index.page(limit=2)
+        self.playlists.insert(0, {'id': 'playlist-new'})
+        self.index.invalidate()
+
+        page, _ = self.index.page(cursor, limit=2)
+
+        self.assertEqual(self.ids(page), ['playlist-2', 'playlist-3'])
+
+    def test_cursor_of_a_deleted_playlist_is_rejected(self):
+        _, cursor = self.index.page(limit=2)
+        del self.playlists[1]
+        self.index.invalidate()
+
+        with self.assertRaises(InvalidCursor):
+            self.index.page(cursor, limit=2)
+
+    def test_malformed_cursors_are_rejected(self):
+        for cursor in ('not-a-cursor', encode_cursor('playlist-1', 0)):
+            with self.assertRaises(InvalidCursor):
+                self.index.page(cursor)
+
+    def test_pages_are_served_from_the_cache(self):
+        loads = []
+        index = PlaylistIndex('spotify', 'session', lambda: loads.append(1) or list(self.playlists))
+
+        _, cursor = index.page(limit=2)
+        index.page(cursor, limit=2)
+
+        self.assertEqual(len(loads), 1)
+
+
+class AIMDLimiterTests(SimpleTestCase):
+    def limiter(self, initial=2, minimum=1, maximum=8, latency_target=10.0):
+        return AIMDLimiter('test', initial, minimum, maximum, latency_target)
+
+    def test_limit_grows_by_one_per_round_of_successful_calls(self):
+        limiter = self.limiter(initial=2)
+
+        for _ in range(4):
+            with limiter.slot():
+                pass
+
+        self.assertEqual(limiter.limit, 3)
+
+    def test_limit_stays_within_maximum(self):
+        limiter = self.limiter(initial=2, maximum=4)
+
+        for _ in range(50):
+            with limiter.slot():
+                pass
+
+        self.assertEqual(limiter.limit, 4)
+
+    def test_rate_limited_call_halves_the_limit(self):
+        limiter = self.limiter(initial=8)
+
+        with limiter.slot() as call:
+            call.rate_limited = True
+
+        self.assertEqual(limiter.limit, 4)
+
+    def test_slow_call_halves_the_limit(self):
+        limiter = self.limiter(initial=8, latency_target=0.01)
+
+        with limiter.slot():
+            time.sleep(0.05)
+
+        self.assertEqual(limiter.limit, 4)
+
+    def test_burst_of_429s_from_one_round_cuts_once(self):
+        limiter = self.limiter(initial=8)
+
+        with ExitStack() as stack:
+            calls = [stack.enter_context(limiter.slot()) for _ in range(4)]
+            for call in calls:
+                call.rate_limited = True
+
+        self.assertEqual(limiter.limit, 4)
+
+        with limiter.slot() as call:
+            call.rate_limited = True
+
+        self.assertEqual(limiter.limit, 2)
+
+    def test_limit_stays_within_minimum(self):
+        limiter = self.limiter(initial=2, minimum=1)
+
+        for _ in range(3):
+            with limiter.slot() as call:
+                call.rate_limited = True
+
+        self.assertEqual(limiter.limit, 1)
+
+    def test_failed_calls_dont_grow_the_limit(self):
+        limiter = self.limiter(initial=2)
+
+        for _ in range(4):
+            with self.assertRaises(ValueError):
+                with limiter.slot():
+                    raise ValueError('bad request')
+
+        self.assertEqual(limiter.limit, 2)
+
+    def test_callers_wait_for_a_free_slot(self):
+        limiter = self.limiter(initial=1)
+        acquired = threading.Event()
+
+        def call():
+            with limiter.slot():
+                acquired.set()
+
+        with limiter.slot():
+            thread = threading.Thread(target=call)
+            thread.start()
+            self.assertFalse(acquired.wait(0.1))
+
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+
+
+class ClientCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = ClientCache(expiry_margin=60)
+        self.loads = []
+
+    def loader(self, expires_in=3600):
+        def load():
+            self.loads.append(1)
+            return f"client-{len(self.loads)}", timezone.now() + timedelta(seconds=expires_in)
+        return load
+
+    def test_client_is_reused_while_its_token_is_fresh(self):
+        first = self.cache.get('session', self.loader())
+        second = self.cache.get('session', self.loader())
+
+        self.assertEqual((first, second), ('client-1', 'client-1'))
+        self.assertEqual(len(self.loads), 1)
+
+    def test_client_is_rebuilt_once_its_token_is_due_for_a_refresh(self):
+        self.cache.get('session', self.loader(expires_in=30))
+
+        self.assertEqual(self.cache.get('session', self.loader()), 'client-2')
+
+    def test_sessions_without_tokens_are_not_cached(self):
+        self.assertIsNone(self.cache.get('session', lambda: None))
+
+        self.assertEqual(self.cache.get('session', self.loader()), 'client-1')
+
+    def test_invalidate_drops_the_client(self):
+        self.cache.get('session', self.loader())
+        self.cache.invalidate('session')
+
+        self.assertEqual(self.cache.get('session', self.loader()), 'client-2')
+
+    def test_concurrent_callers_share_one_refresh(self):
+        release = threading.Event()
+        results = []
+        load = self.loader()
+
+        def slow_load():
+            release.wait()
+            return load()
+
+        threads = [
+            threading.Thread(target=lambda: results.append(self.cache.get('session', slow_load))) for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        wait_until(lambda: self.cache._flight.coalesced == 3)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, ['client-1'] * 4)
+        self.assertEqual(len(self.loads), 1)
+
+
+class ScoreTitlesTests(SimpleTestCase):
+    def test_scores_come_back_in_candidate_order(self):
+        scores = score_titles('Hello', ['Goodbye', 'Hello', 'Hallo'])
+
+        self.assertEqual(scores, [17, 100, 80])
+
+    def test_scores_are_fuzzywuzzy_ratios(self):
+        # fuzzywuzzy.fuzz.ratio('kitten', 'sitting') == 62
+        self.assertEqual(score_titles('kitten', ['sitting']), [62])
+
+    def test_processor_is_applied_to_both_sides(self):
+        self.assertEqual(score_titles(' HELLO ', ['hello'], processor=normalize_title), [100])
+        self.assertLess(score_titles(' HELLO ', ['hello'])[0], 100)
+
+    def test_no_candidates(self):
+        self.assertEqual(score_titles('Hello', []), [])
+
+
+class CanonicalTitleTests(SimpleTestCase):
+    def test_cuts_of_the_same_recording_share_a_title(self):
+        for title in (
+            'Song',
+            'Song (feat. Someone)',
+            'Song ft. Someone',
+            'Song [Clean]',
+            'Song - Radio Edit',
+            'Song - 2011 Remaster',
+            'Song (Remastered 2011) [feat. Someone]',
+            'SONG!',
+        ):
+            with self.subTest(title=title):
+                self.assertEqual(canonical_title(title), 'song')
+
+    def test_other_recordings_keep_their_tag(self):
+        for title in ('Song (Live)', 'Song - Acoustic Version', 'Song (Remix) [Clean]'):
+            with self.subTest(title=title):
+                self.assertNotEqual(canonical_title(title), 'song')
+
+    def test_accents_are_dropped(self):
+        self.assertEqual(canonical_title('Café'), 'cafe')
+
+    def test_titles_of_only_punctuation_are_kept(self):
+        self.assertEqual(canonical_title(' ?! '), '?!')
+
+
+class MatchingTests(SimpleTestCase):
+    def spotify_track(self, name, explicit=False, artist='artist', uri=None):
+        return {
+            'name': name,
+            'explicit': explicit,
+            'artists': [{'id': artist, 'name': artist.title()}],
+            'uri': uri or f"spotify:track:{name}",
+            'link': f"https://open.spotify.com/track/{name}",
+            'external_urls': {'spotify': f"https://open.spotify.com/track/{name}"},
+        }
+
+    def test_title_index_filters_by_artist(self):
+        results = [self.spotify_track('Song', artist='artist'), self.spotify_track('Song - Clean', artist='other')]
+        index = TitleIndex(results)
+
+        self.assertEqual(len(index.get('Song (feat. X)')), 2)
+        self.assertEqual(index.get('Song', frozenset({'other'})), [results[1]])
+
+    def test_spotify_match_prefers_the_exact_title(self):
+        track = self.spotify_track('Song', explicit=True, uri='spotify:track:explicit')
+        results = [
+            track,
+            self.spotify_track('Song - Clean', uri='spotify:track:tagged'),
+            self.spotify_track('Song', uri='spotify:track:exact'),
+            self.spotify_track('Song', artist='other', uri='spotify:track:other'),
+        ]
+
+        match = match_spotify_track(track, results)
+
+        self.assertTrue(match['found_match'])
+        self.assertEqual(match['converted_uri'], 'spotify:track:exact')
+
+    def test_spotify_similar_titles_are_potential_matches(self):
+        track = self.spotify_track('Song', explicit=True)
+
+        match = match_spotify_track(track, [self.spotify_track('Song (Live)')])
+
+        self.assertFalse(match['found_match'])
+        self.assertEqual([potential['name'] for potential in match['potential_matches']], ['Song (Live)'])
+
+    def test_youtube_match_prefers_the_tracks_artist(self):
+        track = {'title': 'Song', 'artists': ['Artist - Topic']}
+        results = [
+            {'resultType': 'song', 'videoId': 'cover', 'title': 'Song', 'artists': [{'name': 'Cover Band'}]},
+            {'resultType': 'song', 'videoId': 'explicit', 'title': 'Song', 'artists': [{'name': 'Artist'}],
+             'isExplicit': True},
+            {'resultType': 'song', 'videoId': 'clean', 'title': 'Song [Clean]', 'artists': [{'name': 'Artist'}]},
+        ]
+
+        match = match_youtube_track(track, results)
+
+        self.assertEqual(match['id'], 'clean')
+
+
+class SendWithRetriesTests(SimpleTestCase):
+    def setUp(self):
+        self.responses = []
+        self.requests = []
+        client = httpx.AsyncClient(transport=httpx.MockTransport(self.handle))
+        patcher = mock.patch('newMusicCleaner.async_http.async_client', return_value=client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def handle(self, request):
+        self.requests.append(request)
+        return self.responses.pop(0) if self.responses else httpx.Response(200)
+
+    def send(self, **kwargs):
+        return send_with_retries('test', 'GET', 'https://api.example.com/items', **kwargs)
+
+    async def test_rate_limited_request_waits_for_retry_after(self):
+        self.responses = [httpx.Response(429, headers={'Retry-After': '0.2'})]
+        started = time.monotonic()
+
+        response = await self.send()
+
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.requests), 2)
+
+    @mock.patch('newMusicCleaner.async_http.asyncio.sleep')
+    async def test_server_errors_are_retried_with_backoff(self, sleep):
+        self.responses = [httpx.Response(503), httpx.Response(502)]
+
+        response = await self.send()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [1, 2])
+
+    @mock.patch('newMusicCleaner.async_http.asyncio.sleep')
+    async def test_last_response_is_returned_once_retries_run_out(self, sleep):
+        self.responses = [httpx.Response(503) for _ in range(3)]
+
+        response = await self.send(max_retries=2)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(self.requests), 3)
+
+    async def test_client_errors_are_not_retried(self):
+        self.responses = [httpx.Response(404)]
+
+        response = await self.send()
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(len(self.requests), 1)
+
+    async def test_slot_is_free_while_waiting_out_retry_after(self):
+        limiter = AIMDLimiter('test', 1, 1, 1, 10.0)
+        self.responses = [httpx.Response(429, headers={'Retry-After': '0.2'})]
+        first = asyncio.ensure_future(self.send(limiter=limiter))
+        while not self.requests:
+            await asyncio.sleep(0.01)
+
+        started = time.monotonic()
+        await self.send(limiter=limiter)
+
+        self.assertLess(time.monotonic() - started, 0.2)
+        self.assertEqual((await first).status_code, 200)
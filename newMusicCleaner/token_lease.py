@@ -0,0 +1,194 @@
+"""OAuth token refreshes coordinated across workers and hosts through the token row.
+
+Any worker on any host may notice that a token is about to expire at the
+same moment. Refreshing takes a lease first: a conditional UPDATE setting the
+row's `refresh_lease_until`, which only one of them can win. The winner
+refreshes and writes the new token, releasing the lease in the same UPDATE.
+The others keep using the current token while it still works, or wait for
+the new one to show up in the row once it has expired. A node dying halfway
+holds the lease for at most TOKEN_REFRESH_LEASE seconds.
+
+Tokens are refreshed TOKEN_REFRESH_AHEAD seconds before they expire, in the
+background: by `token_refresher`, which sweeps the tokens of live sessions
+every TOKEN_REFRESH_SWEEP_INTERVAL seconds, and by any request that finds its
+token about to expire first. Requests only wait on the token endpoint when a
+session comes back after its token has already expired, e.g. after downtime.
+"""
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Type
+
+from django.db import close_old_connections
+from django.db.models import Model, Q
+from django.utils import timezone
+
+from newMusicCleaner.settings import (
+    TOKEN_REFRESH_AHEAD,
+    TOKEN_REFRESH_LEASE,
+    TOKEN_REFRESH_POLL,
+    TOKEN_REFRESH_SWEEP_INTERVAL
+)
+
+logger = logging.getLogger(__name__)
+
+refresh_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='token-refresh')
+
+
+def is_expired(tokens) -> bool:
+    return tokens.expires_in <= timezone.now()
+
+
+def needs_refresh(tokens) -> bool:
+    """Whether a token expires within TOKEN_REFRESH_AHEAD"""
+    return tokens.expires_in <= timezone.now() + timedelta(seconds=TOKEN_REFRESH_AHEAD)
+
+
+def _lease_available(now) -> Q:
+    # Only a token that still needs refreshing, so a lease released together with
+    # a new token isn't taken again by a node that read the row before
+    return (
+        (Q(refresh_lease_until__isnull=True) | Q(refresh_lease_until__lte=now))
+        & Q(expires_in__lte=now + timedelta(seconds=TOKEN_REFRESH_AHEAD))
+    )
+
+
+def _refreshed(response: Dict) -> Dict:
+    return {
+        'access_token': response['access_token'],
+        'refresh_token': response['refresh_token'],
+        'token_type': response['token_type'],
+        'expires_in': timezone.now() + timedelta(seconds=response['expires_in']),
+        'refresh_lease_until': None,
+    }
+
+
+def refresh_with_lease(model: Type[Model], session_id: str, refresh: Callable[[str], Dict]) -> Optional[Model]:
+    """Refresh the token of `session_id` unless another process already is, and return the current row.
+
+    `refresh` takes the refresh token and returns the new access_token,
+    refresh_token, token_type and expires_in (in seconds).
+    """
+    rows = model.objects.filter(user=session_id)
+    while True:
+        tokens = rows.first()
+        if tokens is None or not needs_refresh(tokens):
+            return tokens
+        now = timezone.now()
+        if rows.filter(_lease_available(now)).update(refresh_lease_until=now + timedelta(seconds=TOKEN_REFRESH_LEASE)):
+            break
+        # Someone else is refreshing, a token that still works will do meanwhile
+        if not is_expired(tokens):
+            return tokens
+        time.sleep(TOKEN_REFRESH_POLL)
+
+    try:
+        fields = _refreshed(refresh(tokens.refresh_token))
+    except Exception:
+        rows.update(refresh_lease_until=None)
+        raise
+    rows.update(**fields)
+    return rows.first()
+
+
+async def arefresh_with_lease(model: Type[Model], session_id: str,
+                              refresh: Callable[[str], Awaitable[Dict]]) -> Optional[Model]:
+    """refresh_with_lease for the async services, `refresh` being a coroutine function"""
+    rows = model.objects.filter(user=session_id)
+    while True:
+        tokens = await rows.afirst()
+        if tokens is None or not needs_refresh(tokens):
+            return tokens
+        now = timezone.now()
+        lease_until = now + timedelta(seconds=TOKEN_REFRESH_LEASE)
+        if await rows.filter(_lease_available(now)).aupdate(refresh_lease_until=lease_until):
+            break
+        if not is_expired(tokens):
+            return tokens
+        await asyncio.sleep(TOKEN_REFRESH_POLL)
+
+    try:
+        fields = _refreshed(await refresh(tokens.refresh_token))
+    except Exception:
+        await rows.aupdate(refresh_lease_until=None)
+        raise
+    await rows.aupdate(**fields)
+    return await rows.afirst()
+
+
+def _run_refresh(refresh: Callable[[], object]) -> None:
+    try:
+        close_old_connections()
+        refresh()
+    except Exception as e:
+        logger.error(f"Background token refresh failed: {e}")
+    finally:
+        close_old_connections()
+
+
+def refresh_in_background(refresh: Callable[[], object]) -> None:
+    """Run `refresh` on the refresh pool, for tokens that still work but are about to expire"""
+    refresh_executor.submit(_run_refresh, refresh)
+
+
+class TokenRefresher:
+    """Periodically refreshes the tokens of live sessions that expire within TOKEN_REFRESH_AHEAD.
+
+    Token models are registered with the function refreshing one session's
+    token, e.g. spotify_app.extras.refresh_tokens. Only sessions that haven't
+    expired are swept, so abandoned logins aren't kept alive forever. Every
+    node may sweep, the lease keeps them from refreshing a token twice.
+    """
+
+    def __init__(self, interval: float = TOKEN_REFRESH_SWEEP_INTERVAL):
+        self.interval = interval
+        self._refreshers: List[Tuple[Type[Model], Callable[[str], object]]] = []
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def register(self, model: Type[Model], refresh: Callable[[str], object]) -> None:
+        self._refreshers.append((model, refresh))
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sweep_forever, name='token-refresher', daemon=True)
+                self._thread.start()
+
+    @staticmethod
+    def _due(model: Type[Model]) -> List[str]:
+        from django.contrib.sessions.models import Session
+
+        now = timezone.now()
+        live = Session.objects.filter(expire_date__gt=now).values('session_key')
+        return list(model.objects.filter(
+            user__in=live,
+            expires_in__gt=now,
+            expires_in__lte=now + timedelta(seconds=TOKEN_REFRESH_AHEAD)
+        ).values_list('user', flat=True))
+
+    def sweep(self) -> int:
+        """Start refreshing every token that is due, returning how many"""
+        due = 0
+        for model, refresh in self._refreshers:
+            for session_id in self._due(model):
+                refresh_in_background(lambda refresh=refresh, session_id=session_id: refresh(session_id))
+                due += 1
+        return due
+
+    def _sweep_forever(self) -> None:
+        while True:
+            try:
+                close_old_connections()
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Token refresh sweep failed: {e}", exc_info=True)
+            finally:
+                close_old_connections()
+            time.sleep(self.interval)
+
+
+token_refresher = TokenRefresher()
@@ -17,11 +17,16 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from newMusicCleaner.metrics import metrics_view
 from spotify_app.api import api
+from spotify_app.async_api import router as async_router
+
+api.add_router('/async', async_router)
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', api.urls),
+    path('metrics', metrics_view, name='metrics'),
     path('spotify/', include('spotify_app.urls')),
     path('youtube/', include('youtube_app.urls'))
 
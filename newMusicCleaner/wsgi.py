@@ -14,3 +14,15 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'newMusicCleaner.settings')
 
 application = get_wsgi_application()
+
+# Picks up conversion jobs queued before a restart and runs new ones
+from spotify_app.jobs import job_queue  # noqa: E402
+
+job_queue.start()
+
+# Refreshes the tokens of live sessions ahead of expiry, whether or not a request comes by
+from newMusicCleaner.token_lease import token_refresher  # noqa: E402
+import spotify_app.extras  # noqa: E402,F401  registers the Spotify tokens
+import youtube_app.extras  # noqa: E402,F401  registers the YouTube tokens
+
+token_refresher.start()
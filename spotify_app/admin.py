@@ -1,9 +1,60 @@
 # Register your models here.
 from django.contrib import admin
-from .models import Token
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.html import format_html
+from .models import Token, TrackMatch, ConversionJob, PlaylistConversion, RequestProfile
 
 @admin.register(Token)
 class TokenAdmin(admin.ModelAdmin):
     list_display = ['user', 'created_at', 'expires_in', 'token_type']
     search_fields = ['user']
-    readonly_fields = ['created_at']
\ No newline at end of file
+    readonly_fields = ['created_at']
+
+@admin.register(TrackMatch)
+class TrackMatchAdmin(admin.ModelAdmin):
+    list_display = ['track_uri', 'clean_uri', 'checked_at']
+    search_fields = ['track_uri', 'clean_uri']
+
+
+@admin.register(ConversionJob)
+class ConversionJobAdmin(admin.ModelAdmin):
+    list_display = ['job_id', 'user', 'platform', 'playlist_id', 'status', 'stage', 'created_at']
+    search_fields = ['job_id', 'user', 'playlist_id']
+    list_filter = ['platform', 'status']
+    readonly_fields = ['created_at', 'updated_at']
+
+
+@admin.register(PlaylistConversion)
+class PlaylistConversionAdmin(admin.ModelAdmin):
+    list_display = ['source_playlist_id', 'cleaned_playlist_id', 'spotify_user_id', 'to_clean', 'updated_at']
+    search_fields = ['spotify_user_id', 'source_playlist_id', 'cleaned_playlist_id']
+    readonly_fields = ['created_at', 'updated_at']
+
+
+@admin.register(RequestProfile)
+class RequestProfileAdmin(admin.ModelAdmin):
+    list_display = ['created_at', 'method', 'path', 'status_code', 'duration', 'sample_count', 'download_link']
+    search_fields = ['path', 'profile_id']
+    readonly_fields = ['profile_id', 'method', 'path', 'status_code', 'duration', 'stages',
+                       'sample_count', 'interval', 'created_at', 'download_link']
+    exclude = ['samples']
+
+    def get_urls(self):
+        return [
+            path('<int:pk>/download/', self.admin_site.admin_view(self.download),
+                 name='spotify_app_requestprofile_download'),
+        ] + super().get_urls()
+
+    def download(self, request, pk):
+        """Folded stacks, one "frame;frame;... count" line each, for flamegraph tools"""
+        profile = get_object_or_404(RequestProfile, pk=pk)
+        response = HttpResponse(profile.samples, content_type='text/plain; charset=utf-8')
+        response['Content-Disposition'] = f'attachment; filename="profile-{profile.profile_id}.folded"'
+        return response
+
+    @admin.display(description='Samples')
+    def download_link(self, profile):
+        return format_html('<a href="{}">Download</a>',
+                           reverse('admin:spotify_app_requestprofile_download', args=[profile.pk]))
@@ -1,23 +1,79 @@
+from uuid import UUID
+
 from django.http import HttpResponse
 from django.template.loader import render_to_string
 from ninja import NinjaAPI, Form
-from typing import List
+from ninja.errors import HttpError
+from typing import List, Optional
+from spotify_app.jobs import job_queue, get_job, JobQueueFull, SPOTIFY, YOUTUBE
+from spotify_app.renderers import ORJSONRenderer, ndjson_response
+from newMusicCleaner.playlist_index import InvalidCursor
+from newMusicCleaner.settings import PLAYLIST_PAGE_SIZE
 from spotify_app.services.schemas import (
     PlaylistResponse,
+    PlaylistPageResponse,
     PlaylistConversionResponse,
     UserResponse,
-    TrackResponse
+    TrackResponse,
+    ConversionJobResponse
 )
 from youtube_app.services.schemas import (
     PlaylistResponse as YoutubePlaylistResponse,
+    PlaylistPageResponse as YoutubePlaylistPageResponse,
 YouTubeUserResponse,
     PlaylistConversionResponse as YoutubeConversionResponse,
     TrackResponse as YoutubeTrackResponse,
-    TrackMetadataResponse as YoutubeTrackMetadataResponse)
+    TrackMetadataResponse as YoutubeTrackMetadataResponse,
+    QuotaUsageResponse)
 from spotify_app.spotify_service import SpotifyService
+from youtube_app.quota import QuotaExceeded, quota_ledger
 from youtube_app.yt_services import YouTubeMusicService
 
-api = NinjaAPI()
+api = NinjaAPI(renderer=ORJSONRenderer())
+
+
+def job_response(job) -> ConversionJobResponse:
+    return ConversionJobResponse(
+        job_id=str(job.job_id),
+        platform=job.platform,
+        playlist_id=job.playlist_id,
+        status=job.status,
+        stage=job.stage,
+        tracks_processed=job.tracks_processed,
+        tracks_total=job.tracks_total,
+        result=job.result,
+        error=job.error or None,
+        run_at=job.run_at,
+        estimated_completion=job.estimated_completion
+    )
+
+
+def queue_conversion(request, platform: str, playlist_id: str, to_clean: bool,
+                     num_tracks: Optional[int] = None, run_now: bool = False):
+    """Create the job of a conversion, turning a full queue or an exhausted quota into an HTTP error"""
+    try:
+        return job_queue.enqueue(platform, request.session.session_key, playlist_id, to_clean,
+                                 num_tracks=num_tracks, run_now=run_now)
+    except JobQueueFull as e:
+        raise HttpError(503, str(e))
+    except QuotaExceeded as e:
+        raise HttpError(429, str(e))
+
+
+def enqueue_conversion(request, platform: str, playlist_id: str, to_clean: bool,
+                       num_tracks: Optional[int] = None) -> ConversionJobResponse:
+    return job_response(queue_conversion(request, platform, playlist_id, to_clean, num_tracks))
+
+
+def playlist_page(service, cursor: Optional[str], limit: int) -> dict:
+    """One page of a service's cached playlist index"""
+    if not 1 <= limit <= 100:
+        raise HttpError(400, "limit must be between 1 and 100")
+    try:
+        items, next_cursor = service.playlist_index().page(cursor, limit)
+    except InvalidCursor as e:
+        raise HttpError(400, str(e))
+    return {'items': items, 'next_cursor': next_cursor}
 
 
 @api.get("/user", response=UserResponse)
@@ -35,32 +91,46 @@ def get_playlists(request):
         request.session.create()
 
     spotify_service = SpotifyService(request.session.session_key)
-    playlists = spotify_service.get_playlists()
 
     # Check if it's an HTMX request
     if request.headers.get('HX-Request'):
-        # Render only the playlist items
+        # Render the first page, the list loads the rest as it is scrolled
+        playlists, next_cursor = spotify_service.playlist_index().page()
         html = render_to_string('components/playlist_list.html', {
-            'playlists': playlists
+            'playlists': playlists,
+            'next_cursor': next_cursor
         })
         return HttpResponse(html)
 
     # For non-HTMX requests, return JSON
-    return playlists
+    return spotify_service.playlist_index().get()
+
+
+@api.get("/playlists/page", response=PlaylistPageResponse)
+def get_playlist_page(request, cursor: Optional[str] = None, limit: int = PLAYLIST_PAGE_SIZE):
+    """Page through the user's playlists; pass `next_cursor` back as `cursor` for the next page"""
+    if not request.session.session_key:
+        request.session.create()
+    return playlist_page(SpotifyService(request.session.session_key), cursor, limit)
 
 
 @api.get("/playlists/{playlist_id}/tracks", response=List[TrackResponse])
-def get_playlist_tracks(request, playlist_id: str):
+def get_playlist_tracks(request, playlist_id: str, stream: bool = False):
+    """All tracks of a playlist; with `stream`, as NDJSON written page by page while they are fetched"""
     if not request.session.session_key:
         request.session.create()
     spotify_service = SpotifyService(request.session.session_key)
+    if stream:
+        return ndjson_response(spotify_service.iter_playlist_tracks(playlist_id), TrackResponse)
     return spotify_service.get_playlist_tracks(playlist_id)
 
 
 @api.post("/playlist/{playlist_id}/convert")
-def convert_playlist(request, playlist_id: str) -> PlaylistConversionResponse:
+def convert_playlist(request, playlist_id: str, background: bool = False) -> PlaylistConversionResponse:
     if not request.session.session_key:
         request.session.create()
+    if background:
+        return enqueue_conversion(request, SPOTIFY, playlist_id, to_clean=True)
     spotify_service = SpotifyService(request.session.session_key)
     result = spotify_service.convert_playlist(playlist_id)
     return PlaylistConversionResponse(**result)
@@ -91,24 +161,54 @@ def get_youtube_playlists(request):
     if not request.session.session_key:
         request.session.create()
     youtube_service = YouTubeMusicService(request.session.session_key)
-    return youtube_service.get_playlists()
+    return youtube_service.playlist_index().get()
+
+
+@api.get("/youtube/playlists/page", response=YoutubePlaylistPageResponse)
+def get_youtube_playlist_page(request, cursor: Optional[str] = None, limit: int = PLAYLIST_PAGE_SIZE):
+    """Page through the user's YouTube playlists; pass `next_cursor` back as `cursor` for the next page"""
+    if not request.session.session_key:
+        request.session.create()
+    return playlist_page(YouTubeMusicService(request.session.session_key), cursor, limit)
 
 
 @api.get("/youtube/playlists/{playlist_id}/tracks", response=List[YoutubeTrackMetadataResponse])
-def get_youtube_playlist_tracks(request, playlist_id: str):
+def get_youtube_playlist_tracks(request, playlist_id: str, stream: bool = False):
+    """All tracks of a playlist; with `stream`, as NDJSON written page by page while they are fetched"""
     if not request.session.session_key:
         request.session.create()
     youtube_service = YouTubeMusicService(request.session.session_key)
+    if stream:
+        return ndjson_response(youtube_service.iter_playlist_tracks(playlist_id), YoutubeTrackMetadataResponse)
     return youtube_service.get_playlist_tracks(playlist_id)
 
 
 @api.post("/youtube/playlist/{playlist_id}/convert")
-def convert_youtube_playlist(request, playlist_id: str, to_clean: bool = True) -> YoutubeConversionResponse:
+def convert_youtube_playlist(request, playlist_id: str, to_clean: bool = True,
+                             background: bool = False) -> YoutubeConversionResponse:
     if not request.session.session_key:
         request.session.create()
     youtube_service = YouTubeMusicService(request.session.session_key)
-    result = youtube_service.convert_playlist(playlist_id, to_clean)
-    return PlaylistConversionResponse(**result)
+    num_tracks = youtube_service.get_playlist_size(playlist_id)
+    if background:
+        return enqueue_conversion(request, YOUTUBE, playlist_id, to_clean, num_tracks)
+    # The job row holds the quota reservation while the conversion runs here
+    job = queue_conversion(request, YOUTUBE, playlist_id, to_clean, num_tracks, run_now=True)
+    try:
+        result = youtube_service.convert_playlist(playlist_id, to_clean)
+    except Exception as e:
+        job_queue.finish(job, error=str(e))
+        raise
+    job_queue.finish(job, result)
+    return YoutubeConversionResponse(**result)
+
+
+@api.get("/youtube/quota", response=QuotaUsageResponse)
+def get_youtube_quota(request):
+    """YouTube Data API quota spent today by this user and by the whole project"""
+    if not request.session.session_key:
+        request.session.create()
+    return quota_ledger.report(request.session.session_key)
 
 
 @api.get("/youtube/search")
@@ -141,12 +241,31 @@ def add_tracks_to_playlist(request, playlist_id: str, video_ids: List[str]) -> d
         'failed': []
     }
 
-    for video_id in video_ids:
-        if youtube_service.add_track_to_playlist(playlist_id, video_id):
-            results['successful'].append(video_id)
+    for result in youtube_service.add_tracks_to_playlist(playlist_id, video_ids):
+        if result['success']:
+            results['successful'].append(result['video_id'])
         else:
-            results['failed'].append(video_id)
+            results['failed'].append(result['video_id'])
 
     return results
 
 
+@api.get("/jobs/{job_id}", response=ConversionJobResponse)
+def get_conversion_job(request, job_id: UUID):
+    """Report the stage, progress and final result of a background conversion"""
+    if not request.session.session_key:
+        request.session.create()
+    job = get_job(job_id, request.session.session_key)
+    if not job:
+        raise HttpError(404, "Job not found")
+
+    # HTMX polls this endpoint until the conversion finishes
+    if request.headers.get('HX-Request'):
+        if job.status == job.SUCCEEDED:
+            template = 'components/conversion_result.html'
+        else:
+            template = 'components/job_progress.html'
+        html = render_to_string(template, {'job': job, 'result': job.result}, request=request)
+        return HttpResponse(html)
+
+    return job_response(job)
@@ -0,0 +1,134 @@
+"""Async variants of the API endpoints, mounted under /api/async/ in newMusicCleaner/urls.py.
+
+Served from newMusicCleaner/asgi.py (e.g. `uvicorn newMusicCleaner.asgi:application`)
+a request waiting on Spotify, Google or YTMusic holds no worker thread, so
+one process serves many slow upstream calls at once. Responses match the
+sync endpoints of the same path.
+"""
+from typing import List, Optional
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse
+from django.template.loader import render_to_string
+from ninja import Router
+
+from newMusicCleaner.settings import PLAYLIST_PAGE_SIZE
+from spotify_app.api import enqueue_conversion, playlist_page, queue_conversion
+from spotify_app.async_service import AsyncSpotifyService
+from spotify_app.jobs import job_queue, SPOTIFY, YOUTUBE
+from spotify_app.renderers import ndjson_response
+from spotify_app.services.schemas import PlaylistConversionResponse, PlaylistPageResponse, TrackResponse, UserResponse
+from spotify_app.spotify_service import SpotifyService
+from youtube_app.async_service import AsyncYouTubeMusicService
+from youtube_app.yt_services import YouTubeMusicService
+from youtube_app.services.schemas import (
+    PlaylistConversionResponse as YoutubeConversionResponse,
+    PlaylistPageResponse as YoutubePlaylistPageResponse,
+    PlaylistResponse as YoutubePlaylistResponse,
+    TrackMetadataResponse as YoutubeTrackMetadataResponse,
+    TrackResponse as YoutubeTrackResponse,
+    YouTubeUserResponse
+)
+
+router = Router(tags=['async'])
+
+
+async def session_key(request) -> str:
+    if not request.session.session_key:
+        await request.session.acreate()
+    return request.session.session_key
+
+
+@router.get("/user", response=UserResponse)
+async def get_user(request):
+    spotify_service = AsyncSpotifyService(await session_key(request))
+    return await spotify_service.get_user()
+
+
+@router.get("/playlists")
+async def get_playlists(request):
+    """HTMX endpoint for fetching playlists"""
+    spotify_service = AsyncSpotifyService(await session_key(request))
+    playlists = await spotify_service.get_playlists()
+
+    if request.headers.get('HX-Request'):
+        html = render_to_string('components/playlist_list.html', {
+            'playlists': playlists
+        })
+        return HttpResponse(html)
+
+    return playlists
+
+
+@router.get("/playlists/page", response=PlaylistPageResponse)
+async def get_playlist_page(request, cursor: Optional[str] = None, limit: int = PLAYLIST_PAGE_SIZE):
+    # The index lives in the Django cache, read on a worker thread like the sync endpoint's
+    service = SpotifyService(await session_key(request))
+    return await sync_to_async(playlist_page, thread_sensitive=False)(service, cursor, limit)
+
+
+@router.get("/playlists/{playlist_id}/tracks", response=List[TrackResponse])
+async def get_playlist_tracks(request, playlist_id: str, stream: bool = False):
+    spotify_service = AsyncSpotifyService(await session_key(request))
+    if stream:
+        return ndjson_response(spotify_service.iter_playlist_tracks(playlist_id), TrackResponse)
+    return await spotify_service.get_playlist_tracks(playlist_id)
+
+
+@router.post("/playlist/{playlist_id}/convert")
+async def convert_playlist(request, playlist_id: str, background: bool = False) -> PlaylistConversionResponse:
+    spotify_service = AsyncSpotifyService(await session_key(request))
+    if background:
+        return await sync_to_async(enqueue_conversion)(request, SPOTIFY, playlist_id, to_clean=True)
+    result = await spotify_service.convert_playlist(playlist_id)
+    return PlaylistConversionResponse(**result)
+
+
+@router.get("/youtube/user", response=YouTubeUserResponse)
+async def get_youtube_user(request):
+    youtube_service = AsyncYouTubeMusicService(await session_key(request))
+    return await youtube_service.get_user()
+
+
+@router.get("/youtube/playlists", response=List[YoutubePlaylistResponse])
+async def get_youtube_playlists(request):
+    youtube_service = AsyncYouTubeMusicService(await session_key(request))
+    return await youtube_service.get_playlists()
+
+
+@router.get("/youtube/playlists/page", response=YoutubePlaylistPageResponse)
+async def get_youtube_playlist_page(request, cursor: Optional[str] = None, limit: int = PLAYLIST_PAGE_SIZE):
+    service = YouTubeMusicService(await session_key(request))
+    return await sync_to_async(playlist_page, thread_sensitive=False)(service, cursor, limit)
+
+
+@router.get("/youtube/playlists/{playlist_id}/tracks", response=List[YoutubeTrackMetadataResponse])
+async def get_youtube_playlist_tracks(request, playlist_id: str, stream: bool = False):
+    youtube_service = AsyncYouTubeMusicService(await session_key(request))
+    if stream:
+        return ndjson_response(youtube_service.iter_playlist_tracks(playlist_id), YoutubeTrackMetadataResponse)
+    return await youtube_service.get_playlist_tracks(playlist_id)
+
+
+@router.post("/youtube/playlist/{playlist_id}/convert")
+async def convert_youtube_playlist(request, playlist_id: str, to_clean: bool = True,
+                                   background: bool = False) -> YoutubeConversionResponse:
+    youtube_service = AsyncYouTubeMusicService(await session_key(request))
+    num_tracks = await youtube_service.get_playlist_size(playlist_id)
+    if background:
+        return await sync_to_async(enqueue_conversion)(request, YOUTUBE, playlist_id, to_clean, num_tracks)
+    job = await sync_to_async(queue_conversion)(request, YOUTUBE, playlist_id, to_clean, num_tracks, run_now=True)
+    try:
+        result = await youtube_service.convert_playlist(playlist_id, to_clean)
+    except Exception as e:
+        await sync_to_async(job_queue.finish)(job, error=str(e))
+        raise
+    await sync_to_async(job_queue.finish)(job, result)
+    return YoutubeConversionResponse(**result)
+
+
+@router.get("/youtube/search")
+async def search_youtube_tracks(request, query: str) -> List[YoutubeTrackResponse]:
+    """Search for tracks on YouTube Music"""
+    youtube_service = AsyncYouTubeMusicService(await session_key(request))
+    return await youtube_service.search_track(query)
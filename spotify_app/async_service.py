@@ -0,0 +1,137 @@
+import asyncio
+import logging
+from collections import deque
+from itertools import islice
+from typing import AsyncIterator, Dict, List
+
+import orjson
+from asgiref.sync import sync_to_async
+
+from newMusicCleaner.async_http import send_with_retries
+from newMusicCleaner.session_cache import SessionCache
+from spotify_app.extras import aget_spotify_token
+from spotify_app.search_engine import search_engine
+from spotify_app.spotify_service import SpotifyService
+
+logger = logging.getLogger(__name__)
+
+API_URL = 'https://api.spotify.com/v1/'
+
+
+class AsyncSpotifyService:
+    """SpotifyService for the async endpoints.
+
+    Reads go through httpx and the async ORM, so a request waiting on Spotify
+    holds no thread. Conversions and additions run the sync SpotifyService on a
+    worker thread: their searches already run on the async search engine and
+    the rest is a handful of spotipy writes.
+    """
+    api_url = API_URL
+
+    def __init__(self, session_id=None):
+        self._access_token = None
+        self._user = None
+        self.session_id = session_id
+        self.session_cache = SessionCache('spotify', session_id)
+
+    @property
+    def max_concurrency(self) -> int:
+        """Pages to fetch ahead, following the adaptive limit shared with the search engine"""
+        return search_engine.concurrency.limit
+
+    async def initialize_client(self) -> str:
+        if not self._access_token:
+            self._access_token = await aget_spotify_token(self.session_id)
+            if not self._access_token:
+                raise Exception("Failed to initialize Spotify client")
+        return self._access_token
+
+    async def _get(self, path: str, **params) -> Dict:
+        access_token = await self.initialize_client()
+        response = await send_with_retries(
+            'spotify', 'GET', self.api_url + path,
+            limiter=search_engine.concurrency,
+            params=params,
+            headers={'Authorization': f"Bearer {access_token}"}
+        )
+        response.raise_for_status()
+        return orjson.loads(response.content)
+
+    async def get_user(self) -> Dict:
+        """Get current user information"""
+        if self._user is None:
+            try:
+                self._user = await self.session_cache.aget('user', lambda: self._get('me'))
+            except Exception as e:
+                logger.error(f"Failed to get user: {e}")
+                raise
+        return self._user
+
+    async def get_playlists(self) -> List[Dict]:
+        """All of the user's playlists; pages after the first are fetched concurrently"""
+        try:
+            results = await self._get('me/playlists', limit=50)
+            pages = [results]
+            pages.extend(await asyncio.gather(*(
+                self._get('me/playlists', limit=50, offset=offset)
+                for offset in range(50, results.get('total') or 0, 50)
+            )))
+        except Exception as e:
+            logger.error(f"Failed to fetch playlists: {e}", exc_info=True)
+            raise
+
+        return [
+            {
+                'id': playlist['id'],
+                'name': playlist['name'],
+                'external_urls': playlist['external_urls'],
+                'tracks': None
+            }
+            for page in pages for playlist in page.get('items', []) if playlist
+        ]
+
+    async def iter_playlist_pages(self, playlist_id: str, page_size: int = 100) -> AsyncIterator[List[Dict]]:
+        """Yield a playlist's tracks page by page, in playlist order.
+
+        Like SpotifyService.iter_playlist_pages, the remaining pages are fetched
+        concurrently, at most `max_concurrency` ahead of the consumer.
+        """
+        path = f"playlists/{playlist_id}/tracks"
+        results = await self._get(path, limit=page_size)
+        yield SpotifyService._page_tracks(results)
+
+        offsets = iter(range(page_size, results.get('total') or 0, page_size))
+        pending = deque(
+            asyncio.ensure_future(self._get(path, limit=page_size, offset=offset))
+            for offset in islice(offsets, self.max_concurrency)
+        )
+        try:
+            while pending:
+                results = await pending.popleft()
+                offset = next(offsets, None)
+                if offset is not None:
+                    pending.append(asyncio.ensure_future(self._get(path, limit=page_size, offset=offset)))
+                yield SpotifyService._page_tracks(results)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def iter_playlist_tracks(self, playlist_id: str) -> AsyncIterator[Dict]:
+        async for page in self.iter_playlist_pages(playlist_id):
+            for track in page:
+                yield track
+
+    async def get_playlist_tracks(self, playlist_id: str) -> List[Dict]:
+        try:
+            return [track async for track in self.iter_playlist_tracks(playlist_id)]
+        except Exception as e:
+            logger.error(f"Failed to get tracks: {e}")
+            raise
+
+    async def convert_playlist(self, playlist_id: str, to_clean: bool = True) -> Dict:
+        service = SpotifyService(self.session_id)
+        return await sync_to_async(service.convert_playlist, thread_sensitive=False)(playlist_id, to_clean)
+
+    async def add_additional_songs(self, playlist_id: str, song_uris: List) -> str:
+        service = SpotifyService(self.session_id)
+        return await sync_to_async(service.add_additional_songs, thread_sensitive=False)(playlist_id, song_uris)
@@ -1,13 +1,36 @@
+import asyncio
+import logging
+from typing import Optional
+
 from spotipy import Spotify
 
-from newMusicCleaner.settings import SP_CLIENT_ID, SP_CLIENT_SECRET
+from newMusicCleaner.async_http import async_client
+from newMusicCleaner.client_cache import ClientCache
+from newMusicCleaner.metrics import instrument_session, instrumented_session
+from newMusicCleaner.settings import SP_CLIENT_ID, SP_CLIENT_SECRET, TOKEN_REFRESH_AHEAD
+from newMusicCleaner.singleflight import AsyncSingleFlight, SingleFlight
+from newMusicCleaner.token_lease import (
+    arefresh_with_lease,
+    is_expired,
+    needs_refresh,
+    refresh_in_background,
+    refresh_with_lease,
+    token_refresher
+)
 from .models import Token
 from django.utils import timezone
 from datetime import timedelta
-from requests import post
+
+logger = logging.getLogger(__name__)
 
 BASE_URL = 'Https://api.spotify.com/v1/me'
 
+# Clients are reloaded once their token is due for a refresh, which starts the refresh
+spotify_clients = ClientCache(name='spotify_clients', expiry_margin=TOKEN_REFRESH_AHEAD)
+token_refreshes = SingleFlight()
+async_token_refreshes = AsyncSingleFlight()
+accounts_session = instrumented_session('spotify_accounts')
+
 
 def check_tokens(session_id):
     try:
@@ -19,73 +42,131 @@ def check_tokens(session_id):
 
 
 def create_or_update_tokens(session_id, access_token, refresh_token, expires_in, token_type):
+    Token.objects.update_or_create(user=session_id, defaults={
+        'access_token': access_token,
+        'refresh_token': refresh_token,
+        'expires_in': timezone.now() + timedelta(seconds=expires_in),
+        'token_type': token_type,
+        'refresh_lease_until': None,
+    })
+    spotify_clients.invalidate(session_id)
+
+
+def fresh_tokens(session_id):
+    """Tokens of a session, refreshed first if expired and in the background if about to expire"""
     tokens = check_tokens(session_id)
-    expires_in = timezone.now() + timedelta(seconds=expires_in)
-
-    if tokens:
-        tokens.access_token = access_token
-        tokens.refresh_token = refresh_token
-        tokens.expires_in = expires_in
-        tokens.token_type = token_type
-        tokens.save(update_fields=['access_token', 'refresh_token', 'expires_in', 'token_type'])
-    else:
-        tokens = Token(
-            user=session_id,
-            access_token=access_token,
-            refresh_token=refresh_token,
-            expires_in=expires_in,
-            token_type=token_type
-        )
-        tokens.save()
+
+    if tokens and is_expired(tokens):
+        logger.debug(f"Token expired for session {session_id}, attempting refresh")
+        tokens = refresh_tokens(session_id)
+    elif tokens and needs_refresh(tokens):
+        refresh_in_background(lambda: refresh_tokens(session_id))
+    return tokens
 
 
 def is_spotify_authenticated(session_id):
-    tokens = check_tokens(session_id)
+    return fresh_tokens(session_id) is not None
+
 
-    if tokens:
-        if tokens.expires_in <= timezone.now():
-            refresh_token_func(session_id)
-        return True
-    return False
+def refresh_tokens(session_id):
+    """Refresh once per session even when several requests, or nodes, notice the expiry together"""
+    return token_refreshes.do(session_id, lambda: refresh_token_func(session_id))
 
 
 def refresh_token_func(session_id):
-    refresh_token = check_tokens(session_id).refresh_token
+    tokens = refresh_with_lease(Token, session_id, _request_refresh)
+    spotify_clients.invalidate(session_id)
+    return tokens
 
-    response = post('https://accounts.spotify.com/api/token', data={
+
+token_refresher.register(Token, refresh_tokens)
+
+
+def _refresh_response(response, refresh_token):
+    if 'access_token' not in response:
+        raise Exception(f"Failed to refresh Spotify token: {response.get('error')}")
+    # Spotify may rotate the refresh token
+    response.setdefault('refresh_token', refresh_token)
+    return response
+
+
+def _request_refresh(refresh_token):
+    response = accounts_session.post('https://accounts.spotify.com/api/token', data={
         'grant_type': "refresh_token",
         'refresh_token': refresh_token,
         'client_id': SP_CLIENT_ID,
         'client_secret': SP_CLIENT_SECRET,
 
     }).json()
+    return _refresh_response(response, refresh_token)
 
-    access_token = response.get('access_token')
-    expires_in = response.get('expires_in')
-    token_type = response.get('token_type')
 
-    create_or_update_tokens(
-        session_id=session_id,
-        access_token=access_token,
-        refresh_token=refresh_token,
-        expires_in=expires_in,
-        token_type=token_type
-    )
+def _load_spotify_client(session_id):
+    tokens = fresh_tokens(session_id)
+
+    if not tokens:
+        logger.debug(f"No tokens found for session {session_id}")
+        return None
+
+    client = Spotify(auth=tokens.access_token)
+    instrument_session(client._session, 'spotify')
+    return client, tokens.expires_in
 
 
 def get_spotify_client(session_id):
-    tokens = check_tokens(session_id)
-    print(f"Session ID: {session_id}")
-    print(f"Tokens found: {tokens is not None}")
+    return spotify_clients.get(session_id, lambda: _load_spotify_client(session_id))
+
+
+async def acheck_tokens(session_id):
+    return await Token.objects.filter(user=session_id).afirst()
+
+
+async def acreate_or_update_tokens(session_id, access_token, refresh_token, expires_in, token_type):
+    await Token.objects.aupdate_or_create(user=session_id, defaults={
+        'access_token': access_token,
+        'refresh_token': refresh_token,
+        'expires_in': timezone.now() + timedelta(seconds=expires_in),
+        'token_type': token_type,
+        'refresh_lease_until': None,
+    })
+    spotify_clients.invalidate(session_id)
+
+
+async def arefresh_tokens(session_id):
+    """Refresh once per session and event loop, tasks can't be awaited from another loop"""
+    key = (session_id, id(asyncio.get_running_loop()))
+    return await async_token_refreshes.do(key, lambda: arefresh_token_func(session_id))
+
+
+async def arefresh_token_func(session_id):
+    tokens = await arefresh_with_lease(Token, session_id, _arequest_refresh)
+    spotify_clients.invalidate(session_id)
+    return tokens
+
+
+async def _arequest_refresh(refresh_token):
+    response = await async_client('spotify_accounts').post('https://accounts.spotify.com/api/token', data={
+        'grant_type': "refresh_token",
+        'refresh_token': refresh_token,
+        'client_id': SP_CLIENT_ID,
+        'client_secret': SP_CLIENT_SECRET,
+    })
+    return _refresh_response(response.json(), refresh_token)
+
+
+async def aget_spotify_token(session_id) -> Optional[str]:
+    """Access token of a session for the async services, refreshed first if it has expired"""
+    tokens = await acheck_tokens(session_id)
 
     if not tokens:
-        print("No tokens found for session")
+        logger.debug(f"No tokens found for session {session_id}")
         return None
 
-    if tokens.expires_in <= timezone.now():
-        print("Token expired, attempting refresh")
-        refresh_token_func(session_id)
-        tokens = check_tokens(session_id)
+    if is_expired(tokens):
+        logger.debug(f"Token expired for session {session_id}, attempting refresh")
+        tokens = await arefresh_tokens(session_id)
+    elif needs_refresh(tokens):
+        # Refreshed on the shared pool, not a task that would die with this request's loop
+        refresh_in_background(lambda: refresh_tokens(session_id))
 
-    print(f"Creating Spotify client with token: {tokens.access_token[:10]}...")
-    return Spotify(auth=tokens.access_token)
+    return tokens.access_token if tokens else None
@@ -0,0 +1,279 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from newMusicCleaner.settings import (
+    CONVERSION_JOB_WORKERS,
+    CONVERSION_JOB_MAX_PENDING,
+    CONVERSION_JOB_POLL_INTERVAL,
+    CONVERSION_JOB_STALE_AFTER
+)
+from .models import ConversionJob
+
+logger = logging.getLogger(__name__)
+
+SPOTIFY = 'spotify'
+YOUTUBE = 'youtube'
+
+
+class JobQueueFull(Exception):
+    """Raised when too many conversions are already waiting for a worker"""
+
+
+class JobProgress:
+    """Progress callback handed to convert_playlist, writes throttled updates to the job row"""
+
+    def __init__(self, job: ConversionJob, interval: float = 0.5):
+        self.job = job
+        self.interval = interval
+        self._last_write = 0.0
+
+    def __call__(self, stage: str, processed: int = 0, total: int = 0) -> None:
+        now = time.monotonic()
+        stage_changed = stage != self.job.stage
+        if not stage_changed and now - self._last_write < self.interval:
+            return
+
+        self.job.stage = stage
+        self.job.tracks_processed = processed
+        self.job.tracks_total = total
+        self.job.save(update_fields=['stage', 'tracks_processed', 'tracks_total', 'updated_at'])
+        self._last_write = now
+
+
+def get_service(platform: str, session_id: str):
+    if platform == SPOTIFY:
+        from .spotify_service import SpotifyService
+        return SpotifyService(session_id)
+    if platform == YOUTUBE:
+        from youtube_app.yt_services import YouTubeMusicService
+        return YouTubeMusicService(session_id)
+    raise ValueError(f"Unknown platform: {platform}")
+
+
+def defer_inserts(job: ConversionJob, video_ids: List[str]) -> None:
+    """Queue the tracks a split conversion has left to insert on the same job, for the next day with quota"""
+    from youtube_app.quota import quota_scheduler
+
+    def requeue(decision) -> ConversionJob:
+        job.status = ConversionJob.QUEUED
+        job.stage = 'waiting_for_quota'
+        job.pending_video_ids = video_ids
+        job.insert_limit = decision.insert_limit
+        job.run_at = decision.run_at
+        job.estimated_completion = decision.estimated_completion
+        job.quota_cost = decision.estimated_cost
+        job.save(update_fields=[
+            'result', 'status', 'stage', 'pending_video_ids', 'insert_limit',
+            'run_at', 'estimated_completion', 'quota_cost', 'updated_at'
+        ])
+        return job
+
+    quota_scheduler.admit_inserts(job.user, len(video_ids), requeue)
+
+
+def run_job(job: ConversionJob) -> None:
+    job.status = ConversionJob.RUNNING
+    job.save(update_fields=['status', 'updated_at'])
+
+    try:
+        service = get_service(job.platform, job.user)
+        # Only YouTube conversions are split over several quota days
+        split = {} if job.insert_limit is None else {'insert_limit': job.insert_limit}
+        if job.pending_video_ids:
+            result = service.resume_conversion(job.result, job.pending_video_ids, progress=JobProgress(job), **split)
+        else:
+            result = service.convert_playlist(job.playlist_id, job.to_clean, progress=JobProgress(job), **split)
+        deferred = result.pop('deferred_inserts', None)
+        job.result = result
+        if deferred:
+            defer_inserts(job, deferred)
+            return
+        job.pending_video_ids = []
+        job.status = ConversionJob.SUCCEEDED
+        job.stage = 'done'
+    except Exception as e:
+        logger.error(f"Conversion job {job.job_id} failed: {e}", exc_info=True)
+        job.error = str(e)
+        job.status = ConversionJob.FAILED
+
+    job.save(update_fields=['result', 'status', 'stage', 'error', 'pending_video_ids', 'updated_at'])
+
+
+class LocalJobQueue:
+    """Bounded in-process worker pool for conversion jobs, fed from the ConversionJob table.
+
+    A dispatcher thread claims QUEUED rows that are due, i.e. without a
+    `run_at` or with one that has passed, and hands them to the pool. A job
+    waiting for its `run_at` is only a row, holding neither a worker nor a
+    pending slot, and queued jobs survive a restart; any process running a
+    queue may claim them. Running jobs get a heartbeat on `updated_at`, so rows
+    left RUNNING by a process that died are failed once it stops.
+    """
+
+    def __init__(self, max_workers: int = CONVERSION_JOB_WORKERS, max_pending: int = CONVERSION_JOB_MAX_PENDING,
+                 poll_interval: float = CONVERSION_JOB_POLL_INTERVAL, stale_after: int = CONVERSION_JOB_STALE_AFTER):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.poll_interval = poll_interval
+        self.stale_after = timedelta(seconds=stale_after)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='conversion-job')
+        self._running = set()
+        # Jobs run by request threads, which get heartbeats but take no worker
+        self._inline = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        """Start the dispatcher, which first picks up the jobs left queued by a previous run"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._dispatch_forever, name='conversion-dispatcher', daemon=True)
+                self._thread.start()
+
+    def wake(self) -> None:
+        self.start()
+        self._wakeup.set()
+
+    @staticmethod
+    def _due():
+        return ConversionJob.objects.filter(status=ConversionJob.QUEUED).filter(
+            Q(run_at__isnull=True) | Q(run_at__lte=timezone.now())
+        )
+
+    def enqueue(self, platform: str, session_id: str, playlist_id: str, to_clean: bool = True,
+                num_tracks: Optional[int] = None, run_now: bool = False) -> ConversionJob:
+        """Queue a conversion; one with a future `run_at` waits in the table until it is due.
+
+        A YouTube conversion of `num_tracks` tracks is admitted against the
+        quota, which may delay it or split it over several days, and raises
+        QuotaExceeded if it can't be. With `run_now` the job is created
+        RUNNING for the caller to run on its own thread and `finish`, and
+        raises QuotaExceeded rather than wait for quota.
+        """
+        if not run_now and self._due().count() >= self.max_pending:
+            raise JobQueueFull("Too many conversions in progress, try again later")
+
+        fields = {
+            'user': session_id,
+            'platform': platform,
+            'playlist_id': playlist_id,
+            'to_clean': to_clean,
+            'status': ConversionJob.RUNNING if run_now else ConversionJob.QUEUED,
+        }
+        if platform == YOUTUBE and num_tracks is not None:
+            from youtube_app.quota import QuotaExceeded, quota_scheduler
+
+            def create(decision) -> ConversionJob:
+                if run_now and (decision.delayed or decision.split):
+                    raise QuotaExceeded(f"{decision.reason}. Only a background conversion can wait for quota")
+                return ConversionJob.objects.create(
+                    run_at=decision.run_at,
+                    estimated_completion=decision.estimated_completion,
+                    quota_cost=decision.estimated_cost,
+                    insert_limit=decision.insert_limit,
+                    **fields
+                )
+
+            job = quota_scheduler.admit(session_id, num_tracks, create)
+        else:
+            job = ConversionJob.objects.create(**fields)
+
+        if run_now:
+            self.start()
+            with self._lock:
+                self._inline.add(job.pk)
+        else:
+            # Inside a transaction the row is only visible to the dispatcher once committed
+            transaction.on_commit(self.wake)
+        return job
+
+    def finish(self, job: ConversionJob, result: Optional[Dict] = None, error: str = '') -> None:
+        """Record the outcome of a job created with `run_now`, releasing its quota reservation"""
+        job.result = result
+        job.error = error
+        job.status = ConversionJob.FAILED if error else ConversionJob.SUCCEEDED
+        job.stage = 'done'
+        job.save(update_fields=['result', 'status', 'stage', 'error', 'updated_at'])
+        with self._lock:
+            self._inline.discard(job.pk)
+
+    def _dispatch_forever(self) -> None:
+        while True:
+            try:
+                close_old_connections()
+                self._heartbeat()
+                self._fail_stale()
+                self._claim()
+            except Exception as e:
+                logger.error(f"Conversion job dispatcher failed: {e}", exc_info=True)
+            finally:
+                close_old_connections()
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _heartbeat(self) -> None:
+        with self._lock:
+            running = list(self._running | self._inline)
+        if running:
+            ConversionJob.objects.filter(pk__in=running, status=ConversionJob.RUNNING).update(updated_at=timezone.now())
+
+    def _fail_stale(self) -> None:
+        now = timezone.now()
+        with self._lock:
+            running = list(self._running | self._inline)
+        failed = ConversionJob.objects.filter(
+            status=ConversionJob.RUNNING,
+            updated_at__lt=now - self.stale_after
+        ).exclude(pk__in=running).update(
+            status=ConversionJob.FAILED,
+            error="The worker running this conversion stopped, start it again",
+            updated_at=now
+        )
+        if failed:
+            logger.warning(f"Failed {failed} conversion jobs left running by a stopped worker")
+
+    def _claim(self) -> None:
+        with self._lock:
+            free = self.max_workers - len(self._running)
+        if free <= 0:
+            return
+
+        for pk in self._due().order_by('created_at').values_list('pk', flat=True)[:free]:
+            # Another process may go for the same row, the conditional update decides who runs it
+            claimed = ConversionJob.objects.filter(pk=pk, status=ConversionJob.QUEUED).update(
+                status=ConversionJob.RUNNING,
+                updated_at=timezone.now()
+            )
+            if claimed:
+                with self._lock:
+                    self._running.add(pk)
+                self._executor.submit(self._run, pk)
+
+    def _run(self, pk: int) -> None:
+        try:
+            close_old_connections()
+            run_job(ConversionJob.objects.get(pk=pk))
+        except Exception as e:
+            logger.error(f"Conversion job {pk} could not run: {e}", exc_info=True)
+        finally:
+            with self._lock:
+                self._running.discard(pk)
+            close_old_connections()
+            # A worker is free, claim the next job straight away
+            self._wakeup.set()
+
+
+job_queue = LocalJobQueue()
+
+
+def get_job(job_id: str, session_id: str):
+    return ConversionJob.objects.filter(job_id=job_id, user=session_id).first()
@@ -0,0 +1,165 @@
+import logging
+import threading
+from datetime import timedelta
+from typing import Dict, Iterable, Optional
+
+from cachetools import LRUCache
+from django.utils import timezone
+
+from newMusicCleaner.metrics import record_cache_lookups
+from newMusicCleaner.settings import (
+    SPOTIFY_MATCH_CACHE_SIZE,
+    SPOTIFY_MATCH_CACHE_TTL,
+    SPOTIFY_MATCH_CACHE_MISS_TTL
+)
+from .models import TrackMatch
+
+logger = logging.getLogger(__name__)
+
+
+class MatchCache:
+    """Explicit track URI -> clean match lookups, backed by the TrackMatch table.
+
+    The clean counterpart of a track is the same for every user, so results are
+    shared across sessions. Entries older than their TTL are treated as misses
+    and get overwritten by the next search. Outcomes without a clean version use
+    a shorter TTL since a clean edit may be released later. Found matches are
+    also indexed by the explicit track's ISRC.
+    """
+
+    def __init__(self, maxsize: int = SPOTIFY_MATCH_CACHE_SIZE,
+                 ttl: int = SPOTIFY_MATCH_CACHE_TTL,
+                 miss_ttl: int = SPOTIFY_MATCH_CACHE_MISS_TTL):
+        self._entries = LRUCache(maxsize=maxsize)
+        self._by_isrc = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self.ttl = timedelta(seconds=ttl)
+        self.miss_ttl = timedelta(seconds=miss_ttl)
+
+    def _is_fresh(self, entry: Dict) -> bool:
+        ttl = self.ttl if entry['found_match'] or entry['potential_matches'] else self.miss_ttl
+        return entry['checked_at'] + ttl > timezone.now()
+
+    def get_many(self, track_uris: Iterable[str]) -> Dict[str, Dict]:
+        """Return fresh cached results for the given URIs, keyed by URI"""
+        found = {}
+        missing = []
+
+        with self._lock:
+            for uri in track_uris:
+                entry = self._entries.get(uri)
+                if entry and self._is_fresh(entry):
+                    found[uri] = entry
+                else:
+                    missing.append(uri)
+        hits = len(found)
+
+        if missing:
+            try:
+                for match in TrackMatch.objects.filter(track_uri__in=missing):
+                    entry = {
+                        'found_match': match.found_match,
+                        'converted_uri': match.clean_uri,
+                        'potential_matches': match.potential_matches,
+                        'checked_at': match.checked_at,
+                    }
+                    if self._is_fresh(entry):
+                        found[match.track_uri] = entry
+                        with self._lock:
+                            self._entries[match.track_uri] = entry
+            except Exception as e:
+                logger.error(f"Failed to read match cache: {e}")
+
+        record_cache_lookups('spotify_match', len(found), hits + len(missing) - len(found))
+        return found
+
+    def get(self, track_uri: str) -> Optional[Dict]:
+        return self.get_many([track_uri]).get(track_uri)
+
+    def get_many_by_isrc(self, isrcs: Iterable[str]) -> Dict[str, Dict]:
+        """Return fresh clean matches found for any track with the given ISRCs, keyed by ISRC.
+
+        The same recording is often listed under several track URIs (album,
+        single, compilation), so a match resolved for one of them answers the
+        others without a search.
+        """
+        found = {}
+        missing = []
+
+        with self._lock:
+            for isrc in set(isrcs):
+                entry = self._by_isrc.get(isrc)
+                if entry and self._is_fresh(entry):
+                    found[isrc] = entry
+                else:
+                    missing.append(isrc)
+        hits = len(found)
+
+        if missing:
+            try:
+                matches = TrackMatch.objects.filter(isrc__in=missing, clean_uri__isnull=False).order_by('checked_at')
+                for match in matches:
+                    entry = {
+                        'found_match': True,
+                        'converted_uri': match.clean_uri,
+                        'potential_matches': [],
+                        'checked_at': match.checked_at,
+                    }
+                    if self._is_fresh(entry):
+                        # Ordered by age, so the newest match per ISRC wins
+                        found[match.isrc] = entry
+                with self._lock:
+                    for isrc in missing:
+                        if isrc in found:
+                            self._by_isrc[isrc] = found[isrc]
+            except Exception as e:
+                logger.error(f"Failed to read ISRC index: {e}")
+
+        record_cache_lookups('spotify_isrc', len(found), hits + len(missing) - len(found))
+        return found
+
+    def set_many(self, results: Iterable[Dict]) -> None:
+        """Store search_and_process_track results, overwriting stale entries"""
+        now = timezone.now()
+        matches = []
+
+        with self._lock:
+            for result in results:
+                uri = result['track']['uri']
+                isrc = result['track'].get('isrc')
+                entry = self._entries[uri] = {
+                    'found_match': result['found_match'],
+                    'converted_uri': result['converted_uri'],
+                    'potential_matches': result['potential_matches'],
+                    'checked_at': now,
+                }
+                if isrc and result['found_match']:
+                    self._by_isrc[isrc] = {**entry, 'potential_matches': []}
+                matches.append(TrackMatch(
+                    track_uri=uri,
+                    isrc=isrc,
+                    clean_uri=result['converted_uri'],
+                    potential_matches=result['potential_matches'],
+                    checked_at=now
+                ))
+
+        if not matches:
+            return
+
+        try:
+            TrackMatch.objects.bulk_create(
+                matches,
+                update_conflicts=True,
+                unique_fields=['track_uri'],
+                update_fields=['isrc', 'clean_uri', 'potential_matches', 'checked_at']
+            )
+        except Exception as e:
+            logger.error(f"Failed to write match cache: {e}")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._by_isrc.clear()
+
+
+match_cache = MatchCache()
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.2 on 2026-10-18 09:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotify_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrackMatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('track_uri', models.CharField(max_length=100, unique=True)),
+                ('clean_uri', models.CharField(blank=True, max_length=100, null=True)),
+                ('potential_matches', models.JSONField(blank=True, default=list)),
+                ('checked_at', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.2 on 2026-10-18 09:35
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotify_app', '0002_trackmatch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversionJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_id', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('user', models.CharField(max_length=50)),
+                ('platform', models.CharField(max_length=20)),
+                ('playlist_id', models.CharField(max_length=100)),
+                ('to_clean', models.BooleanField(default=True)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='queued', max_length=20)),
+                ('stage', models.CharField(blank=True, max_length=50)),
+                ('tracks_processed', models.IntegerField(default=0)),
+                ('tracks_total', models.IntegerField(default=0)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.1.2 on 2026-10-18 09:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotify_app', '0003_conversionjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlaylistConversion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('spotify_user_id', models.CharField(max_length=100)),
+                ('source_playlist_id', models.CharField(max_length=100)),
+                ('to_clean', models.BooleanField(default=True)),
+                ('cleaned_playlist_id', models.CharField(max_length=100)),
+                ('snapshot_id', models.CharField(max_length=200)),
+                ('tracks', models.JSONField(blank=True, default=dict)),
+                ('cleaned_uris', models.JSONField(blank=True, default=list)),
+                ('result', models.JSONField(blank=True, default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('spotify_user_id', 'source_playlist_id', 'to_clean'), name='unique_playlist_conversion')],
+            },
+        ),
+    ]
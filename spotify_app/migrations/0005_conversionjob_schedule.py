@@ -0,0 +1,28 @@
+# Generated by Django 5.1.2 on 2026-10-18 10:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotify_app', '0004_playlistconversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversionjob',
+            name='estimated_completion',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversionjob',
+            name='quota_cost',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversionjob',
+            name='run_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
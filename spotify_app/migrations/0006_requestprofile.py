@@ -0,0 +1,30 @@
+# Generated by Django 5.1.2 on 2026-10-18 10:06
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotify_app', '0005_conversionjob_schedule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RequestProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('profile_id', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('method', models.CharField(max_length=10)),
+                ('path', models.CharField(max_length=500)),
+                ('status_code', models.IntegerField()),
+                ('duration', models.FloatField()),
+                ('stages', models.JSONField(blank=True, default=dict)),
+                ('samples', models.TextField(blank=True)),
+                ('sample_count', models.IntegerField(default=0)),
+                ('interval', models.FloatField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 10:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotify_app', '0006_requestprofile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trackmatch',
+            name='isrc',
+            field=models.CharField(blank=True, db_index=True, max_length=12, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 10:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotify_app', '0007_trackmatch_isrc'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='token',
+            name='refresh_lease_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.2 on 2026-10-18 10:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotify_app', '0008_token_refresh_lease_until'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversionjob',
+            name='insert_limit',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversionjob',
+            name='pending_video_ids',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -1,6 +1,9 @@
 
 # Create your models here.
+import uuid
+
 from django.db import models
+from django.utils import timezone
 
 class Token(models.Model):
     user = models.CharField(unique=True, max_length=50)
@@ -8,4 +11,102 @@ class Token(models.Model):
     access_token = models.CharField(max_length=500)
     refresh_token = models.CharField(max_length = 500)
     expires_in = models.DateTimeField()
-    token_type = models.CharField(max_length=50)
\ No newline at end of file
+    token_type = models.CharField(max_length=50)
+    # Set while one process refreshes the token, see newMusicCleaner/token_lease.py
+    refresh_lease_until = models.DateTimeField(null=True, blank=True)
+
+class TrackMatch(models.Model):
+    """Resolved clean counterpart of an explicit track, shared across users"""
+    track_uri = models.CharField(unique=True, max_length=100)
+    isrc = models.CharField(max_length=12, null=True, blank=True, db_index=True)
+    clean_uri = models.CharField(max_length=100, null=True, blank=True)
+    potential_matches = models.JSONField(default=list, blank=True)
+    checked_at = models.DateTimeField()
+
+    @property
+    def found_match(self):
+        return self.clean_uri is not None
+
+
+class ConversionJob(models.Model):
+    """Playlist conversion running in the background job queue"""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    ]
+
+    job_id = models.UUIDField(unique=True, default=uuid.uuid4, editable=False)
+    user = models.CharField(max_length=50)
+    platform = models.CharField(max_length=20)
+    playlist_id = models.CharField(max_length=100)
+    to_clean = models.BooleanField(default=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=QUEUED)
+    stage = models.CharField(max_length=50, blank=True)
+    tracks_processed = models.IntegerField(default=0)
+    tracks_total = models.IntegerField(default=0)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    run_at = models.DateTimeField(null=True, blank=True)
+    estimated_completion = models.DateTimeField(null=True, blank=True)
+    quota_cost = models.IntegerField(default=0)
+    # A conversion split over several quota days: what it may insert on its next run, and what is left
+    insert_limit = models.IntegerField(null=True, blank=True)
+    pending_video_ids = models.JSONField(default=list, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def is_finished(self):
+        return self.status in (self.SUCCEEDED, self.FAILED)
+
+    @property
+    def is_scheduled(self):
+        """Queued to start later, once there is quota for it"""
+        return self.status == self.QUEUED and self.run_at is not None and self.run_at > timezone.now()
+
+
+class PlaylistConversion(models.Model):
+    """Cleaned playlist built from a source playlist, kept in sync on re-runs.
+
+    `tracks` maps each resolved explicit source track uri to its match result and
+    `cleaned_uris` lists the tracks the conversion itself put in the cleaned
+    playlist, so a re-run only searches, adds and removes what changed.
+    """
+    spotify_user_id = models.CharField(max_length=100)
+    source_playlist_id = models.CharField(max_length=100)
+    to_clean = models.BooleanField(default=True)
+    cleaned_playlist_id = models.CharField(max_length=100)
+    snapshot_id = models.CharField(max_length=200)
+    tracks = models.JSONField(default=dict, blank=True)
+    cleaned_uris = models.JSONField(default=list, blank=True)
+    result = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['spotify_user_id', 'source_playlist_id', 'to_clean'],
+                name='unique_playlist_conversion'
+            )
+        ]
+
+
+class RequestProfile(models.Model):
+    """Sampling profile and stage timings captured for one opted-in request"""
+    profile_id = models.UUIDField(unique=True, default=uuid.uuid4, editable=False)
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=500)
+    status_code = models.IntegerField()
+    duration = models.FloatField()
+    stages = models.JSONField(default=dict, blank=True)
+    samples = models.TextField(blank=True)
+    sample_count = models.IntegerField(default=0)
+    interval = models.FloatField()
+    created_at = models.DateTimeField(auto_now_add=True)
@@ -0,0 +1,65 @@
+import logging
+from typing import Any, AsyncIterable, AsyncIterator, Iterable, Iterator, Type, Union
+
+import orjson
+from django.http import StreamingHttpResponse
+from ninja import Schema
+from ninja.renderers import BaseRenderer
+from ninja.responses import NinjaJSONEncoder
+
+logger = logging.getLogger(__name__)
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+# Datetimes go through NinjaJSONEncoder so they keep the format of the default renderer
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+
+class ORJSONRenderer(BaseRenderer):
+    """JSON renderer serializing with orjson, falling back to NinjaJSONEncoder for other types"""
+    media_type = 'application/json'
+
+    def __init__(self):
+        self._encoder = NinjaJSONEncoder()
+
+    def render(self, request, data: Any, *, response_status: int) -> bytes:
+        return orjson.dumps(data, default=self._encoder.default, option=ORJSON_OPTIONS)
+
+
+def iter_ndjson(items: Iterable[Any], schema: Type[Schema]) -> Iterator[bytes]:
+    """One line per item, validated through `schema` as the JSON endpoint would.
+
+    The status line is long gone when the source fails halfway, so the error
+    ends the stream as an {"error": ...} line instead.
+    """
+    encoder = NinjaJSONEncoder()
+    try:
+        for item in items:
+            data = schema.model_validate(item).model_dump()
+            yield orjson.dumps(data, default=encoder.default, option=ORJSON_OPTIONS | orjson.OPT_APPEND_NEWLINE)
+    except Exception as e:
+        logger.error(f"Failed to stream items: {e}")
+        yield orjson.dumps({'error': str(e)}, option=orjson.OPT_APPEND_NEWLINE)
+
+
+async def aiter_ndjson(items: AsyncIterable[Any], schema: Type[Schema]) -> AsyncIterator[bytes]:
+    """iter_ndjson for an async source, streamed by the async endpoints"""
+    encoder = NinjaJSONEncoder()
+    try:
+        async for item in items:
+            data = schema.model_validate(item).model_dump()
+            yield orjson.dumps(data, default=encoder.default, option=ORJSON_OPTIONS | orjson.OPT_APPEND_NEWLINE)
+    except Exception as e:
+        logger.error(f"Failed to stream items: {e}")
+        yield orjson.dumps({'error': str(e)}, option=orjson.OPT_APPEND_NEWLINE)
+
+
+def ndjson_response(items: Union[Iterable[Any], AsyncIterable[Any]], schema: Type[Schema]) -> StreamingHttpResponse:
+    if hasattr(items, '__aiter__'):
+        lines = aiter_ndjson(items, schema)
+    else:
+        lines = iter_ndjson(items, schema)
+    response = StreamingHttpResponse(lines, content_type=NDJSON_MEDIA_TYPE)
+    # Tell proxies not to buffer, the point is getting the first tracks out early
+    response['X-Accel-Buffering'] = 'no'
+    return response
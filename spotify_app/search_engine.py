@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Coroutine, Dict, List
+
+import httpx
+import orjson
+
+from newMusicCleaner.concurrency import AIMDLimiter
+from newMusicCleaner.matching import normalize_query
+from newMusicCleaner.metrics import (
+    Counter,
+    InstrumentedTransport,
+    UPSTREAM_RESPONSE_BYTES,
+    UPSTREAM_RETRIES,
+    endpoint_label
+)
+from newMusicCleaner.singleflight import AsyncSingleFlight
+from newMusicCleaner.settings import (
+    CONCURRENCY_BACKOFF,
+    SPOTIFY_CONCURRENCY_INITIAL,
+    SPOTIFY_LATENCY_TARGET,
+    SPOTIFY_SEARCH_RATE,
+    SPOTIFY_SEARCH_BURST,
+    SPOTIFY_SEARCH_CONCURRENCY,
+    SPOTIFY_SEARCH_MAX_RETRIES
+)
+
+logger = logging.getLogger(__name__)
+
+SEARCH_URL = 'https://api.spotify.com/v1/search'
+
+
+def compact_track(item: Dict) -> Dict:
+    """The fields of a search result track that matching and the results page use"""
+    return {
+        'name': item['name'],
+        'uri': item['uri'],
+        'explicit': item['explicit'],
+        'artists': [{'id': artist.get('id'), 'name': artist['name']} for artist in item['artists']],
+        'external_urls': {'spotify': item['external_urls'].get('spotify')},
+        'external_ids': {'isrc': item.get('external_ids', {}).get('isrc')},
+    }
+
+
+class RateLimitedError(Exception):
+    """Raised when a search is still rate limited after every retry"""
+
+    def __init__(self, query: str, retry_after: float):
+        super().__init__(f"Rate limited searching '{query}', retry after {retry_after}s")
+        self.query = query
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Token bucket shared by every search running on the engine loop.
+
+    `pause` blocks all callers until the given delay has passed, which is how a
+    Retry-After from one request holds back the whole process.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = None
+        self._blocked_until = 0.0
+
+    async def acquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if self._updated is None:
+                self._updated = now
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            if self._blocked_until > now:
+                await asyncio.sleep(self._blocked_until - now)
+                continue
+
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        now = asyncio.get_running_loop().time()
+        self._blocked_until = max(self._blocked_until, now + seconds)
+        self._tokens = 0.0
+
+
+class SpotifySearchEngine:
+    """Runs Spotify track searches concurrently on one background event loop.
+
+    The loop, HTTP client, rate limiter and the adaptive concurrency limit are
+    shared by every SpotifyService in the process. Sync callers hand coroutines over with `submit` and get a
+    concurrent.futures.Future back. Identical searches in flight at the same
+    time, from any session, share one request.
+    """
+
+    def __init__(self, rate: float = SPOTIFY_SEARCH_RATE, burst: int = SPOTIFY_SEARCH_BURST,
+                 max_concurrency: int = SPOTIFY_SEARCH_CONCURRENCY,
+                 max_retries: int = SPOTIFY_SEARCH_MAX_RETRIES):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.search_url = SEARCH_URL
+        # Also taken by SpotifyService's playlist page reads, the rate limit is per app
+        self.concurrency = AIMDLimiter(
+            'spotify', min(SPOTIFY_CONCURRENCY_INITIAL, max_concurrency), 1, max_concurrency,
+            SPOTIFY_LATENCY_TARGET, CONCURRENCY_BACKOFF
+        )
+        self._searches = AsyncSingleFlight()
+        self._loop = None
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name='spotify-search', daemon=True)
+                thread.start()
+                self._client = httpx.AsyncClient(
+                    timeout=httpx.Timeout(10.0),
+                    transport=InstrumentedTransport(
+                        'spotify',
+                        limits=httpx.Limits(max_connections=self.max_concurrency)
+                    )
+                )
+                self._loop = loop
+        return self._loop
+
+    def submit(self, coro: Coroutine) -> Future:
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    @property
+    def coalesced(self) -> int:
+        """Searches answered by another caller's request instead of their own"""
+        return self._searches.coalesced
+
+    async def search(self, access_token: str, query: str, limit: int = 50, offset: int = 0) -> List[Dict]:
+        """Search tracks, joining an identical search that is already in flight.
+
+        Searches are coalesced on the query, limit and offset alone, assuming
+        results don't depend on the user: whichever caller's token started the
+        request answers everyone waiting on it. No `market` is sent, so
+        Spotify filters by the country of the token's account; two users
+        searching the same query at once are assumed to share a market, and
+        at worst one gets a match that isn't playable in their country.
+        """
+        return await self._searches.do(
+            (normalize_query(query), limit, offset),
+            lambda: self._search(access_token, query, limit, offset)
+        )
+
+    async def _search(self, access_token: str, query: str, limit: int, offset: int) -> List[Dict]:
+        """Search tracks, waiting out 429s instead of reporting them as empty results"""
+        retry_after = 1.0
+
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            async with self.concurrency.aslot() as call:
+                response = await self._client.get(
+                    self.search_url,
+                    params={'q': query, 'type': 'track', 'limit': limit, 'offset': offset},
+                    headers={'Authorization': f"Bearer {access_token}"}
+                )
+                call.rate_limited = response.status_code == 429
+                call.failed = response.status_code >= 500
+
+            if response.status_code == 429:
+                retry_after = float(response.headers.get('Retry-After', 2 ** attempt))
+                logger.warning(f"Spotify search rate limited, retrying in {retry_after}s")
+                self.bucket.pause(retry_after)
+                if attempt < self.max_retries:
+                    UPSTREAM_RETRIES.inc(service='spotify', endpoint=endpoint_label(self.search_url))
+                continue
+
+            if response.status_code >= 500 and attempt < self.max_retries:
+                logger.warning(f"Spotify search failed with {response.status_code}, retrying")
+                UPSTREAM_RETRIES.inc(service='spotify', endpoint=endpoint_label(self.search_url))
+                await asyncio.sleep(2 ** attempt)
+                continue
+
+            response.raise_for_status()
+            UPSTREAM_RESPONSE_BYTES.observe(
+                len(response.content), service='spotify', endpoint=endpoint_label(self.search_url)
+            )
+            # Full track objects are large and mostly unused, only the compact form is kept
+            return [compact_track(item) for item in orjson.loads(response.content)['tracks']['items'] if item]
+
+        raise RateLimitedError(query, retry_after)
+
+
+search_engine = SpotifySearchEngine()
+
+Counter(
+    'spotify_searches_coalesced_total',
+    'Spotify searches answered by an identical search already in flight',
+    function=lambda: search_engine.coalesced
+)
@@ -1,3 +1,4 @@
+from datetime import datetime
 from typing import List, Dict, Optional
 from ninja import Schema
 
@@ -24,6 +25,11 @@ class PlaylistResponse(Schema):
     external_urls: Dict[str, str]
 
 
+class PlaylistPageResponse(Schema):
+    items: List[PlaylistResponse]
+    next_cursor: Optional[str]
+
+
 class UserResponse(Schema):
     id: str
     display_name: str
@@ -52,3 +58,19 @@ class PlaylistConversionResponse(Schema):
     num_still_missing: int
     still_missing: List[RemainingTrackSchema]
     potential_matches: Dict[str, List[PotentialMatchSchema]]
+    num_search_failed: int = 0
+    search_failed: List[RemainingTrackSchema] = []
+
+
+class ConversionJobResponse(Schema):
+    job_id: str
+    platform: str
+    playlist_id: str
+    status: str
+    stage: str
+    tracks_processed: int
+    tracks_total: int
+    result: Optional[Dict] = None
+    error: Optional[str] = None
+    run_at: Optional[datetime] = None
+    estimated_completion: Optional[datetime] = None
@@ -1,24 +1,50 @@
 import logging
-from typing import Dict, List
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 from urllib.parse import quote
 import concurrent.futures
+from collections import Counter, deque
 from concurrent.futures import ThreadPoolExecutor
 
 import spotipy
-from fuzzywuzzy import fuzz
 from spotipy.oauth2 import SpotifyOAuth
 
-from spotify_app.extras import get_spotify_client
+from newMusicCleaner.matching import artist_names, match_spotify_track
+from newMusicCleaner.metrics import SEARCH_CANDIDATES
+from newMusicCleaner.playlist_index import PlaylistIndex
+from newMusicCleaner.profiling import stage
+from newMusicCleaner.session_cache import SessionCache
+from newMusicCleaner.settings import SPOTIFY_PAGE_WORKERS, SPOTIFY_SEARCH_DEPTHS
+from spotify_app.extras import fresh_tokens, get_spotify_client
+from spotify_app.match_cache import match_cache
+from spotify_app.models import PlaylistConversion
+from spotify_app.search_engine import search_engine
 
 logger = logging.getLogger(__name__)
 
+# Long-lived pool shared by every service instance, the concurrency slots bound the reads in flight
+page_executor = ThreadPoolExecutor(max_workers=SPOTIFY_PAGE_WORKERS, thread_name_prefix='spotify-pages')
+
 
 class SpotifyService:
     def __init__(self, session_id=None):
         self._spotify = None
         self._user = None
         self.session_id = session_id
-        self.max_workers = 10
+        self.session_cache = SessionCache('spotify', session_id)
+
+    @property
+    def max_workers(self) -> int:
+        """Spotify calls to run at once, following the adaptive limit shared with the search engine"""
+        return search_engine.concurrency.limit
+
+    def _read(self, method: Callable, *args, **kwargs):
+        """Run a spotipy read holding one of the shared Spotify concurrency slots"""
+        with search_engine.concurrency.slot() as call:
+            try:
+                return method(*args, **kwargs)
+            except spotipy.SpotifyException as e:
+                call.rate_limited = e.http_status == 429
+                raise
 
     def initialize_client(self):
         if not self._spotify:
@@ -27,22 +53,37 @@ class SpotifyService:
                 raise Exception("Failed to initialize Spotify client")
         return self._spotify
 
+    def _search_token(self) -> str:
+        """The session's current access token for the search engine.
+
+        Read again for every batch of searches, so a long conversion moves on
+        to the refreshed token instead of searching with an expired one.
+        """
+        tokens = fresh_tokens(self.session_id)
+        if not tokens:
+            raise Exception("Spotify session is no longer authenticated")
+        return tokens.access_token
+
     def get_user(self) -> Dict:
         """Get current user information"""
         if self._user is None:
             try:
-                # Initialize the client if not already done
-                self.initialize_client()
-                self._user = self._spotify.current_user()
+                self._user = self.session_cache.get('user', self._fetch_user)
             except Exception as e:
-                print(f"Failed to get user: {e}")
+                logger.error(f"Failed to get user: {e}")
                 raise
         return self._user
 
+    def _fetch_user(self) -> Dict:
+        # Initialize the client if not already done
+        self.initialize_client()
+        return self._spotify.current_user()
+
     def get_playlists(self) -> List[Dict]:
+        """All of the user's playlists; pages after the first are fetched concurrently"""
         try:
             self.initialize_client()
-            results = self._spotify.current_user_playlists()
+            results = self._spotify.current_user_playlists(limit=50)
 
             if not results:
                 logger.error("No results returned from Spotify API")
@@ -52,28 +93,35 @@ class SpotifyService:
                 logger.error(f"Unexpected API response format: {results}")
                 return []
 
+            pages = [results]
+            offsets = range(50, results.get('total') or 0, 50)
+            if offsets:
+                with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                    pages.extend(executor.map(
+                        lambda offset: self._read(self._spotify.current_user_playlists, limit=50, offset=offset),
+                        offsets
+                    ))
+
             playlists = []
 
-            for playlist in results['items']:
-                if not playlist:
-                    logger.warning("Encountered None playlist in results")
-                    continue
-
-                try:
-                    playlist_data = {
-                        'id': playlist['id'],
-                        'name': playlist['name'],
-                        'external_urls': playlist['external_urls'],
-                        'tracks': None
-                    }
-                    playlists.append(playlist_data)
-                except KeyError as ke:
-                    logger.error(f"Missing key in playlist data: {ke}")
-                    logger.debug(f"Playlist object: {playlist}")
-                    continue
-                except Exception as e:
-                    logger.error(f"Error processing playlist: {e}")
-                    continue
+            for page in pages:
+                for playlist in page.get('items', []):
+                    if not playlist:
+                        logger.warning("Encountered None playlist in results")
+                        continue
+
+                    try:
+                        playlist_data = {
+                            'id': playlist['id'],
+                            'name': playlist['name'],
+                            'external_urls': playlist['external_urls'],
+                            'tracks': None
+                        }
+                        playlists.append(playlist_data)
+                    except KeyError as ke:
+                        logger.error(f"Missing key in playlist data: {ke}")
+                        logger.debug(f"Playlist object: {playlist}")
+                        continue
 
             return playlists
 
@@ -81,170 +129,366 @@ class SpotifyService:
             logger.error(f"Failed to fetch playlists: {e}", exc_info=True)
             raise
 
+    def playlist_index(self) -> PlaylistIndex:
+        """The user's playlists, cached and paged"""
+        return PlaylistIndex('spotify', self.session_id, self.get_playlists)
+
+    def invalidate_cache(self) -> None:
+        """Drop the cached user and playlists of this session, e.g. after logging in again"""
+        self.session_cache.invalidate('user')
+        self.playlist_index().invalidate()
+
     def contain_same_artists(self, first: Dict, second: Dict) -> bool:
         """Check if two tracks have the same artists"""
-        if len(first['artists']) != len(second['artists']):
-            return False
-
-        for i in range(len(first['artists'])):
-            if first['artists'][i]['name'] != second['artists'][i]['name']:
-                return False
-        return True
+        return artist_names(first) == artist_names(second)
+
+    @staticmethod
+    def _page_tracks(results: Dict) -> List[Dict]:
+        # Appends tracks if they exist in items
+        return [item['track'] for item in results.get('items', []) if item.get('track')]
+
+    def iter_playlist_pages(self, playlist_id: str, page_size: int = 100) -> Iterator[List[Dict]]:
+        """Yield a playlist's tracks page by page, in playlist order.
+
+        The first page reports the total, so the remaining offsets are fetched
+        concurrently while the caller is already working on earlier pages.
+        """
+        self.initialize_client()
+        with stage('fetch_tracks'):
+            results = self._read(self._spotify.playlist_items, playlist_id, limit=page_size)
+        yield self._page_tracks(results)
+
+        offsets = deque(range(page_size, results.get('total') or 0, page_size))
+        pending = deque()
+        try:
+            while offsets or pending:
+                # Keep a bounded window of pages in flight ahead of the consumer
+                while offsets and len(pending) < self.max_workers * 2:
+                    pending.append(page_executor.submit(
+                        self._read, self._spotify.playlist_items, playlist_id, limit=page_size, offset=offsets.popleft()
+                    ))
+                with stage('fetch_tracks'):
+                    results = pending.popleft().result()
+                yield self._page_tracks(results)
+        finally:
+            # Pages nobody will read anymore, e.g. the caller stopped early
+            for future in pending:
+                future.cancel()
+
+    def iter_playlist_tracks(self, playlist_id: str) -> Iterator[Dict]:
+        for page in self.iter_playlist_pages(playlist_id):
+            yield from page
 
     def get_playlist_tracks(self, playlist_id: str) -> List[Dict]:
         try:
-            tracks = []
-            self.initialize_client()
-            results = self._spotify.playlist_items(playlist_id)
-
-            while results:
-                # Appends tracks if they exist in items
-                for item in results.get('items', []):
-                    track = item.get('track')
-                    if track:
-                        tracks.append(track)
-
-                results = self._spotify.next(results) if results.get('next') else None
-
+            tracks = list(self.iter_playlist_tracks(playlist_id))
         except Exception as e:
-            print(f"Failed to get tracks: {e}")
+            logger.error(f"Failed to get tracks of {playlist_id}: {e}")
             raise
         return tracks
 
-    def contain_same_artists(self, first: Dict, second: Dict) -> bool:
-        """Check if two tracks have the same artists"""
-        if len(first['artists']) != len(second['artists']):
-            return False
+    def process_search_results(self, track: Dict, search_results: List[Dict]) -> Dict:
+        """Pick the clean match for a track out of its search results"""
+        return match_spotify_track(track, search_results)
 
-        for i in range(len(first['artists'])):
-            if first['artists'][i]['name'] != second['artists'][i]['name']:
-                return False
-        return True
+    async def search_and_process_track_async(self, track: Dict, access_token: str) -> Dict:
+        """Search for a single track on the shared search engine and process results.
+
+        Results are fetched in SPOTIFY_SEARCH_DEPTHS steps: the next page is only
+        requested when the results so far hold no match.
+        """
+        query = track['query'].replace('#', '').strip()
+        search_results = []
+
+        for depth in SPOTIFY_SEARCH_DEPTHS:
+            offset = len(search_results)
+            try:
+                with stage('search_request'):
+                    page = await search_engine.search(access_token, query, limit=depth - offset, offset=offset)
+            except Exception as e:
+                logger.error(f"Failed to search track {query}: {e}")
+                return {
+                    'track': track,
+                    'found_match': False,
+                    'converted_uri': None,
+                    'potential_matches': [],
+                    'search_failed': True,
+                }
+            search_results.extend(page)
+
+            with stage('match'):
+                result = self.process_search_results(track, search_results)
+            if result['found_match'] or len(page) < depth - offset:
+                break
+
+        SEARCH_CANDIDATES.observe(len(search_results), service='spotify')
+        return result
 
     def search_and_process_track(self, track: Dict) -> Dict:
         """Search for a single track and process results"""
-        query = track['query'].replace('#', '').strip()
+        return search_engine.submit(self.search_and_process_track_async(track, self._search_token())).result()
 
+    def _load_conversion(self, playlist_id: str, to_clean: bool) -> Optional[PlaylistConversion]:
         try:
-            self.initialize_client()
-            search_results = self._spotify.search(q=query, type='track', limit=50)['tracks']['items']
+            return PlaylistConversion.objects.filter(
+                spotify_user_id=self.get_user()['id'],
+                source_playlist_id=playlist_id,
+                to_clean=to_clean
+            ).first()
         except Exception as e:
-            logger.error(f"Failed to search track {query}: {e}")
-            return {
-                'track': track,
-                'found_match': False,
-                'converted_uri': None,
-                'potential_matches': [],
-            }
+            logger.error(f"Failed to load previous conversion of {playlist_id}: {e}")
+            return None
 
-        found_match = False
-        converted_uri = None
-        potential_matches = []
-
-        for result in search_results:
-            if not result['explicit'] and self.contain_same_artists(track, result):
-                similarity = fuzz.ratio(result['name'], track['name'])
-                if similarity == 100:
-                    found_match = True
-                    converted_uri = result['uri']
-                    break
-                elif similarity > 1:
-                    potential_matches.append({
-                        'name': result['name'],
-                        'artists': result['artists'][0]['name'],
-                        'link': result['external_urls']['spotify'],
-                        'uri': result['uri'],
-                        'original_track_uri': track['uri'],
-                        'original_track_link': track['link']
-                    })
-
-        return {
-            'track': track,
-            'found_match': found_match,
-            'converted_uri': converted_uri,
-            'potential_matches': potential_matches,
-        }
-
-    def convert_playlist(self, playlist_id: str, to_clean: bool = True) -> Dict:
+    def _save_conversion(self, playlist_id: str, to_clean: bool, **fields) -> None:
+        try:
+            PlaylistConversion.objects.update_or_create(
+                spotify_user_id=self.get_user()['id'],
+                source_playlist_id=playlist_id,
+                to_clean=to_clean,
+                defaults=fields
+            )
+        except Exception as e:
+            logger.error(f"Failed to save conversion of {playlist_id}: {e}")
+
+    @staticmethod
+    def _diff_tracks(current: List[str], wanted: List[str]) -> Tuple[Counter, List[str]]:
+        """Occurrences of each uri to remove from a playlist holding `current`, and the uris to add after, so it holds `wanted`"""
+        current_counts, wanted_counts = Counter(current), Counter(wanted)
+        missing = wanted_counts - current_counts
+
+        additions = []
+        for uri in wanted:
+            if missing[uri]:
+                additions.append(uri)
+                missing[uri] -= 1
+        return current_counts - wanted_counts, additions
+
+    def _playlist_uris(self, playlist_id: str) -> List[str]:
+        """Track uris of a playlist as it is now, in order"""
+        uris = []
+        results = self._read(self._spotify.playlist_items, playlist_id, fields='items(track(uri)),next', limit=100)
+        while results:
+            uris.extend((item.get('track') or {}).get('uri') for item in results['items'])
+            results = self._read(self._spotify.next, results) if results.get('next') else None
+        return uris
+
+    def _remove_items(self, playlist_id: str, removals: Counter) -> None:
+        """Remove the given number of occurrences of each uri, by position.
+
+        The conversion's own tracks were added before anything the user added
+        later, so the first occurrences are the ones to remove and copies the
+        user added by hand or through add_additional_songs stay.
+        """
+        left = Counter(removals)
+        positions = []
+        for position, uri in enumerate(self._playlist_uris(playlist_id)):
+            if left[uri]:
+                positions.append((position, uri))
+                left[uri] -= 1
+
+        # Highest positions first, so a request never shifts the positions of the next one
+        positions.sort(reverse=True)
+        with stage('remove_items'):
+            for i in range(0, len(positions), 100):
+                items = {}
+                for position, uri in positions[i:i + 100]:
+                    items.setdefault(uri, []).append(position)
+                self._spotify.playlist_remove_specific_occurrences_of_items(
+                    playlist_id, [{'uri': uri, 'positions': uri_positions} for uri, uri_positions in items.items()]
+                )
+
+    def _has_playlist(self, playlist_id: str) -> bool:
+        """Whether the user still has a playlist; deleting one in Spotify only unfollows it"""
+        try:
+            return self._read(self._spotify.playlist_is_following, playlist_id, [self.get_user()['id']])[0]
+        except spotipy.SpotifyException as e:
+            if e.http_status == 404:
+                return False
+            raise
+
+    def _add_items(self, playlist_id: str, uris: List[str]) -> None:
+        with stage('add_items'):
+            for i in range(0, len(uris), 100):
+                batch = uris[i:i + 100]
+                if batch:
+                    self._spotify.playlist_add_items(playlist_id, batch)
+
+    def convert_playlist(self, playlist_id: str, to_clean: bool = True,
+                         progress: Optional[Callable[[str, int, int], None]] = None) -> Dict:
+        """Build a cleaned copy of a playlist, or bring the one from an earlier run up to date.
+
+        A re-run reuses the stored per-track results, so only tracks added to the
+        source since the last run are searched, and the existing cleaned playlist
+        only gets the changed tracks added or removed.
+        """
+        progress = progress or (lambda stage, processed=0, total=0: None)
         try:
             self.initialize_client()
+            progress('fetching_tracks')
             # Get original playlist
-            original_playlist = self._spotify.playlist(playlist_id)
+            with stage('fetch_tracks'):
+                original_playlist = self._spotify.playlist(playlist_id)
 
-            # Get tracks
-            tracks = self.get_playlist_tracks(playlist_id)
+            conversion = self._load_conversion(playlist_id, to_clean)
+            # Only found matches are reused as they are; misses go through the match cache and its miss TTL
+            known_tracks = {
+                uri: match for uri, match in (conversion.tracks if conversion else {}).items() if match['found_match']
+            }
+            if conversion and not self._has_playlist(conversion.cleaned_playlist_id):
+                # The cleaned playlist was deleted since, build a new one
+                conversion = None
+            if conversion and conversion.result and conversion.snapshot_id == original_playlist['snapshot_id']:
+                # The source hasn't changed since the last run
+                return conversion.result
 
             # Process and categorize tracks
             clean_tracks_uris = []
             tracks_to_convert = []
+            cached_results = []
+            isrc_results = []
+            futures = []
+
+            # Tracks stream in page by page, so searches start while later pages are still loading
+            for page in self.iter_playlist_pages(playlist_id):
+                page_to_convert = []
+                access_token = None
+
+                # iterates each track, adding explicit to tracks_to_convert list
+                for track in page:
+                    if not track['explicit']:
+                        clean_tracks_uris.append(track['uri'])
+                    else:
+                        page_to_convert.append({
+                            'query': f"{track['name']} {track['artists'][0]['name']}",
+                            'name': track['name'],
+                            'artists': track['artists'],
+                            'uri': track['uri'],
+                            'isrc': track.get('external_ids', {}).get('isrc'),
+                            'link': track['external_urls']['spotify']
+                        })
+
+                # Explicit tracks resolved by the last run or by any earlier conversion skip the search
+                cached_matches = {
+                    track['uri']: known_tracks[track['uri']]
+                    for track in page_to_convert if track['uri'] in known_tracks
+                }
+                cached_matches.update(match_cache.get_many(
+                    track['uri'] for track in page_to_convert if track['uri'] not in cached_matches
+                ))
+                # So do other releases of a recording resolved before, found by ISRC
+                isrc_matches = match_cache.get_many_by_isrc(
+                    track['isrc'] for track in page_to_convert
+                    if track['uri'] not in cached_matches and track['isrc']
+                )
+                for track in page_to_convert:
+                    if track['uri'] in cached_matches:
+                        cached_results.append({'track': track, **cached_matches[track['uri']]})
+                    elif track['isrc'] in isrc_matches:
+                        isrc_results.append({'track': track, **isrc_matches[track['isrc']]})
+                    else:
+                        access_token = access_token or self._search_token()
+                        # All searches run concurrently on the shared, rate limited engine
+                        futures.append(search_engine.submit(self.search_and_process_track_async(track, access_token)))
 
-            # iterates each track, adding explicit to tracks_to_convert list
-            for track in tracks:
-                if not track['explicit']:
-                    clean_tracks_uris.append(track['uri'])
-                else:
-                    tracks_to_convert.append({
-                        'query': f"{track['name']} {track['artists'][0]['name']}",
-                        'name': track['name'],
-                        'artists': track['artists'],
-                        'uri': track['uri'],
-                        'link': track['external_urls']['spotify']
-                    })
+                tracks_to_convert.extend(page_to_convert)
+                progress('fetching_tracks', len(cached_results) + len(isrc_results), len(tracks_to_convert))
 
             # Parallel search and match
             converted_tracks_uris = []
             remaining_songs = []
+            failed_songs = []
             potential_matches = {}
 
-            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-                # Submit all searches to the thread pool
-                future_to_track = {
-                    executor.submit(self.search_and_process_track, track): track
-                    for track in tracks_to_convert
-                }
+            results = cached_results + isrc_results
+            progress('searching', len(results), len(tracks_to_convert))
+
+            searched = []
+            with stage('search'):
+                for future in concurrent.futures.as_completed(futures):
+                    searched.append(future.result())
+                    progress('searching', len(results) + len(searched), len(tracks_to_convert))
 
-                # Process results as they complete
-                for future in concurrent.futures.as_completed(future_to_track):
-                    result = future.result()
+            # ISRC matches are stored under their own URI so the next run finds them directly
+            match_cache.set_many(isrc_results + [result for result in searched if not result.get('search_failed')])
+            results.extend(searched)
 
-                    if result['found_match']:
-                        converted_tracks_uris.append(result['converted_uri'])
+            for result in results:
+                if result['found_match']:
+                    converted_tracks_uris.append(result['converted_uri'])
+                else:
+                    track = result['track']
+                    remaining_song = {
+                        'name': track['name'],
+                        'artists': track['artists'][0]['name'],
+                        'query_url': f"https://open.spotify.com/search/{quote(track['query'])}"
+                    }
+                    if result.get('search_failed'):
+                        failed_songs.append(remaining_song)
+                    elif result['potential_matches']:
+                        potential_matches[track['name']] = result['potential_matches']
                     else:
-                        track = result['track']
-                        if result['potential_matches']:
-                            potential_matches[track['name']] = result['potential_matches']
-                        else:
-                            remaining_songs.append({
-                                'name': track['name'],
-                                'artists': track['artists'][0]['name'],
-                                'query_url': f"https://open.spotify.com/search/{quote(track['query'])}"
-                            })
-
-            user = self.get_user()
-            playlist_name = f"{original_playlist['name']} ({'Cleaned' if to_clean else 'explicit'})"
-            new_playlist = self._spotify.user_playlist_create(
-                user['id'],
-                playlist_name,
-                public=True
-            )
+                        remaining_songs.append(remaining_song)
 
             all_tracks = clean_tracks_uris + converted_tracks_uris
-            for i in range(0, len(all_tracks), 100):
-                batch = all_tracks[i:i + 100]
-                if batch:
-                    self._spotify.playlist_add_items(new_playlist['id'], batch)
 
-            return {
-                'playlist_id': new_playlist['id'],
+            if conversion:
+                # Only tracks this conversion added are touched; songs the user added by hand stay
+                cleaned_playlist_id = conversion.cleaned_playlist_id
+                removals, additions = self._diff_tracks(conversion.cleaned_uris, all_tracks)
+                progress('adding_tracks', len(tracks_to_convert), len(tracks_to_convert))
+                if removals:
+                    self._remove_items(cleaned_playlist_id, removals)
+                self._add_items(cleaned_playlist_id, additions)
+            else:
+                progress('creating_playlist', len(tracks_to_convert), len(tracks_to_convert))
+                user = self.get_user()
+                playlist_name = f"{original_playlist['name']} ({'Cleaned' if to_clean else 'explicit'})"
+                with stage('create_playlist'):
+                    new_playlist = self._spotify.user_playlist_create(
+                        user['id'],
+                        playlist_name,
+                        public=True
+                    )
+                cleaned_playlist_id = new_playlist['id']
+                self.playlist_index().invalidate()
+
+                progress('adding_tracks', len(tracks_to_convert), len(tracks_to_convert))
+                self._add_items(cleaned_playlist_id, all_tracks)
+
+            result = {
+                'playlist_id': cleaned_playlist_id,
                 'num_original_clean': len(clean_tracks_uris),
                 'num_clean_found': len(converted_tracks_uris),
                 'num_still_missing': len(remaining_songs),
                 'still_missing': remaining_songs,
                 'potential_matches': potential_matches,
+                'num_search_failed': len(failed_songs),
+                'search_failed': failed_songs,
             }
 
+            # Failed searches aren't stored, so the next run tries them again
+            self._save_conversion(
+                playlist_id,
+                to_clean,
+                cleaned_playlist_id=cleaned_playlist_id,
+                snapshot_id=original_playlist['snapshot_id'],
+                tracks={
+                    match['track']['uri']: {
+                        'found_match': match['found_match'],
+                        'converted_uri': match['converted_uri'],
+                        'potential_matches': match['potential_matches'],
+                    }
+                    for match in results if not match.get('search_failed')
+                },
+                cleaned_uris=all_tracks,
+                # A run with failed searches must not short-circuit the next one
+                result=result if not failed_songs else {}
+            )
+            return result
+
         except Exception as e:
-            logging.error(f"Failed to convert playlist: {e}")
+            logger.error(f"Failed to convert playlist: {e}")
+            raise
 
     def add_additional_songs(self, playlist_id: str, song_uris: List) -> str:
         try:
@@ -0,0 +1,71 @@
+import asyncio
+from unittest import mock
+
+import httpx
+from django.test import SimpleTestCase
+
+from spotify_app.async_service import AsyncSpotifyService
+
+
+class AsyncSpotifyServiceTests(SimpleTestCase):
+    def setUp(self):
+        self.requests = []
+        self.release = None
+        client = httpx.AsyncClient(transport=httpx.MockTransport(self.handle))
+        patcher = mock.patch('newMusicCleaner.async_http.async_client', return_value=client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.service = AsyncSpotifyService('session')
+        self.service._access_token = 'token'
+
+    async def handle(self, request):
+        self.requests.append(request)
+        offset = int(request.url.params.get('offset', 0))
+        limit = int(request.url.params['limit'])
+        if self.release and offset >= 20:
+            await self.release.wait()
+        if request.url.path == '/v1/me/playlists':
+            return httpx.Response(200, json={
+                'items': [
+                    {'id': f"playlist-{n}", 'name': f"Playlist {n}", 'external_urls': {}}
+                    for n in range(offset, min(offset + limit, 120))
+                ],
+                'total': 120,
+            })
+        return httpx.Response(200, json={
+            'items': [{'track': {'uri': f"spotify:track:{n}"}} for n in range(offset, min(offset + limit, 250))],
+            'total': 250,
+        })
+
+    async def test_playlist_tracks_come_in_playlist_order(self):
+        tracks = await self.service.get_playlist_tracks('playlist')
+
+        self.assertEqual([track['uri'] for track in tracks], [f"spotify:track:{n}" for n in range(250)])
+        self.assertEqual(self.requests[0].headers['Authorization'], 'Bearer token')
+
+    async def test_every_page_of_playlists_is_fetched(self):
+        playlists = await self.service.get_playlists()
+
+        self.assertEqual([playlist['id'] for playlist in playlists], [f"playlist-{n}" for n in range(120)])
+        self.assertEqual(len(self.requests), 3)
+
+    async def test_pages_not_read_are_cancelled_when_the_caller_stops(self):
+        self.release = asyncio.Event()
+        tasks = []
+        ensure_future = asyncio.ensure_future
+
+        def track(coro):
+            tasks.append(ensure_future(coro))
+            return tasks[-1]
+
+        pages = self.service.iter_playlist_pages('playlist', page_size=10)
+        with mock.patch('spotify_app.async_service.asyncio.ensure_future', side_effect=track):
+            await pages.__anext__()
+            await pages.__anext__()
+
+        await pages.aclose()
+        await asyncio.sleep(0)
+
+        self.assertTrue(tasks)
+        self.assertTrue(all(task.done() for task in tasks))
+        self.assertTrue(any(task.cancelled() for task in tasks))
@@ -0,0 +1,116 @@
+from datetime import timedelta
+from unittest import mock
+
+import spotipy
+from django.test import TestCase
+from django.utils import timezone
+
+from spotify_app.jobs import SPOTIFY, JobQueueFull, LocalJobQueue, run_job
+from spotify_app.models import ConversionJob
+
+
+def create_job(**fields):
+    return ConversionJob.objects.create(user='session', platform=SPOTIFY, playlist_id='playlist', **fields)
+
+
+class RunJobTests(TestCase):
+    @mock.patch('spotify_app.jobs.get_service')
+    def test_finished_conversion_stores_its_result(self, get_service):
+        get_service.return_value.convert_playlist.return_value = {'playlist_id': 'cleaned'}
+        job = create_job()
+
+        run_job(job)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ConversionJob.SUCCEEDED)
+        self.assertEqual(job.stage, 'done')
+        self.assertEqual(job.result, {'playlist_id': 'cleaned'})
+        get_service.return_value.convert_playlist.assert_called_once_with('playlist', True, progress=mock.ANY)
+
+    @mock.patch('spotify_app.spotify_service.get_spotify_client')
+    def test_failed_conversion_records_its_error(self, get_spotify_client):
+        get_spotify_client.return_value.playlist.side_effect = spotipy.SpotifyException(
+            404, -1, 'Resource not found'
+        )
+        job = create_job()
+
+        run_job(job)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ConversionJob.FAILED)
+        self.assertIn('Resource not found', job.error)
+
+
+class LocalJobQueueTests(TestCase):
+    def setUp(self):
+        self.queue = LocalJobQueue(max_workers=2, max_pending=3, stale_after=60)
+        self.queue._executor = mock.MagicMock()
+
+    def age(self, job, seconds):
+        ConversionJob.objects.filter(pk=job.pk).update(updated_at=timezone.now() - timedelta(seconds=seconds))
+
+    def test_due_jobs_are_claimed_oldest_first_up_to_the_free_workers(self):
+        jobs = [create_job() for _ in range(3)]
+        for minutes, job in zip((1, 3, 2), jobs):
+            ConversionJob.objects.filter(pk=job.pk).update(created_at=timezone.now() - timedelta(minutes=minutes))
+
+        self.queue._claim()
+
+        self.assertEqual(
+            [call.args for call in self.queue._executor.submit.call_args_list],
+            [(self.queue._run, jobs[1].pk), (self.queue._run, jobs[2].pk)]
+        )
+        self.assertEqual(dict(ConversionJob.objects.values_list('pk', 'status')), {
+            jobs[0].pk: ConversionJob.QUEUED,
+            jobs[1].pk: ConversionJob.RUNNING,
+            jobs[2].pk: ConversionJob.RUNNING,
+        })
+
+    def test_jobs_waiting_for_their_run_at_are_not_claimed(self):
+        create_job(run_at=timezone.now() + timedelta(hours=1))
+        due = create_job(run_at=timezone.now() - timedelta(seconds=1))
+
+        self.queue._claim()
+
+        self.assertEqual(self.queue._running, {due.pk})
+
+    def test_jobs_claimed_elsewhere_are_left_alone(self):
+        create_job(status=ConversionJob.RUNNING)
+
+        self.queue._claim()
+
+        self.queue._executor.submit.assert_not_called()
+
+    def test_enqueue_refuses_when_too_many_jobs_are_due(self):
+        for _ in range(3):
+            self.queue.enqueue(SPOTIFY, 'session', 'playlist')
+
+        with self.assertRaises(JobQueueFull):
+            self.queue.enqueue(SPOTIFY, 'session', 'playlist')
+
+    def test_heartbeat_keeps_running_jobs_fresh(self):
+        job = create_job(status=ConversionJob.RUNNING)
+        self.age(job, 120)
+        self.queue._running.add(job.pk)
+
+        self.queue._heartbeat()
+
+        job.refresh_from_db()
+        self.assertGreater(job.updated_at, timezone.now() - timedelta(seconds=60))
+
+    def test_jobs_left_running_by_a_stopped_worker_fail(self):
+        mine, inline, abandoned, recent = (create_job(status=ConversionJob.RUNNING) for _ in range(4))
+        for job in (mine, inline, abandoned):
+            self.age(job, 120)
+        self.queue._running.add(mine.pk)
+        self.queue._inline.add(inline.pk)
+
+        self.queue._fail_stale()
+
+        self.assertEqual(dict(ConversionJob.objects.values_list('pk', 'status')), {
+            mine.pk: ConversionJob.RUNNING,
+            inline.pk: ConversionJob.RUNNING,
+            abandoned.pk: ConversionJob.FAILED,
+            recent.pk: ConversionJob.RUNNING,
+        })
+        self.assertIn('stopped', ConversionJob.objects.get(pk=abandoned.pk).error)
@@ -0,0 +1,79 @@
+from datetime import timedelta
+
+from django.test import TestCase
+from django.utils import timezone
+
+from spotify_app.match_cache import MatchCache
+from spotify_app.models import TrackMatch
+
+
+def result(uri, clean_uri=None, isrc=None, potential_matches=None):
+    return {
+        'track': {'uri': uri, 'isrc': isrc},
+        'found_match': clean_uri is not None,
+        'converted_uri': clean_uri,
+        'potential_matches': potential_matches or [],
+    }
+
+
+class MatchCacheTests(TestCase):
+    def setUp(self):
+        self.cache = MatchCache(ttl=3600, miss_ttl=60)
+
+    def age(self, seconds):
+        TrackMatch.objects.update(checked_at=timezone.now() - timedelta(seconds=seconds))
+
+    def test_unknown_track_is_a_miss(self):
+        self.assertEqual(self.cache.get_many(['spotify:track:unknown']), {})
+        self.assertIsNone(self.cache.get('spotify:track:unknown'))
+
+    def test_stored_results_are_shared_through_the_database(self):
+        self.cache.set_many([result('spotify:track:1', 'spotify:track:1c'), result('spotify:track:2')])
+
+        found = MatchCache(ttl=3600, miss_ttl=60).get_many(['spotify:track:1', 'spotify:track:2'])
+
+        self.assertEqual(found['spotify:track:1']['converted_uri'], 'spotify:track:1c')
+        self.assertTrue(found['spotify:track:1']['found_match'])
+        self.assertFalse(found['spotify:track:2']['found_match'])
+
+    def test_tracks_without_clean_version_expire_after_the_miss_ttl(self):
+        self.cache.set_many([
+            result('spotify:track:found', 'spotify:track:clean'),
+            result('spotify:track:near', potential_matches=[{'uri': 'spotify:track:maybe'}]),
+            result('spotify:track:missing'),
+        ])
+        self.age(120)
+
+        found = MatchCache(ttl=3600, miss_ttl=60).get_many(
+            ['spotify:track:found', 'spotify:track:near', 'spotify:track:missing']
+        )
+
+        self.assertEqual(set(found), {'spotify:track:found', 'spotify:track:near'})
+
+    def test_matches_expire_after_the_ttl(self):
+        self.cache.set_many([result('spotify:track:found', 'spotify:track:clean', isrc='USRC17607839')])
+        self.age(7200)
+        cache = MatchCache(ttl=3600, miss_ttl=60)
+
+        self.assertEqual(cache.get_many(['spotify:track:found']), {})
+        self.assertEqual(cache.get_many_by_isrc(['USRC17607839']), {})
+
+    def test_stale_entries_are_overwritten(self):
+        self.cache.set_many([result('spotify:track:1')])
+        self.age(120)
+
+        self.cache.set_many([result('spotify:track:1', 'spotify:track:1c')])
+
+        self.assertEqual(TrackMatch.objects.get(track_uri='spotify:track:1').clean_uri, 'spotify:track:1c')
+        self.assertEqual(self.cache.get('spotify:track:1')['converted_uri'], 'spotify:track:1c')
+
+    def test_only_found_matches_are_indexed_by_isrc(self):
+        self.cache.set_many([
+            result('spotify:track:album', 'spotify:track:clean', isrc='USRC17607839'),
+            result('spotify:track:single', isrc='GBUM71029604'),
+        ])
+
+        for cache in (self.cache, MatchCache(ttl=3600, miss_ttl=60)):
+            found = cache.get_many_by_isrc(['USRC17607839', 'GBUM71029604'])
+            self.assertEqual(set(found), {'USRC17607839'})
+            self.assertEqual(found['USRC17607839']['converted_uri'], 'spotify:track:clean')
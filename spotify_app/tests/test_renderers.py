@@ -0,0 +1,78 @@
+import json
+from datetime import datetime, timezone
+
+from asgiref.sync import async_to_sync
+from django.test import SimpleTestCase
+from ninja import Schema
+from ninja.responses import NinjaJSONEncoder
+
+from spotify_app.renderers import ORJSONRenderer, iter_ndjson, ndjson_response
+
+
+class ItemSchema(Schema):
+    name: str
+    added_at: datetime
+
+
+ADDED_AT = datetime(2024, 5, 1, 12, 30, 15, 123456, tzinfo=timezone.utc)
+
+
+def items(count=2, fail=False):
+    for n in range(count):
+        yield {'name': f"Song {n}", 'added_at': ADDED_AT, 'internal': 'dropped'}
+    if fail:
+        raise ValueError('page failed')
+
+
+async def aitems(count=2):
+    for item in items(count):
+        yield item
+
+
+class ORJSONRendererTests(SimpleTestCase):
+    def test_output_matches_the_default_renderer(self):
+        data = {'name': 'Song', 'added_at': ADDED_AT, 'counts': {1: 2}}
+
+        rendered = ORJSONRenderer().render(None, data, response_status=200)
+
+        self.assertEqual(json.loads(rendered), json.loads(json.dumps(data, cls=NinjaJSONEncoder)))
+
+
+class NDJSONTests(SimpleTestCase):
+    def lines(self, chunks):
+        return [json.loads(line) for line in b''.join(chunks).splitlines()]
+
+    def test_one_validated_item_per_line(self):
+        lines = self.lines(iter_ndjson(items(), ItemSchema))
+
+        self.assertEqual(lines, [
+            {'name': 'Song 0', 'added_at': NinjaJSONEncoder().default(ADDED_AT)},
+            {'name': 'Song 1', 'added_at': NinjaJSONEncoder().default(ADDED_AT)},
+        ])
+
+    def test_source_failing_halfway_ends_with_an_error_line(self):
+        lines = self.lines(iter_ndjson(items(fail=True), ItemSchema))
+
+        self.assertEqual([line.get('name') for line in lines[:2]], ['Song 0', 'Song 1'])
+        self.assertEqual(lines[2], {'error': 'page failed'})
+
+    def test_items_not_matching_the_schema_end_the_stream(self):
+        lines = self.lines(iter_ndjson([{'name': 'Song'}], ItemSchema))
+
+        self.assertEqual(list(lines[0]), ['error'])
+
+    def test_response_streams_unbuffered_ndjson(self):
+        response = ndjson_response(items(), ItemSchema)
+
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(response['X-Accel-Buffering'], 'no')
+        self.assertEqual(len(self.lines(response.streaming_content)), 2)
+
+    def test_async_sources_are_streamed(self):
+        response = ndjson_response(aitems(), ItemSchema)
+
+        async def read():
+            return [chunk async for chunk in response.streaming_content]
+
+        self.assertTrue(response.is_async)
+        self.assertEqual(self.lines(async_to_sync(read)()), self.lines(iter_ndjson(items(), ItemSchema)))
@@ -0,0 +1,94 @@
+import time
+
+import httpx
+from django.test import SimpleTestCase
+
+from spotify_app.search_engine import RateLimitedError, SpotifySearchEngine
+
+
+def search_response(*names):
+    return httpx.Response(200, json={'tracks': {'items': [
+        {
+            'name': name,
+            'uri': f"spotify:track:{name}",
+            'explicit': False,
+            'artists': [{'id': 'artist', 'name': 'Artist', 'href': 'https://api.spotify.com/v1/artists/artist'}],
+            'external_urls': {'spotify': f"https://open.spotify.com/track/{name}"},
+            'external_ids': {'isrc': 'USRC17607839'},
+            'available_markets': ['US', 'GB'],
+        }
+        for name in names
+    ]}})
+
+
+class SpotifySearchEngineTests(SimpleTestCase):
+    def setUp(self):
+        self.requests = []
+        self.responses = []
+        self.sent_at = {}
+        self.engine = SpotifySearchEngine(rate=1000, burst=1000, max_concurrency=4, max_retries=2)
+        self.engine._ensure_loop()
+        self.engine._client = httpx.AsyncClient(transport=httpx.MockTransport(self.handle))
+
+    def tearDown(self):
+        self.engine._loop.call_soon_threadsafe(self.engine._loop.stop)
+
+    def handle(self, request):
+        self.requests.append(request)
+        self.sent_at.setdefault(request.url.params['q'], []).append(time.monotonic())
+        # Queued responses first, then plain results for whatever was searched
+        return self.responses.pop(0) if self.responses else search_response(request.url.params['q'])
+
+    def search(self, query='song'):
+        return self.engine.submit(self.engine.search('token', query, limit=10)).result(timeout=10)
+
+    def test_results_are_compacted(self):
+        results = self.search()
+
+        self.assertEqual(results, [{
+            'name': 'song',
+            'uri': 'spotify:track:song',
+            'explicit': False,
+            'artists': [{'id': 'artist', 'name': 'Artist'}],
+            'external_urls': {'spotify': 'https://open.spotify.com/track/song'},
+            'external_ids': {'isrc': 'USRC17607839'},
+        }])
+        self.assertEqual(self.requests[0].headers['Authorization'], 'Bearer token')
+
+    def test_rate_limited_search_waits_for_retry_after(self):
+        self.responses = [httpx.Response(429, headers={'Retry-After': '0.3'})]
+        started = time.monotonic()
+
+        results = self.search()
+
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+        self.assertEqual([result['name'] for result in results], ['song'])
+        self.assertEqual(len(self.requests), 2)
+
+    def test_retry_after_holds_back_other_searches(self):
+        self.responses = [httpx.Response(429, headers={'Retry-After': '0.3'})]
+        first = self.engine.submit(self.engine.search('token', 'song', limit=10))
+        while not self.requests:
+            time.sleep(0.01)
+
+        self.search('other')
+        first.result(timeout=10)
+
+        self.assertGreaterEqual(self.sent_at['other'][0] - self.sent_at['song'][0], 0.3)
+
+    def test_search_still_rate_limited_after_every_retry_raises(self):
+        self.responses = [httpx.Response(429, headers={'Retry-After': '0'}) for _ in range(3)]
+
+        with self.assertRaises(RateLimitedError) as raised:
+            self.search()
+
+        self.assertEqual(raised.exception.query, 'song')
+        self.assertEqual(raised.exception.retry_after, 0.0)
+        self.assertEqual(len(self.requests), 3)
+
+    def test_client_errors_are_not_retried(self):
+        self.responses = [httpx.Response(401)]
+
+        with self.assertRaises(httpx.HTTPStatusError):
+            self.search()
+        self.assertEqual(len(self.requests), 1)
@@ -0,0 +1,8 @@
+"""Settings for the test suite: the local memory cache instead of memcached"""
+from newMusicCleaner.settings import *  # noqa: F401,F403
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
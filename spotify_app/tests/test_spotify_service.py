@@ -0,0 +1,197 @@
+import threading
+from collections import Counter
+from concurrent.futures import Future
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase
+
+from spotify_app.match_cache import MatchCache
+from spotify_app.search_engine import search_engine
+from spotify_app.spotify_service import SpotifyService, page_executor
+
+
+def playlist_items(*uris):
+    return {'items': [{'track': {'uri': uri}} for uri in uris], 'next': None}
+
+
+class DiffTracksTests(SimpleTestCase):
+    def test_unchanged_playlist_needs_nothing(self):
+        removals, additions = SpotifyService._diff_tracks(['a', 'b'], ['a', 'b'])
+
+        self.assertEqual(removals, Counter())
+        self.assertEqual(additions, [])
+
+    def test_removed_and_added_tracks(self):
+        removals, additions = SpotifyService._diff_tracks(['a', 'b', 'c'], ['a', 'c', 'd', 'e'])
+
+        self.assertEqual(removals, Counter({'b': 1}))
+        self.assertEqual(additions, ['d', 'e'])
+
+    def test_duplicates_are_counted(self):
+        removals, additions = SpotifyService._diff_tracks(['a', 'a', 'b'], ['a', 'b', 'b', 'c', 'b'])
+
+        self.assertEqual(removals, Counter({'a': 1}))
+        self.assertEqual(additions, ['b', 'b', 'c'])
+
+
+class RemoveItemsTests(SimpleTestCase):
+    def setUp(self):
+        self.service = SpotifyService('session')
+        self.service._spotify = mock.MagicMock()
+
+    def test_first_occurrences_are_removed_highest_position_first(self):
+        self.service._spotify.playlist_items.return_value = playlist_items('a', 'b', 'a', 'c', 'b')
+
+        self.service._remove_items('playlist', Counter({'a': 1, 'b': 2}))
+
+        self.service._spotify.playlist_remove_specific_occurrences_of_items.assert_called_once_with(
+            'playlist', [{'uri': 'b', 'positions': [4, 1]}, {'uri': 'a', 'positions': [0]}]
+        )
+
+    def test_copies_added_by_the_user_stay(self):
+        # The conversion added 'a' once, the user added it again later
+        self.service._spotify.playlist_items.return_value = playlist_items('a', 'c', 'a')
+
+        self.service._remove_items('playlist', Counter({'a': 1}))
+
+        self.service._spotify.playlist_remove_specific_occurrences_of_items.assert_called_once_with(
+            'playlist', [{'uri': 'a', 'positions': [0]}]
+        )
+
+    def test_removals_go_in_batches_of_100(self):
+        uris = [f"spotify:track:{n}" for n in range(150)]
+        self.service._spotify.playlist_items.return_value = playlist_items(*uris)
+
+        self.service._remove_items('playlist', Counter(uris))
+
+        calls = self.service._spotify.playlist_remove_specific_occurrences_of_items.call_args_list
+        self.assertEqual([len(call.args[1]) for call in calls], [100, 50])
+        self.assertEqual(calls[0].args[1][0], {'uri': 'spotify:track:149', 'positions': [149]})
+
+
+class PlaylistPagesTests(SimpleTestCase):
+    def setUp(self):
+        self.service = SpotifyService('session')
+        self.service._spotify = mock.MagicMock()
+        self.service._spotify.playlist_items.side_effect = self.playlist_items
+
+    @staticmethod
+    def playlist_items(playlist_id, limit, offset=0):
+        return {
+            'items': [{'track': {'uri': f"spotify:track:{n}"}} for n in range(offset, min(offset + limit, 250))],
+            'total': 250,
+        }
+
+    def test_pages_come_in_playlist_order(self):
+        tracks = self.service.get_playlist_tracks('playlist')
+
+        self.assertEqual([track['uri'] for track in tracks], [f"spotify:track:{n}" for n in range(250)])
+
+    def test_every_page_holds_a_concurrency_slot(self):
+        with mock.patch.object(search_engine.concurrency, 'slot', wraps=search_engine.concurrency.slot) as slot:
+            list(self.service.iter_playlist_pages('playlist'))
+
+        self.assertEqual(slot.call_count, 3)
+
+    def test_pages_not_read_are_cancelled_when_the_caller_stops(self):
+        release = threading.Event()
+        futures = []
+        original_submit = page_executor.submit
+
+        def playlist_items(playlist_id, limit, offset=0):
+            if offset >= 20:
+                release.wait(5)
+            return self.playlist_items(playlist_id, limit, offset)
+
+        def submit(*args, **kwargs):
+            futures.append(original_submit(*args, **kwargs))
+            return futures[-1]
+
+        self.service._spotify.playlist_items.side_effect = playlist_items
+        pages = self.service.iter_playlist_pages('playlist', page_size=10)
+        next(pages)
+        with mock.patch('spotify_app.spotify_service.page_executor.submit', side_effect=submit):
+            next(pages)
+
+        try:
+            pages.close()
+            # More pages are in flight than the pool has threads, so some never started
+            self.assertTrue(any(future.cancelled() for future in futures))
+        finally:
+            release.set()
+
+
+def explicit_track(uri, isrc=None):
+    return {
+        'name': uri,
+        'uri': uri,
+        'explicit': True,
+        'artists': [{'id': 'artist', 'name': 'Artist'}],
+        'external_ids': {'isrc': isrc} if isrc else {},
+        'external_urls': {'spotify': f"https://open.spotify.com/track/{uri}"},
+    }
+
+
+class ConvertPlaylistIsrcTests(TestCase):
+    def setUp(self):
+        self.match_cache = MatchCache(ttl=3600, miss_ttl=60)
+        patcher = mock.patch('spotify_app.spotify_service.match_cache', self.match_cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.searched = []
+        patcher = mock.patch('spotify_app.spotify_service.search_engine.submit', side_effect=self.submit)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.service = SpotifyService('session')
+        self.service._spotify = mock.MagicMock()
+        self.service._spotify.playlist.return_value = {'name': 'Playlist', 'snapshot_id': 'snapshot'}
+        self.service._spotify.user_playlist_create.return_value = {'id': 'cleaned'}
+        self.service.get_user = mock.MagicMock(return_value={'id': 'user'})
+        self.service.playlist_index = mock.MagicMock()
+        self.service._search_token = mock.MagicMock(return_value='token')
+        self.service.search_and_process_track_async = lambda track, access_token: track
+
+    def submit(self, track):
+        self.searched.append(track['uri'])
+        future = Future()
+        future.set_result({'track': track, 'found_match': False, 'converted_uri': None, 'potential_matches': []})
+        return future
+
+    def convert(self, *tracks):
+        self.service.iter_playlist_pages = mock.MagicMock(return_value=iter([list(tracks)]))
+        return self.service.convert_playlist('playlist')
+
+    def test_other_release_of_a_resolved_recording_skips_the_search(self):
+        self.match_cache.set_many([{
+            'track': {'uri': 'spotify:track:album', 'isrc': 'USRC17607839'},
+            'found_match': True,
+            'converted_uri': 'spotify:track:clean',
+            'potential_matches': [],
+        }])
+
+        result = self.convert(explicit_track('spotify:track:single', 'USRC17607839'))
+
+        self.assertEqual(self.searched, [])
+        self.assertEqual(result['num_clean_found'], 1)
+        self.service._spotify.playlist_add_items.assert_called_once_with('cleaned', ['spotify:track:clean'])
+        # Stored under its own URI for the next run
+        self.assertEqual(self.match_cache.get('spotify:track:single')['converted_uri'], 'spotify:track:clean')
+
+    def test_tracks_without_a_resolved_isrc_are_searched(self):
+        self.match_cache.set_many([{
+            'track': {'uri': 'spotify:track:album', 'isrc': 'GBUM71029604'},
+            'found_match': False,
+            'converted_uri': None,
+            'potential_matches': [],
+        }])
+
+        self.convert(
+            explicit_track('spotify:track:unknown', 'USRC17607839'),
+            explicit_track('spotify:track:unmatched', 'GBUM71029604'),
+            explicit_track('spotify:track:no-isrc'),
+        )
+
+        self.assertEqual(
+            self.searched, ['spotify:track:unknown', 'spotify:track:unmatched', 'spotify:track:no-isrc']
+        )
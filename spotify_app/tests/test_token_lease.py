@@ -0,0 +1,120 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.sessions.models import Session
+from django.test import TestCase
+from django.utils import timezone
+
+from newMusicCleaner.token_lease import TokenRefresher, refresh_with_lease
+from spotify_app.models import Token
+
+
+def refreshed(refresh_token):
+    return {'access_token': 'new-access', 'refresh_token': 'new-refresh', 'token_type': 'Bearer', 'expires_in': 3600}
+
+
+def create_token(session_id='session', expires_in=60, **fields):
+    return Token.objects.create(
+        user=session_id,
+        access_token='access',
+        refresh_token='refresh',
+        token_type='Bearer',
+        expires_in=timezone.now() + timedelta(seconds=expires_in),
+        **fields
+    )
+
+
+class RefreshWithLeaseTests(TestCase):
+    def test_token_not_due_is_left_alone(self):
+        create_token(expires_in=3600)
+        refresh = mock.Mock(side_effect=refreshed)
+
+        tokens = refresh_with_lease(Token, 'session', refresh)
+
+        self.assertEqual(tokens.access_token, 'access')
+        refresh.assert_not_called()
+
+    def test_due_token_is_refreshed_and_the_lease_released(self):
+        create_token()
+        refresh = mock.Mock(side_effect=refreshed)
+
+        tokens = refresh_with_lease(Token, 'session', refresh)
+
+        refresh.assert_called_once_with('refresh')
+        self.assertEqual((tokens.access_token, tokens.refresh_token), ('new-access', 'new-refresh'))
+        self.assertGreater(tokens.expires_in, timezone.now() + timedelta(minutes=59))
+        self.assertIsNone(tokens.refresh_lease_until)
+
+    def test_token_is_refreshed_once_by_successive_callers(self):
+        create_token()
+        refresh = mock.Mock(side_effect=refreshed)
+
+        refresh_with_lease(Token, 'session', refresh)
+        refresh_with_lease(Token, 'session', refresh)
+
+        refresh.assert_called_once()
+
+    def test_working_token_is_used_while_another_node_refreshes(self):
+        create_token(refresh_lease_until=timezone.now() + timedelta(seconds=30))
+        refresh = mock.Mock(side_effect=refreshed)
+
+        tokens = refresh_with_lease(Token, 'session', refresh)
+
+        self.assertEqual(tokens.access_token, 'access')
+        refresh.assert_not_called()
+
+    @mock.patch('newMusicCleaner.token_lease.time.sleep')
+    def test_expired_token_waits_for_the_other_nodes_refresh(self, sleep):
+        create_token(expires_in=-10, refresh_lease_until=timezone.now() + timedelta(seconds=30))
+        refresh = mock.Mock(side_effect=refreshed)
+        # The other node writes its new token while this one waits
+        sleep.side_effect = lambda seconds: Token.objects.update(
+            access_token='other-node', expires_in=timezone.now() + timedelta(hours=1), refresh_lease_until=None
+        )
+
+        tokens = refresh_with_lease(Token, 'session', refresh)
+
+        self.assertEqual(tokens.access_token, 'other-node')
+        refresh.assert_not_called()
+
+    def test_lease_of_a_node_that_died_is_taken_over(self):
+        create_token(expires_in=-10, refresh_lease_until=timezone.now() - timedelta(seconds=1))
+        refresh = mock.Mock(side_effect=refreshed)
+
+        tokens = refresh_with_lease(Token, 'session', refresh)
+
+        self.assertEqual(tokens.access_token, 'new-access')
+
+    def test_failed_refresh_releases_the_lease(self):
+        create_token()
+        refresh = mock.Mock(side_effect=ValueError('invalid_grant'))
+
+        with self.assertRaises(ValueError):
+            refresh_with_lease(Token, 'session', refresh)
+
+        tokens = Token.objects.get(user='session')
+        self.assertIsNone(tokens.refresh_lease_until)
+        self.assertEqual(tokens.access_token, 'access')
+
+
+@mock.patch('newMusicCleaner.token_lease.refresh_in_background', side_effect=lambda refresh: refresh())
+class TokenRefresherTests(TestCase):
+    def test_sweep_refreshes_only_live_sessions_tokens_that_are_due(self, refresh_in_background):
+        for session_id, session_expires_in, token_expires_in in (
+            ('due', 3600, 60),
+            ('not-due', 3600, 3600),
+            ('expired-token', 3600, -10),
+            ('logged-out', -10, 60),
+        ):
+            Session.objects.create(
+                session_key=session_id,
+                session_data='',
+                expire_date=timezone.now() + timedelta(seconds=session_expires_in)
+            )
+            create_token(session_id, token_expires_in)
+        refresh = mock.Mock()
+        refresher = TokenRefresher()
+        refresher.register(Token, refresh)
+
+        self.assertEqual(refresher.sweep(), 1)
+        refresh.assert_called_once_with('due')
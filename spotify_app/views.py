@@ -4,8 +4,10 @@ from django.template.loader import render_to_string
 from requests import Request, post
 from rest_framework.views import APIView
 
+from newMusicCleaner.playlist_index import InvalidCursor
 from newMusicCleaner.settings import SP_REDIRECT_URI, SP_CLIENT_ID, SP_CLIENT_SECRET
 from .extras import create_or_update_tokens, is_spotify_authenticated
+from .jobs import job_queue, SPOTIFY
 from .spotify_service import SpotifyService
 
 
@@ -22,14 +24,13 @@ def spotify_interface(request):
     try:
         # Get user info and playlists
         user_info = spotify_service.get_user()
-        playlists = spotify_service.get_playlists()
-
-        # Limit playlists to 60 as per original implementation
-        limited_playlists = playlists[:60] if playlists else []
+        # First page only, the list fetches the next ones as it is scrolled
+        playlists, next_cursor = spotify_service.playlist_index().page()
 
         context = {
             'user': user_info,
-            'playlists': limited_playlists,
+            'playlists': playlists,
+            'next_cursor': next_cursor,
         }
 
         return render(request, 'index.html', context)
@@ -37,6 +38,38 @@ def spotify_interface(request):
         return render(request, 'index.html', {'error': str(e)})
 
 
+def playlist_page(request):
+    """View for the next page of the playlist list, requested as the list is scrolled"""
+    if not request.session.session_key:
+        request.session.create()
+
+    if not is_spotify_authenticated(request.session.session_key):
+        return JsonResponse({'error': 'Not authenticated'}, status=401)
+
+    spotify_service = SpotifyService(request.session.session_key)
+
+    try:
+        playlists, next_cursor = spotify_service.playlist_index().page(request.GET.get('cursor'))
+    except InvalidCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception as e:
+        error_message = f"Error fetching playlists: {str(e)}"
+        if request.headers.get('HX-Request'):
+            return HttpResponse(f'<div class="alert alert-danger">{error_message}</div>')
+        return JsonResponse({'error': error_message}, status=500)
+
+    context = {
+        'playlists': playlists,
+        'next_cursor': next_cursor
+    }
+
+    if request.headers.get('HX-Request'):
+        html = render_to_string('components/playlist_items.html', context)
+        return HttpResponse(html)
+
+    return JsonResponse(context)
+
+
 def playlist_tracks(request, playlist_id):
     """View for displaying tracks of a specific playlist"""
     if not request.session.session_key:
@@ -82,6 +115,14 @@ def convert_playlist(request, playlist_id):
     try:
         # Default to clean version
         to_clean = request.GET.get('to_clean', 'true').lower() == 'true'
+
+        # Background mode returns straight away and lets the client poll the job
+        if request.GET.get('background', 'false').lower() == 'true':
+            job = job_queue.enqueue(SPOTIFY, request.session.session_key, playlist_id, to_clean)
+            if request.headers.get('HX-Request'):
+                return render(request, 'components/job_progress.html', {'job': job})
+            return JsonResponse({'job_id': str(job.job_id), 'status': job.status}, status=202)
+
         result = spotify_service.convert_playlist(playlist_id, to_clean)
 
         if request.headers.get('HX-Request'):
@@ -156,6 +197,8 @@ def spotify_redirect(request, format=None):
             expires_in=expires_in,
             token_type=token_type
         )
+        # The session may now belong to another account
+        SpotifyService(request.session.session_key).invalidate_cache()
 
         return HttpResponseRedirect('/spotify/')
     except Exception as e:
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Youtube_token
+from .models import Youtube_token, VideoMetadata, QuotaUsage
 
 
 @admin.register(Youtube_token)
@@ -8,3 +8,17 @@ class YouTubeTokenAdmin(admin.ModelAdmin):
     search_fields = ['user']
     readonly_fields = ['created_at']
     list_filter = ['token_type', 'created_at']
+
+
+@admin.register(VideoMetadata)
+class VideoMetadataAdmin(admin.ModelAdmin):
+    list_display = ['video_id', 'title', 'matched', 'explicit', 'checked_at']
+    search_fields = ['video_id', 'title']
+    list_filter = ['matched', 'explicit']
+
+
+@admin.register(QuotaUsage)
+class QuotaUsageAdmin(admin.ModelAdmin):
+    list_display = ['day', 'user', 'units', 'calls', 'updated_at']
+    search_fields = ['user']
+    list_filter = ['day']
@@ -0,0 +1,201 @@
+import asyncio
+import logging
+from collections import deque
+from typing import AsyncIterator, Dict, List, Optional
+from urllib.parse import urlencode
+
+import orjson
+from asgiref.sync import sync_to_async
+
+from newMusicCleaner.async_http import send_with_retries
+from newMusicCleaner.playlist_index import PlaylistIndex
+from youtube_app.extras import aget_youtube_token
+from youtube_app.http_cache import DjangoHttpCache
+from youtube_app.metadata_cache import metadata_cache
+from youtube_app.quota import quota_ledger, request_cost
+from newMusicCleaner.settings import SESSION_PLAYLIST_CACHE_TTL
+from youtube_app.yt_services import YouTubeMusicService, channel_user, metadata_executor, search_executor
+
+logger = logging.getLogger(__name__)
+
+API_URL = 'https://www.googleapis.com/youtube/v3/'
+
+
+class AsyncYouTubeMusicService:
+    """YouTubeMusicService for the async endpoints.
+
+    YouTube Data API reads go through httpx and the async ORM and are charged
+    to the quota ledger like the sync client's. They are revalidated with
+    ETags from the sync client's HTTP cache store, and the playlist list is
+    the sync service's PlaylistIndex. ytmusicapi is sync only, so
+    YTMusic lookups run on the same shared pools as the sync service, and
+    conversions run the sync service on a worker thread.
+    """
+    api_url = API_URL
+
+    def __init__(self, session_id=None):
+        self._access_token = None
+        self._user = None
+        self.session_id = session_id
+        # Does the YTMusic lookups and the conversions
+        self._sync = YouTubeMusicService(session_id)
+        self.max_in_flight = self._sync.max_in_flight
+        self.http_cache = DjangoHttpCache(namespace=session_id)
+
+    async def initialize_client(self) -> str:
+        if not self._access_token:
+            self._access_token = await aget_youtube_token(self.session_id)
+            if not self._access_token:
+                raise Exception("Failed to initialize YouTube client")
+        return self._access_token
+
+    async def _list(self, resource: str, **params) -> Dict:
+        """GET `resource`.list, e.g. playlistItems, recording its quota cost once answered or failed.
+
+        A response seen before is revalidated with its ETag and a 304 answered
+        from the stored body.
+        """
+        access_token = await self.initialize_client()
+        cache_key = f"async:{self.api_url}{resource}?{urlencode(sorted(params.items()))}"
+        cached = await self.http_cache.aget(cache_key)
+        headers = {'Authorization': f"Bearer {access_token}"}
+        if cached:
+            headers['If-None-Match'] = cached['etag']
+        try:
+            response = await send_with_retries('youtube', 'GET', self.api_url + resource, params=params, headers=headers)
+        finally:
+            await quota_ledger.arecord(self.session_id, request_cost(f"youtube.{resource}.list"))
+
+        if response.status_code == 304 and cached:
+            return orjson.loads(cached['body'])
+        response.raise_for_status()
+        if response.headers.get('ETag'):
+            await self.http_cache.aset(cache_key, {'etag': response.headers['ETag'], 'body': response.content})
+        return orjson.loads(response.content)
+
+    async def get_user(self) -> Optional[Dict]:
+        """Get current user channel information"""
+        if self._user is None:
+            try:
+                self._user = await self._sync.session_cache.aget('user', self._fetch_user)
+            except Exception as e:
+                logger.error(f"Failed to get user: {e}")
+                raise
+        return self._user
+
+    async def _fetch_user(self) -> Optional[Dict]:
+        response = await self._list('channels', part='snippet', mine='true')
+        if response['items']:
+            return channel_user(response['items'][0])
+        return None
+
+    def playlist_index(self) -> PlaylistIndex:
+        """The same cached index as YouTubeMusicService's, loaded through its client"""
+        return self._sync.playlist_index()
+
+    async def get_playlists(self) -> List[Dict]:
+        # The index lives in the Django cache and loads on a worker thread when missing
+        return await sync_to_async(self.playlist_index().get, thread_sensitive=False)()
+
+    async def get_playlist(self, playlist_id: str) -> Dict:
+        """A playlist's snippet and contentDetails, shared with YouTubeMusicService.get_playlist"""
+        return await self._sync.session_cache.aget(f"playlist:{playlist_id}", lambda: self._fetch_playlist(playlist_id),
+                                                   SESSION_PLAYLIST_CACHE_TTL)
+
+    async def _fetch_playlist(self, playlist_id: str) -> Dict:
+        response = await self._list('playlists', part='snippet,contentDetails', id=playlist_id)
+        if not response['items']:
+            raise Exception(f"Playlist {playlist_id} not found")
+        return response['items'][0]
+
+    async def get_playlist_size(self, playlist_id: str) -> int:
+        """Number of videos in a playlist, for estimating what converting it will cost"""
+        return (await self.get_playlist(playlist_id))['contentDetails']['itemCount']
+
+    async def iter_playlist_tracks(self, playlist_id: str) -> AsyncIterator[Dict]:
+        """Yield a playlist's tracks with music metadata, in playlist order.
+
+        Same pipeline as YouTubeMusicService.iter_playlist_tracks: the next page
+        is fetched while this page's metadata lookups run on the shared pool.
+        """
+        loop = asyncio.get_running_loop()
+        params = {
+            'part': 'snippet,contentDetails',
+            'playlistId': playlist_id,
+            'maxResults': 50,
+            'fields': 'items(snippet(title,videoOwnerChannelTitle),contentDetails(videoId)),nextPageToken'
+        }
+        response = await self._list('playlistItems', **params)
+        pending = deque()
+        fetched = {}
+
+        async def next_track():
+            item, future, looked_up = pending.popleft()
+            await asyncio.wait([future])
+            track = self._sync._track_from_item(item, future)
+            # Store fresh lookups, including misses, so they aren't searched again
+            if looked_up and not future.exception():
+                fetched[item['contentDetails']['videoId']] = future.result()
+                if len(fetched) >= 50:
+                    await sync_to_async(metadata_cache.set_many, thread_sensitive=False)(dict(fetched))
+                    fetched.clear()
+            return track
+
+        try:
+            while response:
+                next_page = None
+                if response.get('nextPageToken'):
+                    next_page = asyncio.ensure_future(
+                        self._list('playlistItems', **params, pageToken=response['nextPageToken'])
+                    )
+
+                items = response.get('items', [])
+                cached = await sync_to_async(metadata_cache.get_many, thread_sensitive=False)(
+                    [item['contentDetails']['videoId'] for item in items]
+                )
+
+                for item in items:
+                    while len(pending) >= self.max_in_flight:
+                        track = await next_track()
+                        if track:
+                            yield track
+
+                    video_id = item['contentDetails']['videoId']
+                    if video_id in cached:
+                        future = loop.create_future()
+                        future.set_result(cached[video_id])
+                        pending.append((item, future, False))
+                    else:
+                        pending.append((item, loop.run_in_executor(
+                            metadata_executor,
+                            self._sync.get_song_metadata,
+                            video_id,
+                            item['snippet']['title'],
+                            item['snippet'].get('videoOwnerChannelTitle', '')
+                        ), True))
+
+                response = await next_page if next_page else None
+
+            while pending:
+                track = await next_track()
+                if track:
+                    yield track
+        finally:
+            for _, future, _ in pending:
+                future.cancel()
+            if fetched:
+                await sync_to_async(metadata_cache.set_many, thread_sensitive=False)(fetched)
+
+    async def get_playlist_tracks(self, playlist_id: str) -> List[Dict]:
+        try:
+            return [track async for track in self.iter_playlist_tracks(playlist_id)]
+        except Exception as e:
+            logger.error(f"Failed to get tracks: {e}")
+            raise
+
+    async def search_track(self, query: str) -> List[Dict]:
+        """Search for tracks on YTMusic"""
+        return await asyncio.get_running_loop().run_in_executor(search_executor, self._sync.search_track, query)
+
+    async def convert_playlist(self, playlist_id: str, to_clean: bool = True) -> Dict:
+        return await sync_to_async(self._sync.convert_playlist, thread_sensitive=False)(playlist_id, to_clean)
@@ -1,12 +1,37 @@
+import asyncio
+import threading
 from datetime import timedelta
+from typing import Optional
+
 from django.utils import timezone
-from requests import post
 
-from newMusicCleaner.settings import YOUTUBE_CLIENT_ID, YOUTUBE_CLIENT_SECRET, YOUTUBE_SCOPES
+from newMusicCleaner.async_http import async_client
+from newMusicCleaner.client_cache import ClientCache
+from newMusicCleaner.metrics import instrumented_session
+from newMusicCleaner.settings import TOKEN_REFRESH_AHEAD, YOUTUBE_CLIENT_ID, YOUTUBE_CLIENT_SECRET, YOUTUBE_SCOPES
+from newMusicCleaner.singleflight import AsyncSingleFlight, SingleFlight
+from newMusicCleaner.token_lease import (
+    arefresh_with_lease,
+    is_expired,
+    needs_refresh,
+    refresh_in_background,
+    refresh_with_lease,
+    token_refresher
+)
+from .http_cache import DjangoHttpCache
 from .models import Youtube_token
+from .quota import MeteredHttpRequest
+import google_auth_httplib2
+import httplib2
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 
+# Clients are reloaded once their token is due for a refresh, which starts the refresh
+youtube_clients = ClientCache(name='youtube_clients', expiry_margin=TOKEN_REFRESH_AHEAD)
+token_refreshes = SingleFlight()
+async_token_refreshes = AsyncSingleFlight()
+oauth_session = instrumented_session('google_oauth')
+
 
 def check_tokens(session_id):
     try:
@@ -18,69 +43,68 @@ def check_tokens(session_id):
 
 
 def create_or_update_tokens(session_id, access_token, refresh_token, expires_in, token_type):
+    Youtube_token.objects.update_or_create(user=session_id, defaults={
+        'access_token': access_token,
+        'refresh_token': refresh_token,
+        'expires_in': timezone.now() + timedelta(seconds=expires_in),
+        'token_type': token_type,
+        'refresh_lease_until': None,
+    })
+    youtube_clients.invalidate(session_id)
+
+
+def fresh_tokens(session_id):
+    """Tokens of a session, refreshed first if expired and in the background if about to expire"""
     tokens = check_tokens(session_id)
-    expires_in = timezone.now() + timedelta(seconds=expires_in)
-
-    if tokens:
-        tokens.access_token = access_token
-        tokens.refresh_token = refresh_token
-        tokens.expires_in = expires_in
-        tokens.token_type = token_type
-        tokens.save(update_fields=['access_token', 'refresh_token', 'expires_in', 'token_type'])
-    else:
-        tokens = Youtube_token(
-            user=session_id,
-            access_token=access_token,
-            refresh_token=refresh_token,
-            expires_in=expires_in,
-            token_type=token_type
-        )
-        tokens.save()
+
+    if tokens and is_expired(tokens):
+        tokens = refresh_tokens(session_id)
+    elif tokens and needs_refresh(tokens):
+        refresh_in_background(lambda: refresh_tokens(session_id))
+    return tokens
 
 
 def is_youtube_authenticated(session_id):
-    tokens = check_tokens(session_id)
-    if tokens:
-        if tokens.expires_in <= timezone.now():
-            refresh_token_func(session_id)
-        return True
-    return False
+    return fresh_tokens(session_id) is not None
+
+
+def refresh_tokens(session_id):
+    """Refresh once per session even when several requests, or nodes, notice the expiry together"""
+    return token_refreshes.do(session_id, lambda: refresh_token_func(session_id))
 
 
 def refresh_token_func(session_id):
-    tokens = check_tokens(session_id)
-    if not tokens:
-        return None
+    tokens = refresh_with_lease(Youtube_token, session_id, _request_refresh)
+    youtube_clients.invalidate(session_id)
+    return tokens
+
+
+token_refresher.register(Youtube_token, refresh_tokens)
+
 
-    response = post('https://oauth2.googleapis.com/token', data={
+def _refresh_response(response, refresh_token):
+    if 'access_token' not in response:
+        raise Exception(f"Failed to refresh YouTube token: {response.get('error')}")
+    # Google keeps the refresh token and doesn't send it again
+    response.setdefault('refresh_token', refresh_token)
+    return response
+
+
+def _request_refresh(refresh_token):
+    response = oauth_session.post('https://oauth2.googleapis.com/token', data={
         'client_id': YOUTUBE_CLIENT_ID,
         'client_secret': YOUTUBE_CLIENT_SECRET,
-        'refresh_token': tokens.refresh_token,
+        'refresh_token': refresh_token,
         'grant_type': 'refresh_token'
     }).json()
-
-    access_token = response.get('access_token')
-    expires_in = response.get('expires_in')
-    token_type = response.get('token_type')
-
-    create_or_update_tokens(
-        session_id=session_id,
-        access_token=access_token,
-        refresh_token=tokens.refresh_token,
-        expires_in=expires_in,
-        token_type=token_type
-    )
+    return _refresh_response(response, refresh_token)
 
 
-def get_youtube_client(session_id):
-    tokens = check_tokens(session_id)
+def _load_youtube_client(session_id):
+    tokens = fresh_tokens(session_id)
     if not tokens:
         return None
 
-    if tokens.expires_in <= timezone.now():
-        refresh_token_func(session_id)
-        tokens = check_tokens(session_id)
-
     credentials = Credentials(
         token=tokens.access_token,
         refresh_token=tokens.refresh_token,
@@ -90,4 +114,79 @@ def get_youtube_client(session_id):
         scopes=YOUTUBE_SCOPES
     )
 
-    return build('youtube', 'v3', credentials=credentials)
+    # The cached client is shared between threads and httplib2 is not thread-safe,
+    # so each thread keeps its own authorized connection and reuses it across requests.
+    # They share one ETag cache, so repeat list calls send If-None-Match and unchanged
+    # pages come back as a 304.
+    http_cache = DjangoHttpCache(namespace=session_id)
+    local = threading.local()
+
+    def thread_http():
+        http = getattr(local, 'http', None)
+        if http is None:
+            http = local.http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(cache=http_cache))
+        return http
+
+    def build_request(http, *args, **kwargs):
+        request = MeteredHttpRequest(thread_http(), *args, **kwargs)
+        request.quota_user = session_id
+        return request
+
+    client = build('youtube', 'v3', credentials=credentials, requestBuilder=build_request)
+    return client, tokens.expires_in
+
+
+def get_youtube_client(session_id):
+    return youtube_clients.get(session_id, lambda: _load_youtube_client(session_id))
+
+
+async def acheck_tokens(session_id):
+    return await Youtube_token.objects.filter(user=session_id).afirst()
+
+
+async def acreate_or_update_tokens(session_id, access_token, refresh_token, expires_in, token_type):
+    await Youtube_token.objects.aupdate_or_create(user=session_id, defaults={
+        'access_token': access_token,
+        'refresh_token': refresh_token,
+        'expires_in': timezone.now() + timedelta(seconds=expires_in),
+        'token_type': token_type,
+        'refresh_lease_until': None,
+    })
+    youtube_clients.invalidate(session_id)
+
+
+async def arefresh_tokens(session_id):
+    """Refresh once per session and event loop, tasks can't be awaited from another loop"""
+    key = (session_id, id(asyncio.get_running_loop()))
+    return await async_token_refreshes.do(key, lambda: arefresh_token_func(session_id))
+
+
+async def arefresh_token_func(session_id):
+    tokens = await arefresh_with_lease(Youtube_token, session_id, _arequest_refresh)
+    youtube_clients.invalidate(session_id)
+    return tokens
+
+
+async def _arequest_refresh(refresh_token):
+    response = await async_client('google_oauth').post('https://oauth2.googleapis.com/token', data={
+        'client_id': YOUTUBE_CLIENT_ID,
+        'client_secret': YOUTUBE_CLIENT_SECRET,
+        'refresh_token': refresh_token,
+        'grant_type': 'refresh_token'
+    })
+    return _refresh_response(response.json(), refresh_token)
+
+
+async def aget_youtube_token(session_id) -> Optional[str]:
+    """Access token of a session for the async services, refreshed first if it has expired"""
+    tokens = await acheck_tokens(session_id)
+    if not tokens:
+        return None
+
+    if is_expired(tokens):
+        tokens = await arefresh_tokens(session_id)
+    elif needs_refresh(tokens):
+        # Refreshed on the shared pool, not a task that would die with this request's loop
+        refresh_in_background(lambda: refresh_tokens(session_id))
+
+    return tokens.access_token if tokens else None
@@ -0,0 +1,63 @@
+import hashlib
+import logging
+from typing import Any, Optional
+
+from django.core.cache import cache
+
+from newMusicCleaner.settings import YOUTUBE_HTTP_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+
+class DjangoHttpCache:
+    """httplib2 response cache stored in the Django cache.
+
+    httplib2 keeps each GET response under its URL and, once the entry is
+    stale, revalidates it with If-None-Match; a 304 is answered from the
+    stored body. Responses are user specific, so entries are namespaced per
+    session. Cache errors only cost the conditional request, never the call.
+
+    The async service keeps its own entries in the same store through `aget`
+    and `aset`, under keys httplib2 never uses.
+    """
+
+    def __init__(self, namespace: str, ttl: int = YOUTUBE_HTTP_CACHE_TTL):
+        self.namespace = namespace
+        self.ttl = ttl
+
+    def _key(self, key: str) -> str:
+        # httplib2 keys are full URLs, too long and unsafe for memcached
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return f"youtube-http:{self.namespace}:{digest}"
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            return cache.get(self._key(key))
+        except Exception as e:
+            logger.warning(f"Failed to read HTTP cache: {e}")
+            return None
+
+    def set(self, key: str, value: bytes) -> None:
+        try:
+            cache.set(self._key(key), value, self.ttl)
+        except Exception as e:
+            logger.warning(f"Failed to write HTTP cache: {e}")
+
+    def delete(self, key: str) -> None:
+        try:
+            cache.delete(self._key(key))
+        except Exception as e:
+            logger.warning(f"Failed to delete from HTTP cache: {e}")
+
+    async def aget(self, key: str) -> Optional[Any]:
+        try:
+            return await cache.aget(self._key(key))
+        except Exception as e:
+            logger.warning(f"Failed to read HTTP cache: {e}")
+            return None
+
+    async def aset(self, key: str, value: Any) -> None:
+        try:
+            await cache.aset(self._key(key), value, self.ttl)
+        except Exception as e:
+            logger.warning(f"Failed to write HTTP cache: {e}")
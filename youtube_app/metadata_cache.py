@@ -0,0 +1,113 @@
+import logging
+import threading
+from datetime import timedelta
+from typing import Dict, Iterable, Optional, Tuple
+
+from cachetools import LRUCache
+from django.utils import timezone
+
+from newMusicCleaner.metrics import record_cache_lookups
+from newMusicCleaner.settings import (
+    YOUTUBE_METADATA_CACHE_SIZE,
+    YOUTUBE_METADATA_CACHE_TTL,
+    YOUTUBE_METADATA_CACHE_MISS_TTL
+)
+from .models import VideoMetadata
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataCache:
+    """videoId -> YTMusic song metadata, backed by the VideoMetadata table.
+
+    A cached value of None records a miss, i.e. a video that had no matching
+    song and fell back to basic metadata, so it is not searched again until its
+    (shorter) TTL runs out.
+    """
+
+    def __init__(self, maxsize: int = YOUTUBE_METADATA_CACHE_SIZE,
+                 ttl: int = YOUTUBE_METADATA_CACHE_TTL,
+                 miss_ttl: int = YOUTUBE_METADATA_CACHE_MISS_TTL):
+        self._entries = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self.ttl = timedelta(seconds=ttl)
+        self.miss_ttl = timedelta(seconds=miss_ttl)
+
+    def _is_fresh(self, entry: Tuple[Optional[Dict], object]) -> bool:
+        metadata, checked_at = entry
+        ttl = self.ttl if metadata else self.miss_ttl
+        return checked_at + ttl > timezone.now()
+
+    def get_many(self, video_ids: Iterable[str]) -> Dict[str, Optional[Dict]]:
+        """Return fresh cached metadata keyed by video id; None values are recorded misses"""
+        found = {}
+        missing = []
+
+        with self._lock:
+            for video_id in video_ids:
+                entry = self._entries.get(video_id)
+                if entry and self._is_fresh(entry):
+                    found[video_id] = entry[0]
+                else:
+                    missing.append(video_id)
+        hits = len(found)
+
+        if missing:
+            try:
+                for row in VideoMetadata.objects.filter(video_id__in=missing):
+                    metadata = None
+                    if row.matched:
+                        metadata = {
+                            'id': row.video_id,
+                            'title': row.title,
+                            'artists': row.artists,
+                            'explicit': row.explicit,
+                            'url': f"https://www.music.youtube.com/watch?v={row.video_id}"
+                        }
+                    entry = (metadata, row.checked_at)
+                    if self._is_fresh(entry):
+                        found[row.video_id] = metadata
+                        with self._lock:
+                            self._entries[row.video_id] = entry
+            except Exception as e:
+                logger.error(f"Failed to read metadata cache: {e}")
+
+        record_cache_lookups('youtube_metadata', len(found), hits + len(missing) - len(found))
+        return found
+
+    def set_many(self, results: Dict[str, Optional[Dict]]) -> None:
+        """Store get_song_metadata results keyed by video id, None for a miss"""
+        if not results:
+            return
+
+        now = timezone.now()
+        rows = []
+
+        with self._lock:
+            for video_id, metadata in results.items():
+                self._entries[video_id] = (metadata, now)
+                rows.append(VideoMetadata(
+                    video_id=video_id,
+                    matched=metadata is not None,
+                    title=(metadata or {}).get('title') or '',
+                    artists=(metadata or {}).get('artists') or [],
+                    explicit=bool((metadata or {}).get('explicit')),
+                    checked_at=now
+                ))
+
+        try:
+            VideoMetadata.objects.bulk_create(
+                rows,
+                update_conflicts=True,
+                unique_fields=['video_id'],
+                update_fields=['matched', 'title', 'artists', 'explicit', 'checked_at']
+            )
+        except Exception as e:
+            logger.error(f"Failed to write metadata cache: {e}")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+metadata_cache = MetadataCache()
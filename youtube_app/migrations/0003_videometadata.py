@@ -0,0 +1,25 @@
+# Generated by Django 5.1.2 on 2026-10-18 09:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('youtube_app', '0002_rename_youtubetoken_youtube_token'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VideoMetadata',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('video_id', models.CharField(max_length=50, unique=True)),
+                ('matched', models.BooleanField(default=True)),
+                ('title', models.CharField(blank=True, max_length=500)),
+                ('artists', models.JSONField(blank=True, default=list)),
+                ('explicit', models.BooleanField(default=False)),
+                ('checked_at', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.2 on 2026-10-18 10:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('youtube_app', '0003_videometadata'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuotaUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('user', models.CharField(max_length=50)),
+                ('units', models.IntegerField(default=0)),
+                ('calls', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('day', 'user'), name='unique_quota_usage')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 10:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('youtube_app', '0004_quotausage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='youtube_token',
+            name='refresh_lease_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -8,3 +8,29 @@ class Youtube_token(models.Model):
     refresh_token = models.CharField(max_length=500)
     expires_in = models.DateTimeField()
     token_type = models.CharField(max_length=50)
+    # Set while one process refreshes the token, see newMusicCleaner/token_lease.py
+    refresh_lease_until = models.DateTimeField(null=True, blank=True)
+
+
+class VideoMetadata(models.Model):
+    """YTMusic metadata resolved for a video, shared across users"""
+    video_id = models.CharField(unique=True, max_length=50)
+    matched = models.BooleanField(default=True)
+    title = models.CharField(max_length=500, blank=True)
+    artists = models.JSONField(default=list, blank=True)
+    explicit = models.BooleanField(default=False)
+    checked_at = models.DateTimeField()
+
+
+class QuotaUsage(models.Model):
+    """YouTube Data API quota units spent by one user on one quota day"""
+    day = models.DateField()
+    user = models.CharField(max_length=50)
+    units = models.IntegerField(default=0)
+    calls = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'user'], name='unique_quota_usage')
+        ]
@@ -0,0 +1,176 @@
+import logging
+import time
+from collections import Counter
+from itertools import accumulate
+from typing import Dict, List, Optional
+
+from googleapiclient.errors import HttpError
+
+from newMusicCleaner.metrics import UPSTREAM_RETRIES, track_upstream
+from newMusicCleaner.settings import YOUTUBE_INSERT_BATCH_SIZE, YOUTUBE_INSERT_MAX_RETRIES
+from .quota import quota_ledger, request_cost
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUSES = {409, 429, 500, 502, 503, 504}
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, HttpError):
+        if error.resp.status in RETRYABLE_STATUSES:
+            return True
+        # An earlier item in the same batch failed, so this item's position is past the end
+        return error.resp.status == 400 and 'position' in str(error).lower()
+    return True
+
+
+class PlaylistWriter:
+    """Inserts videos into a playlist through batched playlistItems().insert calls.
+
+    Each item is inserted at an explicit position so the playlist keeps the
+    order of `video_ids` even when the server handles a batch out of order.
+    Transient failures are retried with backoff. Only the items whose own
+    response was an error are retried; when a whole batch call fails, the
+    playlist is read back first so items that went through aren't inserted
+    twice. Batched calls bypass MeteredHttpRequest, so their quota is
+    recorded here against `quota_user`.
+    """
+
+    def __init__(self, youtube, batch_size: int = YOUTUBE_INSERT_BATCH_SIZE,
+                 max_retries: int = YOUTUBE_INSERT_MAX_RETRIES, quota_user: str = None):
+        self.youtube = youtube
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.quota_user = quota_user
+
+    def _insert_request(self, playlist_id: str, video_id: str, position: int):
+        return self.youtube.playlistItems().insert(
+            part='snippet',
+            body={
+                'snippet': {
+                    'playlistId': playlist_id,
+                    'position': position,
+                    'resourceId': {
+                        'kind': 'youtube#video',
+                        'videoId': video_id
+                    }
+                }
+            }
+        )
+
+    def _playlist_video_ids(self, playlist_id: str) -> Optional[List[str]]:
+        """Video ids of a playlist in order, or None if it can't be read"""
+        video_ids = []
+        try:
+            request = self.youtube.playlistItems().list(part='contentDetails', playlistId=playlist_id, maxResults=50)
+            while request is not None:
+                response = request.execute()
+                video_ids.extend(item['contentDetails']['videoId'] for item in response.get('items', []))
+                request = self.youtube.playlistItems().list_next(request, response)
+        except Exception as e:
+            logger.error(f"Failed to read back playlist {playlist_id}: {e}")
+            return None
+        return video_ids
+
+    def _landed(self, playlist_id: str, video_ids: List[str], results: List[Dict],
+                unknown: List[int], start_position: int) -> Optional[set]:
+        """Which of the `unknown` items of a failed batch call are in the playlist after all.
+
+        Everything from `start_position` on was inserted by this writer, so a
+        video found there more often than it was confirmed went through.
+        """
+        current = self._playlist_video_ids(playlist_id)
+        if current is None:
+            return None
+        extra = Counter(current[start_position:]) - Counter(
+            result['video_id'] for result in results if result['success']
+        )
+        landed = set()
+        for index in unknown:
+            if extra[video_ids[index]]:
+                extra[video_ids[index]] -= 1
+                landed.add(index)
+        return landed
+
+    def add_tracks(self, playlist_id: str, video_ids: List[str], start_position: int = 0) -> List[Dict]:
+        """Insert every video and return one result per item, in the original order"""
+        results = [
+            {'video_id': video_id, 'success': False, 'error': None}
+            for video_id in video_ids
+        ]
+        todo = list(range(len(video_ids)))
+
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(2 ** (attempt - 1))
+
+            # Retries go one at a time: their positions are in the middle of the playlist, so a
+            # failed neighbour in the same batch would leave them at a valid but wrong position
+            batch_size = self.batch_size if attempt == 0 else 1
+            retry = []
+            for i in range(0, len(todo), batch_size):
+                chunk = todo[i:i + batch_size]
+                errors = {}
+                answered = set()
+
+                def callback(request_id, response, exception):
+                    answered.add(int(request_id))
+                    if exception is not None:
+                        errors[int(request_id)] = exception
+
+                # An item's position counts the inserted items that come before it in the original order
+                inserted_before = list(accumulate((result['success'] for result in results), initial=0))
+                batch = self.youtube.new_batch_http_request(callback=callback)
+                cost = 0
+                for offset, index in enumerate(chunk):
+                    position = start_position + inserted_before[index] + offset
+                    request = self._insert_request(playlist_id, video_ids[index], position)
+                    cost += request_cost(request.methodId)
+                    batch.add(request, request_id=str(index))
+
+                try:
+                    with track_upstream('youtube', 'youtube.batch') as call:
+                        batch.execute()
+                        call.status = '200'
+                except Exception as e:
+                    logger.error(f"Playlist insert batch failed: {e}")
+                    unanswered = [index for index in chunk if index not in answered]
+                    for index in unanswered:
+                        errors[index] = e
+                else:
+                    unanswered = []
+                finally:
+                    quota_ledger.record(self.quota_user, cost, calls=len(chunk))
+
+                for index in chunk:
+                    if index not in errors:
+                        results[index]['success'] = True
+                        results[index]['error'] = None
+
+                if unanswered:
+                    # Some of these may have been inserted before the call broke off
+                    landed = self._landed(playlist_id, video_ids, results, unanswered, start_position)
+                    for index in unanswered:
+                        if landed is not None and index in landed:
+                            results[index]['success'] = True
+                            results[index]['error'] = None
+                            del errors[index]
+                        elif landed is None:
+                            # Unknown whether it went through, a retry could insert it twice
+                            results[index]['error'] = str(errors.pop(index))
+
+                for index, error in errors.items():
+                    results[index]['error'] = str(error)
+                    if is_retryable(error):
+                        retry.append(index)
+
+            if not retry:
+                break
+            todo = sorted(retry)
+            UPSTREAM_RETRIES.inc(len(todo), service='youtube', endpoint='youtube.playlistItems.insert')
+            logger.warning(f"Retrying {len(todo)} playlist inserts")
+
+        for result in results:
+            if not result['success']:
+                logger.error(f"Failed to add track {result['video_id']} to playlist: {result['error']}")
+        return results
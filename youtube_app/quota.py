@@ -0,0 +1,308 @@
+import logging
+import math
+from datetime import date, datetime, time, timedelta
+from typing import Callable, Dict, Optional, TypeVar
+from zoneinfo import ZoneInfo
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+
+from newMusicCleaner.metrics import track_upstream
+
+from newMusicCleaner.settings import (
+    YOUTUBE_DAILY_QUOTA,
+    YOUTUBE_QUOTA_RESERVE,
+    YOUTUBE_USER_DAILY_QUOTA,
+    YOUTUBE_SECONDS_PER_TRACK
+)
+from .models import QuotaUsage
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# The daily quota resets at midnight Pacific time
+QUOTA_TIMEZONE = ZoneInfo('America/Los_Angeles')
+
+LIST_COST = 1
+WRITE_COST = 50
+METHOD_COSTS = {
+    'youtube.search.list': 100,
+}
+
+PAGE_SIZE = 50
+
+
+def request_cost(method_id: str) -> int:
+    """Quota units charged for one call to a YouTube Data API method, e.g. youtube.playlistItems.insert"""
+    if method_id in METHOD_COSTS:
+        return METHOD_COSTS[method_id]
+    return LIST_COST if method_id.endswith('.list') else WRITE_COST
+
+
+def quota_day(now: Optional[datetime] = None) -> date:
+    return (now or timezone.now()).astimezone(QUOTA_TIMEZONE).date()
+
+
+def next_reset(now: Optional[datetime] = None) -> datetime:
+    tomorrow = quota_day(now) + timedelta(days=1)
+    return datetime.combine(tomorrow, time.min, tzinfo=QUOTA_TIMEZONE)
+
+
+class QuotaLedger:
+    """Quota units spent per user and quota day, summed for the project on read"""
+
+    def record(self, user: Optional[str], units: int, calls: int = 1) -> None:
+        user = user or ''
+        day = quota_day()
+        try:
+            updated = QuotaUsage.objects.filter(day=day, user=user).update(
+                units=F('units') + units,
+                calls=F('calls') + calls
+            )
+            if not updated:
+                try:
+                    QuotaUsage.objects.create(day=day, user=user, units=units, calls=calls)
+                except IntegrityError:
+                    # Another request created today's row first
+                    QuotaUsage.objects.filter(day=day, user=user).update(
+                        units=F('units') + units,
+                        calls=F('calls') + calls
+                    )
+        except Exception as e:
+            logger.error(f"Failed to record {units} quota units for {user}: {e}")
+
+    async def arecord(self, user: Optional[str], units: int, calls: int = 1) -> None:
+        """`record` for the async services, through the async ORM"""
+        user = user or ''
+        day = quota_day()
+        try:
+            updated = await QuotaUsage.objects.filter(day=day, user=user).aupdate(
+                units=F('units') + units,
+                calls=F('calls') + calls
+            )
+            if not updated:
+                try:
+                    await QuotaUsage.objects.acreate(day=day, user=user, units=units, calls=calls)
+                except IntegrityError:
+                    await QuotaUsage.objects.filter(day=day, user=user).aupdate(
+                        units=F('units') + units,
+                        calls=F('calls') + calls
+                    )
+        except Exception as e:
+            logger.error(f"Failed to record {units} quota units for {user}: {e}")
+
+    def usage(self, user: Optional[str] = None, day: Optional[date] = None) -> int:
+        """Units spent on `day` (today by default) by `user`, or by the whole project"""
+        rows = QuotaUsage.objects.filter(day=day or quota_day())
+        if user is not None:
+            rows = rows.filter(user=user)
+        return rows.aggregate(units=Sum('units'))['units'] or 0
+
+    def report(self, user: str) -> Dict:
+        project_units = self.usage()
+        return {
+            'day': quota_day(),
+            'user_units': self.usage(user),
+            'user_limit': YOUTUBE_USER_DAILY_QUOTA,
+            'project_units': project_units,
+            'project_limit': YOUTUBE_DAILY_QUOTA,
+            'remaining': max(0, YOUTUBE_DAILY_QUOTA - project_units),
+            'resets_at': next_reset(),
+        }
+
+
+quota_ledger = QuotaLedger()
+
+
+class MeteredHttpRequest(HttpRequest):
+    """HttpRequest that records its quota cost against `quota_user` once executed.
+
+    Failed calls are charged too, as they are by YouTube. Latency and status go
+    to the upstream metrics. Calls inside a batch never go through execute and
+    are recorded by the batch's owner.
+    """
+    quota_user = None
+
+    def execute(self, http=None, num_retries=0):
+        try:
+            with track_upstream('youtube', self.methodId) as call:
+                try:
+                    response = super().execute(http=http, num_retries=num_retries)
+                except HttpError as e:
+                    call.status = str(e.resp.status)
+                    raise
+                call.status = '200'
+                return response
+        finally:
+            quota_ledger.record(self.quota_user, request_cost(self.methodId))
+
+
+class QuotaExceeded(Exception):
+    """Raised when a conversion can't be admitted against the YouTube quota"""
+
+
+class QuotaDecision:
+    """When a conversion may run: now, at a later quota reset, or not at all.
+
+    `insert_limit` is set when the conversion needs more than one day's quota:
+    it may insert that many tracks on its first day, the rest are scheduled
+    once those are done. `estimated_cost` is what it reserves for that day.
+    """
+
+    def __init__(self, estimated_cost: int, run_at: Optional[datetime] = None,
+                 estimated_completion: Optional[datetime] = None, reason: str = '',
+                 insert_limit: Optional[int] = None):
+        self.estimated_cost = estimated_cost
+        self.run_at = run_at
+        self.estimated_completion = estimated_completion
+        self.reason = reason
+        self.insert_limit = insert_limit
+
+    @property
+    def rejected(self) -> bool:
+        return self.run_at is None
+
+    @property
+    def delayed(self) -> bool:
+        return self.run_at is not None and self.run_at > timezone.now()
+
+    @property
+    def split(self) -> bool:
+        return self.insert_limit is not None
+
+
+class QuotaScheduler:
+    """Admits YouTube conversions against the remaining daily quota.
+
+    A conversion that fits in what is left today, after `reserve` units kept
+    back for browsing, runs now. One that only fits in a fresh day waits for
+    the next reset with room for it. One that needs more than a day's quota is
+    split: it starts on the first day with room to read the playlist, create
+    the new one and insert at least one track, and inserts the rest on the
+    following days. Units are counted against what conversions queued or
+    running on that day have reserved, and `admit` reserves them under a lock
+    together with creating the job, so concurrent requests can't both take
+    the same units.
+    """
+
+    def __init__(self, ledger: QuotaLedger = quota_ledger, daily_quota: int = YOUTUBE_DAILY_QUOTA,
+                 reserve: int = YOUTUBE_QUOTA_RESERVE, user_quota: int = YOUTUBE_USER_DAILY_QUOTA,
+                 seconds_per_track: float = YOUTUBE_SECONDS_PER_TRACK, max_delay_days: int = 7):
+        self.ledger = ledger
+        self.daily_quota = daily_quota
+        self.reserve = reserve
+        self.user_quota = user_quota
+        self.seconds_per_track = seconds_per_track
+        self.max_delay_days = max_delay_days
+
+    def fixed_cost(self, num_tracks: int) -> int:
+        """Units a conversion spends before inserting: reading the playlist and creating the new one"""
+        reads = math.ceil(num_tracks / PAGE_SIZE) + 2
+        return reads * LIST_COST + WRITE_COST
+
+    def estimate_cost(self, num_tracks: int) -> int:
+        """Units a conversion of `num_tracks` tracks spends: reading, creating the playlist and inserting"""
+        return self.fixed_cost(num_tracks) + num_tracks * WRITE_COST
+
+    def _scheduled(self, day: date, user: Optional[str] = None) -> int:
+        """Units reserved by conversions queued to start on `day` or running since.
+
+        A running conversion keeps its whole reservation until it finishes, so
+        the units it already spent count twice meanwhile, erring on the side of
+        not overspending.
+        """
+        from spotify_app.models import ConversionJob
+
+        start = datetime.combine(day, time.min, tzinfo=QUOTA_TIMEZONE)
+        jobs = ConversionJob.objects.filter(
+            platform='youtube',
+            status__in=[ConversionJob.QUEUED, ConversionJob.RUNNING],
+            run_at__gte=start,
+            run_at__lt=start + timedelta(days=1)
+        )
+        if user is not None:
+            jobs = jobs.filter(user=user)
+        return jobs.aggregate(units=Sum('quota_cost'))['units'] or 0
+
+    def _room(self, day: date, user: str, spent_project: int = 0, spent_user: int = 0) -> int:
+        project_left = self.daily_quota - self.reserve - spent_project - self._scheduled(day)
+        user_left = self.user_quota - spent_user - self._scheduled(day, user)
+        return min(project_left, user_left)
+
+    def _duration(self, inserts: int) -> timedelta:
+        return timedelta(seconds=inserts * self.seconds_per_track)
+
+    def _plan(self, user: str, fixed: int, inserts: int) -> QuotaDecision:
+        cost = fixed + inserts * WRITE_COST
+        now = timezone.now()
+        today = quota_day(now)
+        room = self._room(today, user, self.ledger.usage(day=today), self.ledger.usage(user, today))
+        run_at = now
+
+        for _ in range(self.max_delay_days + 1):
+            starts = 'now' if run_at == now else f"at {run_at:%Y-%m-%d %H:%M %Z}"
+            if cost <= room:
+                return QuotaDecision(
+                    cost,
+                    run_at=run_at,
+                    estimated_completion=run_at + self._duration(inserts),
+                    reason='' if run_at == now else f"Not enough YouTube quota left today, "
+                                                    f"the conversion will start {starts}"
+                )
+            insert_limit = (room - fixed) // WRITE_COST
+            if insert_limit > 0:
+                per_day = max(1, min(self.daily_quota - self.reserve, self.user_quota) // WRITE_COST)
+                rest = inserts - insert_limit
+                days = math.ceil(rest / per_day)
+                return QuotaDecision(
+                    fixed + insert_limit * WRITE_COST,
+                    run_at=run_at,
+                    estimated_completion=next_reset(run_at) + timedelta(days=days - 1)
+                                         + self._duration(rest - (days - 1) * per_day),
+                    reason=f"Not enough YouTube quota for all {inserts} tracks in one day, the first "
+                           f"{insert_limit} are added {starts} and the rest over the next {days} day(s)",
+                    insert_limit=insert_limit
+                )
+            run_at = next_reset(run_at)
+            room = self._room(quota_day(run_at), user)
+
+        return QuotaDecision(cost, reason="The YouTube quota is booked for the next week, try again later")
+
+    def schedule(self, user: str, num_tracks: int) -> QuotaDecision:
+        """When a conversion of `num_tracks` tracks can run, without reserving anything"""
+        return self._plan(user, self.fixed_cost(num_tracks), num_tracks)
+
+    def schedule_inserts(self, user: str, num_inserts: int) -> QuotaDecision:
+        """When the inserts a split conversion has left can run"""
+        return self._plan(user, 0, num_inserts)
+
+    def _admit(self, decide: Callable[[], QuotaDecision], create: Callable[[QuotaDecision], T]) -> T:
+        day = quota_day()
+        QuotaUsage.objects.get_or_create(day=day, user='')
+        with transaction.atomic():
+            # Every admission writes today's project row first, which holds the
+            # others off until this one's job is committed
+            QuotaUsage.objects.filter(day=day, user='').update(units=F('units'))
+            decision = decide()
+            if decision.rejected:
+                raise QuotaExceeded(decision.reason)
+            return create(decision)
+
+    def admit(self, user: str, num_tracks: int, create: Callable[[QuotaDecision], T]) -> T:
+        """Schedule a conversion and create its job with `create(decision)` in one transaction.
+
+        The job's `quota_cost` is the reservation; raises QuotaExceeded if no
+        day within `max_delay_days` has room.
+        """
+        return self._admit(lambda: self.schedule(user, num_tracks), create)
+
+    def admit_inserts(self, user: str, num_inserts: int, create: Callable[[QuotaDecision], T]) -> T:
+        """`admit` for the inserts a split conversion has left"""
+        return self._admit(lambda: self.schedule_inserts(user, num_inserts), create)
+
+
+quota_scheduler = QuotaScheduler()
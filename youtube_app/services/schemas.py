@@ -1,3 +1,4 @@
+from datetime import date, datetime
 from ninja import Schema
 from typing import List, Optional, Dict
 
@@ -20,6 +21,10 @@ class PlaylistResponse(Schema):
     tracks: Optional[List[TrackMetadataResponse]]
     external_urls: Dict[str, str]
 
+class PlaylistPageResponse(Schema):
+    items: List[PlaylistResponse]
+    next_cursor: Optional[str]
+
 class TrackResponse(Schema):
     id: str
     title: str
@@ -35,4 +40,18 @@ class PlaylistConversionResponse(Schema):
     num_converted: int
     num_still_missing: int
     still_missing: List[dict[str, str]]  # Each dict should have name, artists, query_url
-    potential_matches: dict[str, List[dict]]
\ No newline at end of file
+    potential_matches: dict[str, List[dict]]
+    num_failed_inserts: int = 0
+    failed_inserts: List[str] = []
+    num_deferred_inserts: int = 0
+    deferred_inserts: List[str] = []
+
+
+class QuotaUsageResponse(Schema):
+    day: date
+    user_units: int
+    user_limit: int
+    project_units: int
+    project_limit: int
+    remaining: int
+    resets_at: datetime
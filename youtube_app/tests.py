@@ -1 +1,495 @@
-# Create your tests here.
+import threading
+from concurrent.futures import Future
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import httplib2
+import httpx
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from googleapiclient.errors import HttpError
+
+from spotify_app.models import ConversionJob
+from youtube_app.async_service import AsyncYouTubeMusicService
+from youtube_app.http_cache import DjangoHttpCache
+from youtube_app.metadata_cache import MetadataCache
+from youtube_app.models import QuotaUsage, VideoMetadata
+from youtube_app.playlist_writer import PlaylistWriter
+from youtube_app.quota import QuotaExceeded, QuotaScheduler, next_reset, quota_day
+from youtube_app.yt_services import YouTubeMusicService
+
+
+def http_error(status):
+    return HttpError(httplib2.Response({'status': status}), b'{"error": {"message": "failed"}}')
+
+
+class FakeRequest:
+    def __init__(self, method_id, execute=None, **params):
+        self.methodId = method_id
+        self.params = params
+        self._execute = execute
+
+    def execute(self):
+        return self._execute()
+
+
+class FakeBatch:
+    def __init__(self, youtube, callback):
+        self.youtube = youtube
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        for request_id, request in self.requests:
+            snippet = request.params['body']['snippet']
+            video_id = snippet['resourceId']['videoId']
+            failures = self.youtube.failures.get(video_id)
+            if failures:
+                self.youtube.failures[video_id] = failures[1:]
+                self.callback(request_id, None, http_error(failures[0]))
+                continue
+
+            self.youtube.items.insert(snippet['position'], video_id)
+            if self.youtube.break_after is not None:
+                self.youtube.break_after -= 1
+                if not self.youtube.break_after:
+                    # The insert went through but its answer is lost
+                    self.youtube.break_after = None
+                    raise ConnectionError('connection reset')
+            self.callback(request_id, {}, None)
+
+
+class FakeYouTube:
+    """playlistItems insert and list, and batches of inserts, against one in-memory playlist"""
+
+    def __init__(self, failures=None, break_after=None, readable=True):
+        self.items = []
+        self.failures = failures or {}
+        self.break_after = break_after
+        self.readable = readable
+
+    def playlistItems(self):
+        return self
+
+    def insert(self, part, body):
+        return FakeRequest('youtube.playlistItems.insert', part=part, body=body)
+
+    def list(self, **params):
+        def execute():
+            if not self.readable:
+                raise http_error(500)
+            return {'items': [{'contentDetails': {'videoId': video_id}} for video_id in self.items]}
+        return FakeRequest('youtube.playlistItems.list', execute, **params)
+
+    def list_next(self, request, response):
+        return None
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+
+@mock.patch('youtube_app.playlist_writer.time.sleep')
+class PlaylistWriterTests(TestCase):
+    video_ids = [f"video-{n}" for n in range(7)]
+
+    def add_tracks(self, youtube, video_ids=None, **kwargs):
+        return PlaylistWriter(youtube, batch_size=3, max_retries=2, **kwargs).add_tracks(
+            'playlist', video_ids or self.video_ids
+        )
+
+    def test_inserts_every_video_in_order(self, sleep):
+        youtube = FakeYouTube()
+
+        results = self.add_tracks(youtube)
+
+        self.assertEqual(youtube.items, self.video_ids)
+        self.assertTrue(all(result['success'] for result in results))
+        sleep.assert_not_called()
+
+    def test_only_failed_items_are_retried(self, sleep):
+        youtube = FakeYouTube(failures={'video-1': [503], 'video-4': [409, 500]})
+
+        results = self.add_tracks(youtube)
+
+        self.assertEqual(youtube.items, self.video_ids)
+        self.assertTrue(all(result['success'] for result in results))
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_permanent_errors_are_not_retried(self, sleep):
+        youtube = FakeYouTube(failures={'video-2': [404, 404]})
+
+        results = self.add_tracks(youtube)
+
+        self.assertEqual(youtube.items, [video_id for video_id in self.video_ids if video_id != 'video-2'])
+        self.assertEqual([result['success'] for result in results], [True, True, False, True, True, True, True])
+        self.assertIn('404', results[2]['error'])
+        sleep.assert_not_called()
+
+    def test_retries_run_out(self, sleep):
+        youtube = FakeYouTube(failures={'video-0': [503, 503, 503]})
+
+        results = self.add_tracks(youtube)
+
+        self.assertFalse(results[0]['success'])
+        self.assertEqual(youtube.items, self.video_ids[1:])
+
+    def test_items_of_a_broken_batch_that_went_through_are_not_inserted_twice(self, sleep):
+        # The first batch breaks off after its second item went through, before it was answered
+        youtube = FakeYouTube(break_after=2)
+
+        results = self.add_tracks(youtube)
+
+        self.assertEqual(youtube.items, self.video_ids)
+        self.assertTrue(all(result['success'] for result in results))
+
+    def test_duplicate_videos_of_a_broken_batch_are_told_apart(self, sleep):
+        video_ids = ['video-a', 'video-a', 'video-b', 'video-a']
+        youtube = FakeYouTube(break_after=1)
+
+        self.add_tracks(youtube, video_ids)
+
+        self.assertEqual(youtube.items, video_ids)
+
+    def test_items_of_a_broken_batch_are_not_retried_if_the_playlist_cant_be_read(self, sleep):
+        youtube = FakeYouTube(break_after=2, readable=False)
+
+        results = self.add_tracks(youtube)
+
+        self.assertEqual(sorted(youtube.items), [video_id for video_id in self.video_ids if video_id != 'video-2'])
+        self.assertEqual([result['success'] for result in results], [True, False, False, True, True, True, True])
+        self.assertIn('connection reset', results[1]['error'])
+        sleep.assert_not_called()
+
+    def test_quota_is_recorded_per_insert(self, sleep):
+        self.add_tracks(FakeYouTube(), quota_user='session')
+
+        usage = QuotaUsage.objects.get(day=quota_day(), user='session')
+        self.assertEqual((usage.units, usage.calls), (7 * 50, 7))
+
+
+class QuotaSchedulerTests(TestCase):
+    def scheduler(self, **kwargs):
+        options = {'daily_quota': 10000, 'reserve': 1000, 'user_quota': 5000, 'seconds_per_track': 1}
+        return QuotaScheduler(**{**options, **kwargs})
+
+    def spend(self, user, units):
+        QuotaUsage.objects.create(day=quota_day(), user=user, units=units)
+
+    def create_job(self, decision):
+        return ConversionJob.objects.create(
+            user='session',
+            platform='youtube',
+            playlist_id='playlist',
+            run_at=decision.run_at,
+            quota_cost=decision.estimated_cost,
+            insert_limit=decision.insert_limit
+        )
+
+    def test_estimate_covers_reads_playlist_creation_and_inserts(self):
+        scheduler = self.scheduler()
+
+        # Two pages of 50 tracks plus the playlist and channel lookups, then one insert per track
+        self.assertEqual(scheduler.fixed_cost(100), 4 + 50)
+        self.assertEqual(scheduler.estimate_cost(100), 54 + 100 * 50)
+
+    def test_conversion_that_fits_runs_now(self):
+        job = self.scheduler().admit('session', 10, self.create_job)
+
+        self.assertLessEqual(job.run_at, timezone.now())
+        self.assertEqual(job.quota_cost, self.scheduler().estimate_cost(10))
+        self.assertIsNone(job.insert_limit)
+
+    def test_conversion_waits_for_the_next_reset_when_today_is_spent(self):
+        self.spend('', 8950)
+
+        decision = self.scheduler().schedule('session', 10)
+
+        self.assertTrue(decision.delayed)
+        self.assertFalse(decision.split)
+        self.assertEqual(decision.run_at, next_reset())
+        self.assertEqual(decision.estimated_completion, next_reset() + timedelta(seconds=10))
+
+    def test_users_own_quota_is_enforced(self):
+        self.spend('session', 4990)
+
+        self.assertTrue(self.scheduler().schedule('session', 10).delayed)
+        self.assertFalse(self.scheduler().schedule('other-session', 10).delayed)
+
+    def test_conversion_larger_than_a_day_is_split(self):
+        decision = self.scheduler(user_quota=3000).schedule('session', 100)
+
+        self.assertFalse(decision.delayed)
+        self.assertEqual(decision.insert_limit, (3000 - 54) // 50)
+        self.assertEqual(decision.estimated_cost, 54 + decision.insert_limit * 50)
+        self.assertEqual(decision.estimated_completion.date(), next_reset().date())
+
+    def test_queued_conversions_reservations_count(self):
+        scheduler = self.scheduler(user_quota=3000)
+        scheduler.admit('session', 40, self.create_job)
+
+        job = scheduler.admit('session', 40, self.create_job)
+
+        # 3000 minus the first conversion's 2053 units leaves room for 17 inserts
+        self.assertEqual(job.insert_limit, 17)
+
+    def test_finished_conversions_release_their_reservation(self):
+        scheduler = self.scheduler(user_quota=3000)
+        first = scheduler.admit('session', 40, self.create_job)
+        ConversionJob.objects.filter(pk=first.pk).update(status=ConversionJob.SUCCEEDED)
+
+        job = scheduler.admit('session', 40, self.create_job)
+
+        self.assertIsNone(job.insert_limit)
+
+    def test_remaining_inserts_of_a_split_conversion_have_no_fixed_cost(self):
+        self.assertEqual(self.scheduler().schedule_inserts('session', 10).estimated_cost, 500)
+
+    def test_conversion_without_room_within_the_delay_is_rejected(self):
+        self.spend('', 9000)
+
+        with self.assertRaises(QuotaExceeded):
+            self.scheduler(max_delay_days=0).admit('session', 10, self.create_job)
+        self.assertFalse(ConversionJob.objects.exists())
+
+
+@mock.patch('youtube_app.playlist_writer.time.sleep')
+class ResumeConversionTests(TestCase):
+    tracks = [
+        {'id': video_id, 'title': video_id, 'artists': ['Artist'], 'explicit': False, 'url': ''}
+        for video_id in ('day1-a', 'day1-b', 'day2-c', 'day2-d', 'day3-e')
+    ]
+
+    def setUp(self):
+        self.youtube = FakeYouTube()
+        self.service = YouTubeMusicService('session')
+        self.service._youtube = self.youtube
+        self.service._ytmusic = mock.MagicMock()
+        self.service.get_playlist_tracks = mock.MagicMock(return_value=self.tracks)
+        self.service.get_playlist = mock.MagicMock(return_value={'snippet': {'title': 'Playlist'}})
+        self.service.create_playlist = mock.MagicMock(return_value={'id': 'playlist'})
+
+    def convert_over_days(self, *insert_limits):
+        result = self.service.convert_playlist('original', insert_limit=insert_limits[0])
+        for insert_limit in insert_limits[1:]:
+            result = self.service.resume_conversion(result, result['deferred_inserts'], insert_limit=insert_limit)
+        return result
+
+    def test_deferred_inserts_go_after_earlier_days_tracks(self, sleep):
+        result = self.convert_over_days(2, 2, None)
+
+        self.assertEqual(self.youtube.items, [track['id'] for track in self.tracks])
+        self.assertEqual(result['deferred_inserts'], [])
+        self.assertEqual(result['failed_inserts'], [])
+
+    def test_failed_inserts_of_earlier_days_leave_no_gap(self, sleep):
+        self.youtube.failures = {'day1-b': [404]}
+
+        result = self.convert_over_days(2, None)
+
+        self.assertEqual(self.youtube.items, ['day1-a', 'day2-c', 'day2-d', 'day3-e'])
+        self.assertEqual(result['failed_inserts'], ['day1-b'])
+
+    def test_broken_batch_on_a_later_day_isnt_confused_by_earlier_tracks(self, sleep):
+        result = self.service.convert_playlist('original', insert_limit=2)
+        # The first insert of the second day goes through but its answer is lost
+        self.youtube.break_after = 1
+
+        self.service.resume_conversion(result, result['deferred_inserts'])
+
+        self.assertEqual(self.youtube.items, [track['id'] for track in self.tracks])
+
+
+class PlaylistReaderTests(TestCase):
+    def setUp(self):
+        self.youtube = mock.MagicMock()
+        self.youtube.playlistItems().list().execute.return_value = {
+            'items': [
+                {'snippet': {'title': f"Song {n}"}, 'contentDetails': {'videoId': f"video-{n}"}}
+                for n in range(3)
+            ],
+            'nextPageToken': 'page-2',
+        }
+        self.service = YouTubeMusicService('session')
+        self.service._youtube = self.youtube
+        self.service._ytmusic = mock.MagicMock()
+
+    @mock.patch('youtube_app.yt_services.metadata_cache')
+    @mock.patch('youtube_app.yt_services.page_executor')
+    def test_prefetched_page_is_cancelled_when_the_caller_stops(self, page_executor, metadata_cache):
+        metadata_cache.get_many.side_effect = lambda video_ids: {
+            video_id: {'title': video_id, 'artists': ['Artist'], 'explicit': False} for video_id in video_ids
+        }
+        next_page = page_executor.submit.return_value = Future()
+        # Tracks are handed out while the page is still being looked up
+        self.service.max_in_flight = 1
+
+        tracks = self.service.iter_playlist_tracks('playlist')
+        next(tracks)
+        tracks.close()
+
+        self.assertTrue(next_page.cancelled())
+
+
+class MetadataCacheTests(TestCase):
+    song = {'id': 'video', 'title': 'Song', 'artists': ['Artist'], 'explicit': True,
+            'url': 'https://www.music.youtube.com/watch?v=video'}
+
+    def setUp(self):
+        self.cache = MetadataCache(maxsize=10, ttl=3600, miss_ttl=60)
+
+    def test_stored_songs_and_misses_are_returned(self):
+        self.cache.set_many({'video': self.song, 'no-song': None})
+
+        self.assertEqual(self.cache.get_many(['video', 'no-song', 'unknown']), {'video': self.song, 'no-song': None})
+
+    def test_entries_outlive_the_process_in_the_database(self):
+        self.cache.set_many({'video': self.song, 'no-song': None})
+        self.cache.clear()
+
+        self.assertEqual(self.cache.get_many(['video', 'no-song']), {'video': self.song, 'no-song': None})
+        self.assertEqual(VideoMetadata.objects.count(), 2)
+
+    def test_misses_expire_sooner_than_songs(self):
+        self.cache.set_many({'video': self.song, 'no-song': None})
+        later = timezone.now() + timedelta(minutes=5)
+
+        with mock.patch('youtube_app.metadata_cache.timezone.now', return_value=later):
+            self.assertEqual(self.cache.get_many(['video', 'no-song']), {'video': self.song})
+
+    def test_stale_database_rows_are_ignored(self):
+        self.cache.set_many({'video': self.song})
+        self.cache.clear()
+        VideoMetadata.objects.update(checked_at=timezone.now() - timedelta(hours=2))
+
+        self.assertEqual(self.cache.get_many(['video']), {})
+
+    def test_songs_are_updated_in_place(self):
+        self.cache.set_many({'video': None})
+        self.cache.set_many({'video': self.song})
+        self.cache.clear()
+
+        self.assertEqual(self.cache.get_many(['video']), {'video': self.song})
+        self.assertEqual(VideoMetadata.objects.count(), 1)
+
+
+class ETagHandler(BaseHTTPRequestHandler):
+    etag = '"v1"'
+    body = b'{"items": []}'
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.send_header('ETag', self.etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DjangoHttpCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        ETagHandler.requests = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ETagHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/youtube/v3/playlistItems?playlistId=playlist"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self, namespace='session'):
+        return httplib2.Http(cache=DjangoHttpCache(namespace=namespace)).request(self.url)
+
+    def test_repeat_requests_are_revalidated_and_answered_from_the_cache(self):
+        self.get()
+
+        response, content = self.get()
+
+        self.assertEqual(ETagHandler.requests, [None, '"v1"'])
+        self.assertEqual(response.status, 200)
+        self.assertTrue(response.fromcache)
+        self.assertEqual(content, b'{"items": []}')
+
+    def test_changed_responses_are_fetched_again(self):
+        self.get()
+
+        with mock.patch.multiple(ETagHandler, etag='"v2"', body=b'{"items": [1]}'):
+            response, content = self.get()
+
+        self.assertFalse(response.fromcache)
+        self.assertEqual(content, b'{"items": [1]}')
+
+    def test_sessions_dont_share_entries(self):
+        self.get('session')
+
+        self.get('other-session')
+
+        self.assertEqual(ETagHandler.requests, [None, None])
+
+    def test_cache_errors_only_cost_the_conditional_request(self):
+        with mock.patch('youtube_app.http_cache.cache.get', side_effect=ConnectionError('down')), \
+                mock.patch('youtube_app.http_cache.cache.set', side_effect=ConnectionError('down')):
+            response, content = self.get()
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(content, b'{"items": []}')
+
+
+class AsyncListTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.requests = []
+        self.etag = '"v1"'
+        client = httpx.AsyncClient(transport=httpx.MockTransport(self.handle))
+        patcher = mock.patch('newMusicCleaner.async_http.async_client', return_value=client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('youtube_app.async_service.quota_ledger', arecord=mock.AsyncMock())
+        self.quota_ledger = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.service = AsyncYouTubeMusicService('session')
+        self.service._access_token = 'token'
+
+    def handle(self, request):
+        self.requests.append(request)
+        if request.headers.get('If-None-Match') == self.etag:
+            return httpx.Response(304, headers={'ETag': self.etag})
+        return httpx.Response(200, headers={'ETag': self.etag}, json={'items': [self.etag]})
+
+    async def test_repeat_reads_are_revalidated_and_answered_from_the_cache(self):
+        await self.service._list('playlistItems', part='snippet', playlistId='playlist')
+
+        response = await self.service._list('playlistItems', part='snippet', playlistId='playlist')
+
+        self.assertEqual(response, {'items': ['"v1"']})
+        self.assertEqual([request.headers.get('If-None-Match') for request in self.requests], [None, '"v1"'])
+        self.assertEqual(self.requests[0].headers['Authorization'], 'Bearer token')
+
+    async def test_changed_responses_replace_the_cached_body(self):
+        await self.service._list('playlistItems', playlistId='playlist')
+        self.etag = '"v2"'
+
+        response = await self.service._list('playlistItems', playlistId='playlist')
+
+        self.assertEqual(response, {'items': ['"v2"']})
+
+    async def test_every_read_is_charged_to_the_quota(self):
+        for _ in range(2):
+            await self.service._list('playlistItems', playlistId='playlist')
+
+        self.assertEqual(self.quota_ledger.arecord.await_args_list, [mock.call('session', 1)] * 2)
@@ -3,6 +3,7 @@ from django.shortcuts import redirect
 from requests import Request, post
 from rest_framework.views import APIView
 from .extras import create_or_update_tokens, is_youtube_authenticated
+from .yt_services import YouTubeMusicService
 from newMusicCleaner.settings import YOUTUBE_CLIENT_ID, YOUTUBE_CLIENT_SECRET, YOUTUBE_REDIRECT_URI, YOUTUBE_SCOPES
 
 
@@ -59,5 +60,7 @@ def youtube_redirect(request, format=None):
         expires_in=expires_in,
         token_type=token_type
     )
+    # The session may now belong to another account
+    YouTubeMusicService(request.session.session_key).invalidate_cache()
 
     return HttpResponseRedirect('/api/docs')
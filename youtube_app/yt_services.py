@@ -1,14 +1,80 @@
 import logging
-from typing import Dict, List
-import concurrent.futures
-from concurrent.futures import ThreadPoolExecutor
-from fuzzywuzzy import fuzz
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from collections import deque
+from itertools import islice
+from concurrent.futures import Future, ThreadPoolExecutor
 from ytmusicapi import YTMusic
-
+from ytmusicapi.exceptions import YTMusicServerError
+
+from newMusicCleaner.concurrency import AIMDLimiter
+from newMusicCleaner.matching import match_youtube_track, normalize_query, youtube_potential_matches
+from newMusicCleaner.settings import (
+    CONCURRENCY_BACKOFF,
+    YOUTUBE_METADATA_WORKERS,
+    YOUTUBE_METADATA_MAX_IN_FLIGHT,
+    YOUTUBE_SEARCH_WORKERS,
+    SESSION_PLAYLIST_CACHE_TTL,
+    YTMUSIC_CONCURRENCY_INITIAL,
+    YTMUSIC_CONCURRENCY_MAX,
+    YTMUSIC_LATENCY_TARGET,
+    YTMUSIC_SEARCH_DEPTHS
+)
+from newMusicCleaner.metrics import SEARCH_CANDIDATES, Counter, instrumented_session
+from newMusicCleaner.playlist_index import PlaylistIndex
+from newMusicCleaner.profiling import bind, stage
+from newMusicCleaner.session_cache import SessionCache
+from newMusicCleaner.singleflight import SingleFlight
 from youtube_app.extras import get_youtube_client
+from youtube_app.metadata_cache import metadata_cache
+from youtube_app.playlist_writer import PlaylistWriter
 
 logger = logging.getLogger(__name__)
 
+# Long-lived pools shared by every service instance, instead of one pool per page
+metadata_executor = ThreadPoolExecutor(max_workers=YOUTUBE_METADATA_WORKERS, thread_name_prefix='ytmusic-metadata')
+search_executor = ThreadPoolExecutor(max_workers=YOUTUBE_SEARCH_WORKERS, thread_name_prefix='ytmusic-search')
+page_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='youtube-pages')
+
+# YTMusic is used unauthenticated, so identical searches from any session can share one request
+ytmusic_searches = SingleFlight()
+# Adaptive limit on YTMusic searches from every service instance and both pools
+ytmusic_concurrency = AIMDLimiter(
+    'ytmusic', YTMUSIC_CONCURRENCY_INITIAL, 1, YTMUSIC_CONCURRENCY_MAX, YTMUSIC_LATENCY_TARGET, CONCURRENCY_BACKOFF
+)
+
+Counter(
+    'ytmusic_searches_coalesced_total',
+    'YTMusic searches answered by an identical search already in flight',
+    function=lambda: ytmusic_searches.coalesced
+)
+
+
+def search_songs(ytmusic: YTMusic, query: str, limit: int) -> List[Dict]:
+    """ytmusic.search for songs, joining an identical search that is already in flight"""
+    return ytmusic_searches.do(
+        (normalize_query(query), limit),
+        lambda: _search_songs(ytmusic, query, limit)
+    )
+
+
+def _search_songs(ytmusic: YTMusic, query: str, limit: int) -> List[Dict]:
+    with ytmusic_concurrency.slot() as call:
+        try:
+            return ytmusic.search(query, filter='songs', limit=limit)
+        except YTMusicServerError as e:
+            call.rate_limited = 'HTTP 429' in str(e)
+            raise
+
+
+def channel_user(channel: Dict) -> Dict:
+    """The user dict returned by get_user, from a channels.list item"""
+    custom_url = channel.get("snippet", {}).get("customUrl")
+    return {
+        'id': channel['id'],
+        'name': channel['snippet']['title'],
+        'external_urls': f"https://music.youtube.com/{custom_url}"
+    }
+
 
 class YouTubeMusicService:
     def __init__(self, session_id=None):
@@ -16,7 +82,13 @@ class YouTubeMusicService:
         self._ytmusic = None
         self._user = None
         self.session_id = session_id
-        self.max_workers = 10
+        self.session_cache = SessionCache('youtube', session_id)
+        self.max_in_flight = YOUTUBE_METADATA_MAX_IN_FLIGHT
+
+    @property
+    def max_workers(self) -> int:
+        """Searches a conversion keeps in flight, following the shared adaptive YTMusic limit"""
+        return ytmusic_concurrency.limit
 
     def initialize_clients(self):
         if not self._youtube:
@@ -25,7 +97,7 @@ class YouTubeMusicService:
                 raise Exception("Failed to initialize YouTube client")
 
         if not self._ytmusic:
-            self._ytmusic = YTMusic()
+            self._ytmusic = YTMusic(requests_session=instrumented_session('ytmusic'))
 
         return self._youtube, self._ytmusic
 
@@ -33,25 +105,23 @@ class YouTubeMusicService:
         """Get current user channel information"""
         if self._user is None:
             try:
-                self.initialize_clients()
-                response = self._youtube.channels().list(
-                    part='snippet',
-                    mine=True
-                ).execute()
-
-                if response['items']:
-                    channel = response['items'][0]
-                    custom_url = channel.get("snippet", {}).get("customUrl")
-                    self._user = {
-                        'id': channel['id'],
-                        'name': channel['snippet']['title'],
-                        'external_urls': f"https://music.youtube.com/{custom_url}"
-                    }
+                self._user = self.session_cache.get('user', self._fetch_user)
             except Exception as e:
                 logger.error(f"Failed to get user: {e}")
                 raise
         return self._user
 
+    def _fetch_user(self) -> Optional[Dict]:
+        self.initialize_clients()
+        response = self._youtube.channels().list(
+            part='snippet',
+            mine=True
+        ).execute()
+
+        if response['items']:
+            return channel_user(response['items'][0])
+        return None
+
     def get_playlists(self) -> List[Dict]:
         try:
             self.initialize_clients()
@@ -85,13 +155,45 @@ class YouTubeMusicService:
             logger.error(f"Failed to fetch playlists: {e}")
             raise
 
+    def playlist_index(self) -> PlaylistIndex:
+        """The user's playlists, cached and paged.
+
+        YouTube pages by token, so unlike Spotify the index is read one page
+        after another; the cache is what keeps that off the request path.
+        """
+        return PlaylistIndex('youtube', self.session_id, self.get_playlists)
+
+    def invalidate_cache(self) -> None:
+        """Drop the cached user and playlists of this session, e.g. after logging in again"""
+        self.session_cache.invalidate('user')
+        self.playlist_index().invalidate()
+
+    def get_playlist(self, playlist_id: str) -> Dict:
+        """A playlist's snippet and contentDetails, cached for SESSION_PLAYLIST_CACHE_TTL"""
+        return self.session_cache.get(f"playlist:{playlist_id}", lambda: self._fetch_playlist(playlist_id),
+                                      SESSION_PLAYLIST_CACHE_TTL)
+
+    def _fetch_playlist(self, playlist_id: str) -> Dict:
+        self.initialize_clients()
+        response = self._youtube.playlists().list(
+            part='snippet,contentDetails',
+            id=playlist_id
+        ).execute()
+        if not response['items']:
+            raise Exception(f"Playlist {playlist_id} not found")
+        return response['items'][0]
+
+    def get_playlist_size(self, playlist_id: str) -> int:
+        """Number of videos in a playlist, for estimating what converting it will cost"""
+        return self.get_playlist(playlist_id)['contentDetails']['itemCount']
+
     def get_song_metadata(self, video_id: str, title: str, channel: str) -> Dict:
         try:
             _, ytmusic = self.initialize_clients()
 
             # Search using title and channel name
             search_query = f"{title} {channel}"
-            search_results = ytmusic.search(search_query, filter='songs', limit=4)
+            search_results = search_songs(ytmusic, search_query, limit=4)
 
             # Look for a result matching our video ID
             matching_result = next(
@@ -112,60 +214,100 @@ class YouTubeMusicService:
             logger.error(f"Failed to get song metadata: {e}")
             raise
 
-    def get_playlist_tracks(self, playlist_id: str) -> List[Dict]:
-        """Get tracks from a playlist with detailed music metadata using parallel processing"""
+    def _track_from_item(self, item: Dict, future: Future) -> Optional[Dict]:
         try:
-            youtube, _ = self.initialize_clients()
-            tracks = []
-
-            # Request with videoOwnerChannelTitle in snippet
-            request = youtube.playlistItems().list(
-                part='snippet,contentDetails',
-                playlistId=playlist_id,
-                maxResults=50,
-                fields='items(snippet(title,videoOwnerChannelTitle),contentDetails(videoId)),nextPageToken'
-            )
-
-            while request:
-                response = request.execute()
+            track_data = future.result()
+            if track_data:
+                return track_data
+            # Fallback to basic metadata if no match found
+            return {
+                'id': item['contentDetails']['videoId'],
+                'title': item['snippet']['title'],
+                'artists': [item['snippet'].get('videoOwnerChannelTitle', 'Unknown Artist')],
+                'explicit': False,
+                'url': f"https://www.youtube.com/watch?v={item['contentDetails']['videoId']}"
+            }
+        except Exception as e:
+            logger.error(f"Error processing track {item['snippet']['title']}: {e}")
+            return None
+
+    def iter_playlist_tracks(self, playlist_id: str) -> Iterator[Dict]:
+        """Yield a playlist's tracks with music metadata, in playlist order.
+
+        The next page is fetched while metadata lookups for the current page run
+        on the shared pool, with at most `max_in_flight` lookups outstanding.
+        Videos already in the metadata cache skip the YTMusic search.
+        """
+        youtube, _ = self.initialize_clients()
+
+        # Request with videoOwnerChannelTitle in snippet
+        request = youtube.playlistItems().list(
+            part='snippet,contentDetails',
+            playlistId=playlist_id,
+            maxResults=50,
+            fields='items(snippet(title,videoOwnerChannelTitle),contentDetails(videoId)),nextPageToken'
+        )
+        response = request.execute()
+        pending = deque()
+        fetched = {}
+        next_page = None
+
+        def next_track():
+            item, future, looked_up = pending.popleft()
+            track = self._track_from_item(item, future)
+            # Store fresh lookups, including misses, so they aren't searched again
+            if looked_up and not future.exception():
+                fetched[item['contentDetails']['videoId']] = future.result()
+                if len(fetched) >= 50:
+                    metadata_cache.set_many(fetched)
+                    fetched.clear()
+            return track
 
-                # Process videos in parallel
-                with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-                    # Create a list of futures for metadata retrieval
-                    future_to_item = {
-                        executor.submit(
+        try:
+            while response:
+                request = youtube.playlistItems().list_next(request, response)
+                next_page = page_executor.submit(request.execute) if request else None
+
+                items = response.get('items', [])
+                cached = metadata_cache.get_many(item['contentDetails']['videoId'] for item in items)
+
+                for item in items:
+                    while len(pending) >= self.max_in_flight:
+                        track = next_track()
+                        if track:
+                            yield track
+
+                    video_id = item['contentDetails']['videoId']
+                    if video_id in cached:
+                        future = Future()
+                        future.set_result(cached[video_id])
+                        pending.append((item, future, False))
+                    else:
+                        pending.append((item, metadata_executor.submit(
                             self.get_song_metadata,
-                            item['contentDetails']['videoId'],
+                            video_id,
                             item['snippet']['title'],
                             item['snippet'].get('videoOwnerChannelTitle', '')
-                        ): item
-                        for item in response.get('items', [])
-                    }
-
-                    # Process completed futures
-                    for future in concurrent.futures.as_completed(future_to_item):
-                        item = future_to_item[future]
-                        try:
-                            track_data = future.result()
-                            if track_data:
-                                tracks.append(track_data)
-                            else:
-                                # Fallback to basic metadata if no match found
-                                basic_track = {
-                                    'id': item['contentDetails']['videoId'],
-                                    'title': item['snippet']['title'],
-                                    'artists': [item['snippet'].get('videoOwnerChannelTitle', 'Unknown Artist')],
-                                    'explicit': False,
-                                    'url': f"https://www.youtube.com/watch?v={item['contentDetails']['videoId']}"
-                                }
-                                tracks.append(basic_track)
-                        except Exception as e:
-                            logger.error(f"Error processing track {item['snippet']['title']}: {e}")
-
-                request = youtube.playlistItems().list_next(request, response)
-
-            return tracks
+                        ), True))
+
+                response = next_page.result() if next_page else None
+
+            while pending:
+                track = next_track()
+                if track:
+                    yield track
+        finally:
+            # A caller that stops early doesn't pay for the page it will never read
+            if next_page is not None:
+                next_page.cancel()
+            for _, future, _ in pending:
+                future.cancel()
+            metadata_cache.set_many(fetched)
 
+    def get_playlist_tracks(self, playlist_id: str) -> List[Dict]:
+        """Get tracks from a playlist with detailed music metadata using parallel processing"""
+        try:
+            return list(self.iter_playlist_tracks(playlist_id))
         except Exception as e:
             logger.error(f"Failed to get tracks: {e}")
             raise
@@ -174,7 +316,7 @@ class YouTubeMusicService:
         """Search for tracks on YTMusic"""
         try:
             _, ytmusic = self.initialize_clients()
-            search_results = ytmusic.search(query, filter="songs", limit=20)
+            search_results = search_songs(ytmusic, query, limit=20)
 
             tracks = []
             for result in search_results:
@@ -209,6 +351,7 @@ class YouTubeMusicService:
                     }
                 }
             ).execute()
+            self.playlist_index().invalidate()
 
             return {
                 'id': response['id'],
@@ -240,74 +383,112 @@ class YouTubeMusicService:
             logger.error(f"Failed to add track to playlist: {e}")
             return False
 
+    def add_tracks_to_playlist(self, playlist_id: str, video_ids: List[str], start_position: int = 0) -> List[Dict]:
+        """Add tracks to a playlist in order from `start_position` on, with one result per track"""
+        youtube, _ = self.initialize_clients()
+        try:
+            with stage('add_items'):
+                return PlaylistWriter(youtube, quota_user=self.session_id).add_tracks(
+                    playlist_id, video_ids, start_position
+                )
+        finally:
+            # Its itemCount changed
+            self.session_cache.invalidate(f"playlist:{playlist_id}")
+
     def find_clean_version(self, track: Dict) -> Dict:
         """Find clean version of a track using basic fuzzy matching"""
+        return self.search_clean_version(track)[0]
+
+    def search_clean_version(self, track: Dict) -> Tuple[Optional[Dict], List[Dict]]:
+        """The clean version of a track, or None with the near misses worth offering instead.
+
+        The top results are scored first; the rest of the page only when none of
+        them matches.
+        """
         try:
             _, ytmusic = self.initialize_clients()
 
             # Create search query using title and first artist
             query = f"{track['title']} {track['artists'][0]}"
-            search_results = ytmusic.search(query, filter="songs", limit=10)
-
-            best_match = None
-            best_ratio = 0
-
-            for result in search_results:
-                if result['resultType'] == 'song' and not result.get('isExplicit', False):
-                    # Compare titles using fuzzy matching
-                    ratio = fuzz.ratio(
-                        track['title'].lower().strip(),
-                        result['title'].lower().strip()
-                    )
-
-                    # If we find a very good match (over 85%), use it
-                    if ratio > 85 and ratio > best_ratio:
-                        best_ratio = ratio
-                        best_match = {
-                            'id': result['videoId'],
-                            'title': result['title'],
-                            'artists': [artist['name'] for artist in result.get('artists', [])],
-                            'explicit': result.get('isExplicit', False),
-                            'url': f"https://www.youtube.com/watch?v={result['videoId']}"
-                        }
-
-            return best_match
+            with stage('search_request'):
+                search_results = search_songs(ytmusic, query, limit=YTMUSIC_SEARCH_DEPTHS[-1])
+
+            with stage('match'):
+                for depth in YTMUSIC_SEARCH_DEPTHS[:-1]:
+                    match = match_youtube_track(track, search_results[:depth])
+                    if match:
+                        SEARCH_CANDIDATES.observe(min(depth, len(search_results)), service='ytmusic')
+                        return match, []
+                SEARCH_CANDIDATES.observe(len(search_results), service='ytmusic')
+                match = match_youtube_track(track, search_results)
+                if match:
+                    return match, []
+                return None, youtube_potential_matches(track, search_results)
         except Exception as e:
             logger.error(f"Failed to find clean version: {e}")
-            return []
-
-    def convert_playlist(self, playlist_id: str, to_clean: bool = True) -> Dict:
-        """Convert a playlist to clean/explicit versions"""
+            return None, []
+
+    def convert_playlist(self, playlist_id: str, to_clean: bool = True,
+                         progress: Optional[Callable[[str, int, int], None]] = None,
+                         insert_limit: Optional[int] = None) -> Dict:
+        """Convert a playlist to clean/explicit versions.
+
+        Only the first `insert_limit` tracks are inserted, the others are
+        returned as `deferred_inserts` for resume_conversion once there is
+        quota for them.
+        """
+        progress = progress or (lambda stage, processed=0, total=0: None)
         try:
+            progress('fetching_tracks')
             # Get all tracks from the playlist with metadata
-            tracks = self.get_playlist_tracks(playlist_id)
+            with stage('fetch_tracks'):
+                tracks = self.get_playlist_tracks(playlist_id)
+                original_playlist = self.get_playlist(playlist_id)
 
             # Create new playlist
-            original_playlist = self._youtube.playlists().list(
-                part='snippet',
-                id=playlist_id
-            ).execute()['items'][0]
-
-            new_playlist = self.create_playlist(
-                title=f"{original_playlist['snippet']['title']} ({'Clean' if to_clean else 'Explicit'})",
-                description=f"Converted from: {original_playlist['snippet']['title']}"
-            )
+            progress('creating_playlist')
+            with stage('create_playlist'):
+                new_playlist = self.create_playlist(
+                    title=f"{original_playlist['snippet']['title']} ({'Clean' if to_clean else 'Explicit'})",
+                    description=f"Converted from: {original_playlist['snippet']['title']}"
+                )
 
             clean_tracks = []
             converted_tracks = []
             remaining_tracks = []
             potential_matches = {}
 
+            # Explicit tracks are matched concurrently, at most max_workers at a time per conversion;
+            # the window is refilled to the current limit as it adapts
+            to_convert = [track for track in tracks if to_clean and track.get('explicit', False)]
+            alternatives = {}
+            pending = deque()
+            queued = iter(to_convert)
+            search_clean_version = bind(self.search_clean_version)
+
+            with stage('search'):
+                while True:
+                    for track in islice(queued, max(0, self.max_workers - len(pending))):
+                        pending.append((track, search_executor.submit(search_clean_version, track)))
+                    if not pending:
+                        break
+                    track, future = pending.popleft()
+                    alternatives[track['id']] = future.result()
+                    progress('converting', len(alternatives), len(to_convert))
+
+            # The new playlist keeps the original order, with clean versions swapped in
+            new_track_ids = []
             for track in tracks:
-                if track.get('explicit', False):
+                if track['id'] not in alternatives:
                     clean_tracks.append(track)
-                    self.add_track_to_playlist(new_playlist['id'], track['id'])
-                else:
-                    # Find alternative version
-                    alternative = self.find_clean_version(track)
+                    new_track_ids.append(track['id'])
+                elif alternatives[track['id']][0]:
+                    alternative = alternatives[track['id']][0]
                     converted_tracks.append(alternative)
-                    self.add_track_to_playlist(new_playlist['id'], alternative['id'])
-                    potential_matches[track['title']] = [alternative]
+                    new_track_ids.append(alternative['id'])
+                elif alternatives[track['id']][1]:
+                    potential_matches[track['title']] = alternatives[track['id']][1]
+                else:
                     # Format the remaining track according to schema
                     remaining_track = {
                         'name': track['title'],
@@ -316,6 +497,13 @@ class YouTubeMusicService:
                     }
                     remaining_tracks.append(remaining_track)
 
+            progress('adding_tracks', len(to_convert), len(to_convert))
+            # Past `insert_limit` the tracks wait for a later quota day
+            deferred = new_track_ids[insert_limit:] if insert_limit is not None else []
+            to_insert = new_track_ids[:len(new_track_ids) - len(deferred)]
+            insert_results = self.add_tracks_to_playlist(new_playlist['id'], to_insert)
+            failed_inserts = [result['video_id'] for result in insert_results if not result['success']]
+
             return {
                 'playlist_id': new_playlist['id'],
                 'num_original_clean': len(clean_tracks),
@@ -323,8 +511,40 @@ class YouTubeMusicService:
                 'num_still_missing': len(remaining_tracks),
                 'still_missing': remaining_tracks,
                 'potential_matches': potential_matches,
+                'num_failed_inserts': len(failed_inserts),
+                'failed_inserts': failed_inserts,
+                'num_deferred_inserts': len(deferred),
+                'deferred_inserts': deferred,
             }
 
         except Exception as e:
             logger.error(f"Failed to convert playlist: {e}")
             raise
+
+    def resume_conversion(self, result: Dict, video_ids: List[str],
+                          progress: Optional[Callable[[str, int, int], None]] = None,
+                          insert_limit: Optional[int] = None) -> Dict:
+        """Insert the tracks a conversion deferred into its new playlist, returning its updated result.
+
+        They go after the tracks inserted on earlier days: every track of the
+        new playlist except those still pending and those that failed.
+        """
+        progress = progress or (lambda stage, processed=0, total=0: None)
+        deferred = video_ids[insert_limit:] if insert_limit is not None else []
+        to_insert = video_ids[:len(video_ids) - len(deferred)]
+        inserted = (
+            result['num_original_clean'] + result['num_converted'] - len(video_ids) - len(result['failed_inserts'])
+        )
+
+        progress('adding_tracks', 0, len(to_insert))
+        insert_results = self.add_tracks_to_playlist(result['playlist_id'], to_insert, start_position=inserted)
+        failed_inserts = result['failed_inserts'] + [
+            insert['video_id'] for insert in insert_results if not insert['success']
+        ]
+        return {
+            **result,
+            'num_failed_inserts': len(failed_inserts),
+            'failed_inserts': failed_inserts,
+            'num_deferred_inserts': len(deferred),
+            'deferred_inserts': deferred,
+        }